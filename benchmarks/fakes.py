@@ -0,0 +1,138 @@
+import asyncio
+import itertools
+import json
+import random
+import time
+import uuid
+from aiogram import Bot, types
+from httpx import MockTransport, Request, Response
+
+
+class FakeCloudPayments:
+    """Локальная замена API CloudPayments для бенчмарков. Подключается к клиенту через transport():
+    CloudPayments(..., transport=fake.transport()).
+
+    latency — задержка ответа в секундах (плюс-минус jitter).
+    Заказ считается оплаченным после settle_after запросов payments/find по нему, до этого
+    payments/find отвечает, что транзакции нет. decline_rate — доля заказов, которые будут отклонены.
+    Номера заказов и транзакций начинаются с number_base, чтобы не пересекаться с настоящими"""
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.2, settle_after: int = 2,
+                 decline_rate: float = 0.1, number_base: int | None = None):
+        """Метод инициализации"""
+        self.latency = latency
+        self.jitter = jitter
+        self.settle_after = settle_after
+        self.decline_rate = decline_rate
+        self.number_base = number_base if number_base is not None else int(time.time()) * 1_000_000
+        self._numbers = itertools.count(self.number_base)
+        self._orders: dict[int, dict] = {}
+        self._checks: dict[int, int] = {}
+        self.requests: dict[str, int] = {}
+
+    def transport(self) -> MockTransport:
+        return MockTransport(self.handle)
+
+    @property
+    def orders(self) -> list[dict]:
+        return list(self._orders.values())
+
+    def transaction(self, number: int, status: str = 'Authorized', status_code: int = 2) -> dict:
+        """Транзакция по заказу в том виде, в каком ее отдает payments/find и присылает хук"""
+        order = self._orders[number]
+        return {
+            'TransactionId': number,
+            'InvoiceId': number,
+            'Amount': order['Amount'],
+            'Currency': order['Currency'],
+            'Description': order['Description'],
+            'StatusCode': status_code,
+            'Status': status,
+        }
+
+    async def handle(self, request: Request) -> Response:
+        endpoint = request.url.path.lstrip('/')
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        await asyncio.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+        params = json.loads(request.content or b'{}')
+
+        if endpoint == 'orders/create':
+            return self._json({'Success': True, 'Model': self._create_order(params)})
+        if endpoint == 'payments/find':
+            return self._json(self._find(int(params['InvoiceId'])))
+        if endpoint == 'orders/cancel':
+            return self._json({'Success': True, 'Message': None})
+        if endpoint == 'kkt/receipt':
+            return self._json({'Success': True, 'Model': {'Id': uuid.uuid4().hex}})
+        return Response(404)
+
+    def _create_order(self, params: dict) -> dict:
+        number = next(self._numbers)
+        order = {
+            'Id': uuid.uuid4().hex,
+            'Number': number,
+            'Amount': params['Amount'],
+            'Currency': params['Currency'],
+            'Email': None,
+            'Description': str(params['Description']),
+            'RequireConfirmation': params['RequireConfirmation'],
+            'Url': f'https://orders.cloudpayments.ru/d/{number}',
+            'StatusCode': 0,
+            'CreatedDateIso': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        self._orders[number] = order
+        return order
+
+    def _find(self, number: int) -> dict:
+        checks = self._checks[number] = self._checks.get(number, 0) + 1
+        if number not in self._orders or checks < self.settle_after:
+            return {'Success': False, 'Message': 'Not found'}
+        # Исход заказа зависит только от номера, чтобы повторные проверки видели один и тот же статус
+        if random.Random(number).random() < self.decline_rate:
+            return {'Success': False, 'Model': self.transaction(number, 'Declined', 5)}
+        return {'Success': True, 'Model': self.transaction(number)}
+
+    @staticmethod
+    def _json(body: dict) -> Response:
+        return Response(200, json=body)
+
+
+class FakeTelegram:
+    """Локальная замена Telegram Bot API для бенчмарков. install(bot) подменяет запросы бота,
+    так что хендлеры, уведомления и вебхук-режим работают как обычно, но без сети.
+    latency — задержка ответа в секундах"""
+
+    def __init__(self, latency: float = 0.03):
+        """Метод инициализации"""
+        self.latency = latency
+        self._message_ids = itertools.count(1)
+        self.requests: dict[str, int] = {}
+
+    def install(self, bot: Bot) -> None:
+        bot.request = self.request
+
+    async def request(self, method: str, data: dict | None = None, files: dict | None = None, **kwargs):
+        self.requests[method] = self.requests.get(method, 0) + 1
+        await asyncio.sleep(self.latency)
+        data = data or {}
+        if method == 'sendMessage':
+            return {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': int(data['chat_id']), 'type': 'private'},
+                'text': data.get('text'),
+            }
+        if method == 'getWebhookInfo':
+            return {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        return True
+
+    @staticmethod
+    def message(chat_id: int, text: str) -> types.Message:
+        """Входящее сообщение от пользователя chat_id"""
+        return types.Message.to_object({
+            'message_id': 1,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'},
+            'text': text,
+        })
@@ -0,0 +1,75 @@
+"""Микробенчмарк логов на горячем пути: сколько стоит logger.debug(), когда бот работает на INFO.
+
+Сравниваются:
+f-string — как было: строка и repr() заказа собираются до вызова loguru, даже если debug выключен
+lazy — аргументы передаются в loguru как есть, форматирование только для включенного уровня
+sampled — SampledLogger для частых событий
+info enqueue / info blocking — цена записанного INFO-сообщения для event loop: sink с enqueue=True
+(settings.log_enqueue) и обычная запись в файл из того же потока
+
+Пример:
+python -m benchmarks.logging_overhead --calls 200000
+"""
+import argparse
+import os
+import tempfile
+import timeit
+from loguru import logger
+from payment_bot.cloud_payments.models import Order
+from payment_bot.logs import LOG_FORMAT, SampledLogger
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Overhead of logging calls at INFO level')
+    parser.add_argument('--calls', type=int, default=200_000, help='calls per case')
+    parser.add_argument('--repeat', type=int, default=5, help='best of N runs')
+    return parser.parse_args()
+
+
+def make_order() -> Order:
+    return Order(id=1, number=1_000_001, amount=10.0, currency='USD', email=None,
+                 description='1000001', require_confirmation=False, url='https://pay.example/1000001',
+                 status_code=2, created='2024-01-01T00:00:00Z')
+
+
+def measure(case, calls: int, repeat: int) -> float:
+    """Лучшее время одного вызова из repeat прогонов, в наносекундах"""
+    return min(timeit.repeat(case, number=calls, repeat=repeat)) / calls * 1e9
+
+
+def main(args: argparse.Namespace) -> None:
+    order = make_order()
+    sampled = SampledLogger()
+    log_path = os.path.join(tempfile.mkdtemp(), 'bench.log')
+
+    # Тот же sink, что и в setup_logging(), но без stderr, чтобы не засорять вывод бенчмарка
+    logger.remove()
+    logger.add(log_path, level='INFO', format=LOG_FORMAT, enqueue=True)
+    cases = {
+        'noop': lambda: None,
+        'debug f-string': lambda: logger.debug(f"Order was updated: {order}, status {order.status_code}"),
+        'debug lazy': lambda: logger.debug("Order was updated: {}, status {}", order, order.status_code),
+        'debug sampled': lambda: sampled.debug("Order was updated: {}, status {}", order, order.status_code),
+    }
+    results = {name: measure(case, args.calls, args.repeat) for name, case in cases.items()}
+    # Записанные сообщения на порядки дороже, столько вызовов не нужно
+    info_calls = min(args.calls, 20_000)
+    results['info enqueue'] = measure(lambda: logger.info("Order {} was updated", order.number),
+                                      info_calls, args.repeat)
+    # Пишем хвост очереди до следующего замера, чтобы фоновый поток не мешал
+    logger.complete()
+
+    logger.remove()
+    logger.add(log_path, level='INFO', format=LOG_FORMAT)
+    results['info blocking'] = measure(lambda: logger.info("Order {} was updated", order.number),
+                                       info_calls, args.repeat)
+    logger.remove()
+
+    print(f"{'case':<18}{'ns/call':>10}")
+    print('-' * 28)
+    for name, result in results.items():
+        print(f'{name:<18}{result:>10.0f}')
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,122 @@
+"""Микробенчмарк моделей CloudPayments: память на заказ и время разбора хука.
+
+Для сравнения рядом прежняя раскладка — объект с __dict__, поля копируются из словаря по одному,
+а тело хука разбирается через parse_qs.
+
+Пример:
+python -m benchmarks.models_overhead --orders 100000
+"""
+import argparse
+import decimal
+import gc
+import timeit
+import tracemalloc
+from urllib.parse import parse_qs, urlencode
+from payment_bot.cloud_payments.models import Order, Transaction
+
+
+class DictOrder:
+    """Заказ в прежней раскладке, с __dict__"""
+
+    def __init__(self, id, number, amount, currency, email,
+                 description, require_confirmation, url, status_code, created, receipt_url=None):
+        self.id = id
+        self.number = number
+        self.amount = amount
+        self.currency = currency
+        self.email = email
+        self.description = description
+        self.require_confirmation = require_confirmation
+        self.url = url
+        self.status_code = status_code
+        self.created = created
+        self.receipt_url = receipt_url
+
+    @classmethod
+    def from_dict(cls, order_dict):
+        return cls(order_dict['Id'], order_dict['Number'], order_dict['Amount'], order_dict['Currency'],
+                   order_dict['Email'], order_dict['Description'], order_dict['RequireConfirmation'],
+                   order_dict['Url'], order_dict['StatusCode'], order_dict['CreatedDateIso'])
+
+
+class DictTransaction:
+    """Транзакция в прежней раскладке, с __dict__"""
+
+    def __init__(self, transaction_id, invoice_id, amount, currency, description, status_code, status):
+        self.transaction_id = transaction_id
+        self.invoice_id = invoice_id
+        self.amount = amount
+        self.currency = currency
+        self.description = description
+        self.status_code = status_code
+        self.status = status
+
+    @classmethod
+    def from_form(cls, body: bytes, status_code: int):
+        params = {key: values[-1] for key, values in parse_qs(body.decode('utf-8')).items()}
+        return cls(params['TransactionId'], params['InvoiceId'], params['Amount'], params['Currency'],
+                   params['Description'], status_code, params['Status'])
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Memory and parse time of CloudPayments models')
+    parser.add_argument('--orders', type=int, default=100_000, help='orders held in memory')
+    parser.add_argument('--calls', type=int, default=50_000, help='webhook parses per case')
+    parser.add_argument('--repeat', type=int, default=5, help='best of N runs')
+    return parser.parse_args()
+
+
+def order_payload(number: int) -> dict:
+    """Заказ в том виде, в каком его отдает orders/create"""
+    return {
+        'Id': f'f2K8LV6reGE9WBFn{number}', 'Number': number, 'Amount': decimal.Decimal('10.0'), 'Currency': 'USD',
+        'Email': None, 'Description': str(number), 'RequireConfirmation': True,
+        'Url': f'https://orders.cloudpayments.ru/d/f2K8LV6reGE9WBFn{number}', 'StatusCode': 0,
+        'CreatedDateIso': '2024-01-01T00:00:00',
+    }
+
+
+def webhook_body(number: int) -> bytes:
+    """Тело хука /pay: поля, которые нужны боту, и часть прочих, которые CloudPayments тоже присылает"""
+    return urlencode({
+        'TransactionId': number, 'Amount': '10.00', 'Currency': 'USD', 'PaymentAmount': '10.00',
+        'PaymentCurrency': 'USD', 'OperationType': 'Payment', 'InvoiceId': number, 'AccountId': '',
+        'SubscriptionId': '', 'Name': 'CARDHOLDER NAME', 'Email': '', 'DateTime': '2024-01-01 00:00:00',
+        'IpAddress': '127.0.0.1', 'CardFirstSix': '424242', 'CardLastFour': '4242', 'CardExpDate': '12/30',
+        'CardType': 'Visa', 'Status': 'Completed', 'TestMode': '1', 'Description': str(number),
+    }).encode()
+
+
+def memory_per_order(model, payloads: list[dict]) -> float:
+    """Сколько байт занимает один заказ, не считая значений полей, общих с payload"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    orders = [model.from_dict(payload) for payload in payloads]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del orders
+    return (after - before) / len(payloads)
+
+
+def measure(case, calls: int, repeat: int) -> float:
+    """Лучшее время одного вызова из repeat прогонов, в микросекундах"""
+    return min(timeit.repeat(case, number=calls, repeat=repeat)) / calls * 1e6
+
+
+def main(args: argparse.Namespace) -> None:
+    payloads = [order_payload(1_000_000 + i) for i in range(args.orders)]
+    body = webhook_body(1_000_001)
+
+    print(f"{'case':<24}{'dict':>10}{'slots':>10}")
+    print('-' * 44)
+    print(f"{'order, bytes':<24}{memory_per_order(DictOrder, payloads):>10.0f}"
+          f"{memory_per_order(Order, payloads):>10.0f}")
+    print(f"{'order from_dict, us':<24}{measure(lambda: DictOrder.from_dict(payloads[0]), args.calls, args.repeat):>10.2f}"
+          f"{measure(lambda: Order.from_dict(payloads[0]), args.calls, args.repeat):>10.2f}")
+    print(f"{'webhook parse, us':<24}{measure(lambda: DictTransaction.from_form(body, 2), args.calls, args.repeat):>10.2f}"
+          f"{measure(lambda: Transaction.from_form(body, StatusCode=2), args.calls, args.repeat):>10.2f}")
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,107 @@
+import json
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# Сохраненные результаты прогонов, с которыми сравниваются новые
+BASELINES_DIR = Path(__file__).parent / 'baselines'
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    """Перцентиль q (0..100) по отсортированному списку, ближайший ранг"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class LatencyRecorder:
+    """Задержки одного сценария. measure() замеряет одну операцию, summary() считает пропускную способность
+    и перцентили. Ошибки считаются отдельно и в перцентили не попадают"""
+
+    def __init__(self, name: str, concurrency: int):
+        """Метод инициализации"""
+        self.name = name
+        self.concurrency = concurrency
+        self.latencies: list[float] = []
+        self.errors = 0
+        self.started = time.perf_counter()
+        self.finished: float | None = None
+        # Показатели сценария сверх задержек, попадают в summary() как есть
+        self.extra: dict = {}
+
+    @contextmanager
+    def measure(self):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.errors += 1
+            raise
+        self.latencies.append(time.perf_counter() - started)
+
+    def record(self, latency: float) -> None:
+        self.latencies.append(latency)
+
+    def stop(self) -> None:
+        self.finished = time.perf_counter()
+
+    def summary(self) -> dict:
+        duration = (self.finished or time.perf_counter()) - self.started
+        latencies = sorted(self.latencies)
+        return {
+            'count': len(latencies),
+            'errors': self.errors,
+            'concurrency': self.concurrency,
+            'duration': round(duration, 3),
+            'throughput': round(len(latencies) / duration, 1) if duration else 0.0,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'max_ms': round(latencies[-1] * 1000, 2) if latencies else 0.0,
+            **self.extra,
+        }
+
+
+# Ключи summary(), общие для всех сценариев
+_SUMMARY_KEYS = ('count', 'errors', 'concurrency', 'duration', 'throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')
+
+
+def print_results(results: dict) -> None:
+    header = f"{'scenario':<14}{'count':>9}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    print(header)
+    print('-' * len(header))
+    for name, result in results['scenarios'].items():
+        print(f"{name:<14}{result['count']:>9}{result['errors']:>8}{result['throughput']:>10}"
+              f"{result['p50_ms']:>10}{result['p95_ms']:>10}{result['p99_ms']:>10}{result['max_ms']:>10}")
+    for name, result in results['scenarios'].items():
+        extra = {key: value for key, value in result.items() if key not in _SUMMARY_KEYS}
+        if extra:
+            print(f"{name}: " + ', '.join(f'{key} {value}' for key, value in extra.items()))
+
+
+def save_baseline(results: dict, name: str) -> Path:
+    BASELINES_DIR.mkdir(exist_ok=True)
+    path = BASELINES_DIR / f'{name}.json'
+    path.write_text(json.dumps(results, indent=2, ensure_ascii=False))
+    return path
+
+
+def compare_with_baseline(results: dict, name: str, tolerance: float) -> list[str]:
+    """Сравнивает прогон с сохраненным. Регрессия — пропускная способность упала или p95 выросла
+    больше чем на tolerance (доля). Отдает список регрессий"""
+    baseline = json.loads((BASELINES_DIR / f'{name}.json').read_text())
+    regressions = []
+    for scenario, result in results['scenarios'].items():
+        base = baseline['scenarios'].get(scenario)
+        if base is None:
+            continue
+        throughput_change = (result['throughput'] - base['throughput']) / base['throughput'] if base['throughput'] else 0.0
+        p95_change = (result['p95_ms'] - base['p95_ms']) / base['p95_ms'] if base['p95_ms'] else 0.0
+        print(f"{scenario:<14} throughput {base['throughput']} -> {result['throughput']} ({throughput_change:+.1%}), "
+              f"p95 {base['p95_ms']} -> {result['p95_ms']} ms ({p95_change:+.1%})")
+        if throughput_change < -tolerance:
+            regressions.append(f'{scenario}: throughput {throughput_change:+.1%}')
+        if p95_change > tolerance:
+            regressions.append(f'{scenario}: p95 {p95_change:+.1%}')
+    return regressions
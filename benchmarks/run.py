@@ -0,0 +1,322 @@
+"""Бенчмарк бота на локальных заменах CloudPayments и Telegram.
+
+Сценарии:
+get_payment — хендлер /get_payment: поиск открытого заказа, создание заказа, запись в бд, постановка в расписание, ответ юзеру
+webhook — прием хуков CloudPayments /pay через FastAPI-приложение режима вебхуков
+polling — планировщик polling-проверок: от постановки заказа до обработки итогового статуса
+hybrid — гибридный режим: хуки приходят по всем заказам, кроме доли --webhook-loss, а планировщик проверяет
+         только заказы без хука через --webhook-grace секунд. От постановки заказа до обработки итогового статуса,
+         плюс сколько запросов payments/find пришлось на заказ
+
+Нужен PostgreSQL из настроек (DB_NAME, DB_USER, DB_PASSWORD, DB_HOST). Лучше отдельная одноразовая база:
+заказы бенчмарка удаляются после прогона, но планировщик подхватит и чужие заказы, которые ждут проверки.
+
+Пример:
+python -m benchmarks.run --orders 10000 --save-baseline main
+python -m benchmarks.run --orders 10000 --compare main
+"""
+import argparse
+import asyncio
+import platform
+import subprocess
+import sys
+import time
+from urllib.parse import urlencode
+from loguru import logger
+from benchmarks.fakes import FakeCloudPayments, FakeTelegram
+from benchmarks.report import LatencyRecorder, compare_with_baseline, print_results, save_baseline
+from payment_bot.config import settings
+from payment_bot.logs import setup_logging
+
+SCENARIOS = ('get_payment', 'webhook', 'polling', 'hybrid')
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Offline benchmark of the payment bot')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--orders', type=int, default=1000, help='orders per scenario')
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='operations in flight at once (all orders by default)')
+    parser.add_argument('--cp-latency', type=float, default=0.05, help='fake CloudPayments latency, s')
+    parser.add_argument('--tg-latency', type=float, default=0.03, help='fake Telegram latency, s')
+    parser.add_argument('--settle-after', type=int, default=2, help='payments/find calls before an order settles')
+    parser.add_argument('--decline-rate', type=float, default=0.1)
+    parser.add_argument('--poll-delay', type=float, default=0.5, help='delay between polling checks, s')
+    parser.add_argument('--polling-workers', type=int, default=100)
+    parser.add_argument('--polling-rps', type=float, default=2000.0)
+    parser.add_argument('--webhook-loss', type=float, default=0.05, help='share of orders without a webhook (hybrid)')
+    parser.add_argument('--webhook-grace', type=float, default=1.0,
+                        help='seconds to wait for a webhook before polling (hybrid)')
+    parser.add_argument('--save-baseline', metavar='NAME')
+    parser.add_argument('--compare', metavar='NAME')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed throughput drop and p95 growth against the baseline')
+    parser.add_argument('--log-level', default='WARNING')
+    return parser.parse_args()
+
+
+class Bench:
+    """Окружение прогона: оба режима бота на фейковых CloudPayments и Telegram"""
+
+    def __init__(self, args: argparse.Namespace):
+        """Метод инициализации. Настройки меняем до импорта режимов: их объекты берут значения по умолчанию
+        из settings при импорте"""
+        self.args = args
+        self.concurrency = args.concurrency or args.orders
+        # Фейковому CloudPayments креды не нужны, но клиент без них не соберет авторизацию
+        settings.cp_p_id = settings.cp_p_id or 'bench'
+        settings.cp_api_pass = settings.cp_api_pass or 'bench'
+        settings.polling_workers = args.polling_workers
+        settings.polling_rps = args.polling_rps
+        # Лимиты Telegram к фейковому API не относятся
+        settings.notify_global_rate = 1_000_000.0
+        settings.notify_chat_rate = 1_000_000.0
+        settings.notify_chat_burst = 1_000_000.0
+
+        from fastapi import FastAPI
+        from payment_bot import core, web
+        from payment_bot.cloud_payments.cloud_payments import FixedPollingPolicy
+        from payment_bot.db_infra import db, migrations, write_behind
+        from payment_bot.lifecycle import Lifecycle, Step
+        self.core = core
+        self.db = db
+        self.write_behind = write_behind
+        # Ручки режима вебхуков без его запуска и регистрации вебхука
+        self.app = FastAPI()
+        self.app.include_router(web.router)
+
+        self.cloud_payments = FakeCloudPayments(latency=args.cp_latency, settle_after=args.settle_after,
+                                                decline_rate=args.decline_rate)
+        self.telegram = FakeTelegram(latency=args.tg_latency)
+        core.client.transport = self.cloud_payments.transport()
+        self.telegram.install(core.bot)
+        core.scheduler.policy = FixedPollingPolicy(delay=args.poll_delay, max_attempts=args.settle_after + 3)
+        # Новые заказы встают в расписание, как в polling-режиме
+        core.links.on_created = core.scheduler.add
+
+        # Общие компоненты режимов без планировщика (его запускают сценарии polling и hybrid)
+        self.lifecycle = Lifecycle('Benchmark').stage(
+            Step('migrations', migrations.migrate_async),
+            Step('db', db.connect, db.close),
+            Step('cloudpayments', core.client.start, core.client.close),
+            Step('notifier', core.notifier.start, core.notifier.stop),
+        ).stage(
+            Step('write_behind', write_behind.start, write_behind.stop),
+            Step('receipts', core.receipt_pipeline.start, core.receipt_pipeline.stop),
+        )
+
+    async def start(self) -> None:
+        await self.lifecycle.start()
+
+    async def stop(self) -> None:
+        await self.core.scheduler.stop()
+        await self.lifecycle.stop()
+        self.cleanup()
+        await logger.complete()
+
+    def cleanup(self) -> None:
+        """Удаляет заказы и хуки бенчмарка"""
+        base = self.cloud_payments.number_base
+        self.db.Orders.delete().where(self.db.Orders.number >= base).execute()
+        self.db.ProcessedWebhooks.delete().where(self.db.ProcessedWebhooks.transaction_id >= base).execute()
+
+    async def run_all(self, concurrency: int, count: int, operation) -> None:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run_one(i: int) -> None:
+            async with semaphore:
+                try:
+                    await operation(i)
+                except Exception as e:
+                    logger.error("Benchmark operation failed: {}", e)
+
+        await asyncio.gather(*(run_one(i) for i in range(count)))
+
+    async def create_orders(self, count: int) -> list:
+        """Подготовка сценария: заказы в CloudPayments и в бд, без замеров"""
+        client = self.core.client
+        orders = []
+
+        async def create(i: int) -> None:
+            order = await client.create_order_link(10.0, 'USD', 1_000_000 + i)
+            await self.db.add_order(order)
+            orders.append(order)
+
+        await self.run_all(self.concurrency, count, create)
+        return orders
+
+    async def bench_get_payment(self) -> LatencyRecorder:
+        from aiogram import Bot
+        Bot.set_current(self.core.bot)
+        recorder = LatencyRecorder('get_payment', self.concurrency)
+        numbers_before = len(self.cloud_payments.orders)
+
+        async def get_payment(i: int) -> None:
+            message = FakeTelegram.message(1_000_000 + i, '/get_payment')
+            with recorder.measure():
+                await self.core.get_payment_link(message)
+
+        await self.run_all(self.concurrency, self.args.orders, get_payment)
+        recorder.stop()
+        # Эти заказы проверять не нужно: снимаем их с расписания и в памяти, и в бд
+        scheduler = self.core.scheduler
+        for order in self.cloud_payments.orders[numbers_before:]:
+            scheduler.discard(order['Number'])
+            await self.db.save_poll_state(order['Number'], scheduler.owner, None, 0, None)
+        return recorder
+
+    async def bench_webhook(self) -> LatencyRecorder:
+        import httpx
+        orders = await self.create_orders(self.args.orders)
+        bodies = [urlencode(self.cloud_payments.transaction(int(order.number))).encode() for order in orders]
+        recorder = LatencyRecorder('webhook', self.concurrency)
+        transport = httpx.ASGITransport(app=self.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as http:
+            async def send_webhook(i: int) -> None:
+                with recorder.measure():
+                    response = await http.post('/pay', content=bodies[i],
+                                               headers={'Content-Type': 'application/x-www-form-urlencoded'})
+                    response.raise_for_status()
+
+            await self.run_all(self.concurrency, len(bodies), send_webhook)
+        recorder.stop()
+        return recorder
+
+    async def bench_polling(self) -> LatencyRecorder:
+        scheduler = self.core.scheduler
+        orders = await self.create_orders(self.args.orders)
+        recorder = LatencyRecorder('polling', self.concurrency)
+        added_at: dict[int, float] = {}
+        pending = {int(order.number) for order in orders}
+        done = asyncio.Event()
+        on_finished = scheduler.on_finished
+
+        async def record_finished(order) -> None:
+            try:
+                await on_finished(order)
+            finally:
+                number = int(order.number)
+                if number in pending:
+                    pending.discard(number)
+                    recorder.record(time.perf_counter() - added_at[number])
+                    if not pending:
+                        done.set()
+
+        scheduler.on_finished = record_finished
+        await scheduler.start()
+
+        async def add(i: int) -> None:
+            added_at[int(orders[i].number)] = time.perf_counter()
+            await scheduler.add(orders[i], delay=0)
+
+        await self.run_all(self.concurrency, len(orders), add)
+        # Проверки, которые так и не дошли до итога, считаем ошибками
+        timeout = self.args.poll_delay * (self.args.settle_after + 3) + len(orders) / self.args.polling_rps + 30
+        try:
+            await asyncio.wait_for(done.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            recorder.errors += len(pending)
+        recorder.stop()
+        scheduler.on_finished = on_finished
+        return recorder
+
+    async def bench_hybrid(self) -> LatencyRecorder:
+        import httpx
+        core = self.core
+        orders = await self.create_orders(self.args.orders)
+        recorder = LatencyRecorder('hybrid', self.concurrency)
+        added_at: dict[int, float] = {}
+        pending = {int(order.number) for order in orders}
+        done = asyncio.Event()
+        settle_order = core.settle_order
+
+        # И хук, и планировщик доходят до core.settle_order(): по нему и замеряем
+        async def record_settled(order, *args, **kwargs) -> None:
+            try:
+                await settle_order(order, *args, **kwargs)
+            finally:
+                number = int(order.number)
+                if number in pending:
+                    pending.discard(number)
+                    recorder.record(time.perf_counter() - added_at[number])
+                    if not pending:
+                        done.set()
+
+        core.settle_order = record_settled
+        finds_before = self.cloud_payments.requests.get('payments/find', 0)
+        await core.scheduler.start()
+
+        async def add(i: int) -> None:
+            added_at[int(orders[i].number)] = time.perf_counter()
+            await core.scheduler.add(orders[i], delay=self.args.webhook_grace)
+
+        await self.run_all(self.concurrency, len(orders), add)
+        # По доле заказов хук теряется: их должен найти планировщик
+        delivered = orders[int(len(orders) * self.args.webhook_loss):]
+        bodies = [urlencode(self.cloud_payments.transaction(int(order.number))).encode() for order in delivered]
+        transport = httpx.ASGITransport(app=self.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as http:
+            async def send_webhook(i: int) -> None:
+                response = await http.post('/pay', content=bodies[i],
+                                           headers={'Content-Type': 'application/x-www-form-urlencoded'})
+                response.raise_for_status()
+
+            await self.run_all(self.concurrency, len(bodies), send_webhook)
+
+        timeout = (self.args.webhook_grace + self.args.poll_delay * (self.args.settle_after + 3)
+                   + len(orders) / self.args.polling_rps + 30)
+        try:
+            await asyncio.wait_for(done.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            recorder.errors += len(pending)
+        recorder.stop()
+        await core.scheduler.stop()
+        core.settle_order = settle_order
+        finds = self.cloud_payments.requests.get('payments/find', 0) - finds_before
+        recorder.extra['finds_per_order'] = round(finds / len(orders), 3) if orders else 0.0
+        return recorder
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args: argparse.Namespace) -> dict:
+    bench = Bench(args)
+    await bench.start()
+    scenarios = {}
+    try:
+        for name in args.scenarios:
+            recorder = await getattr(bench, f'bench_{name}')()
+            scenarios[name] = recorder.summary()
+    finally:
+        await bench.stop()
+    return {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': {key: value for key, value in vars(args).items()
+                   if key not in ('save_baseline', 'compare', 'log_level')},
+        'cloud_payments_requests': bench.cloud_payments.requests,
+        'telegram_requests': bench.telegram.requests,
+        'scenarios': scenarios,
+    }
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    setup_logging(arguments.log_level)
+
+    results = asyncio.run(main(arguments))
+    print_results(results)
+    if arguments.save_baseline:
+        print(f'Baseline saved to {save_baseline(results, arguments.save_baseline)}')
+    if arguments.compare:
+        regressions = compare_with_baseline(results, arguments.compare, arguments.tolerance)
+        if regressions:
+            print('Regressions: ' + '; '.join(regressions))
+            sys.exit(1)
@@ -0,0 +1,84 @@
+import time
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from payment_bot import metrics
+from payment_bot.config import settings
+from payment_bot.db_infra.cache import TTLCache
+from payment_bot.rate_limit import TokenBucket
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Пишет время работы хендлеров сообщений в metrics.HANDLER_SECONDS с меткой по имени хендлера.
+    post_process вызывается и после исключения в хендлере, так что упавшие вызовы тоже попадают в метрику"""
+
+    async def on_process_message(self, message: types.Message, data: dict) -> None:
+        data['metrics_handler'] = current_handler.get().__name__
+        data['metrics_started'] = time.perf_counter()
+
+    async def on_post_process_message(self, message: types.Message, results: list, data: dict) -> None:
+        if 'metrics_started' in data:
+            metrics.HANDLER_SECONDS.labels(data['metrics_handler']).observe(
+                time.perf_counter() - data['metrics_started'])
+
+
+def rate_limit(rate: float, burst: float | None = None):
+    """Декоратор хендлера: не больше rate сообщений в секунду от одного юзера, со всплеском до burst.
+    Лимит соблюдает ThrottlingMiddleware, хендлеры без декоратора не ограничиваются"""
+
+    def decorator(func):
+        func.throttling_rate = rate
+        func.throttling_burst = burst
+        return func
+
+    return decorator
+
+
+class _UserLimit:
+    """Лимит одного юзера на одном хендлере и флаг, что юзер уже предупрежден"""
+
+    __slots__ = ('bucket', 'warned')
+
+    def __init__(self, rate: float, burst: float | None):
+        """Метод инициализации"""
+        self.bucket = TokenBucket(rate, burst)
+        self.warned = False
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Ограничивает частоту сообщений от одного юзера для хендлеров с декоратором rate_limit().
+    Сообщение сверх лимита до хендлера не доходит. О превышении юзер узнает один раз,
+    пока снова не уложится в лимит: ответы на флуд сами по себе не должны упираться в лимиты Telegram.
+    Лимиты хранятся в TTLCache: юзеры, которые давно ничего не присылали, вытесняются"""
+
+    def __init__(self, max_users: int = settings.throttle_max_users):
+        """Метод инициализации"""
+        super().__init__()
+        self._limits = TTLCache(max_users, ttl=60 * 60)
+        self.throttled = 0
+
+    async def on_process_message(self, message: types.Message, data: dict) -> None:
+        handler = current_handler.get()
+        rate = getattr(handler, 'throttling_rate', None)
+        if rate is None:
+            return
+
+        key = (handler.__name__, message.from_id)
+        limit = self._limits.get(key)
+        if limit is None:
+            limit = _UserLimit(rate, getattr(handler, 'throttling_burst', None))
+            self._limits.set(key, limit)
+
+        if limit.bucket.try_acquire():
+            limit.warned = False
+            return
+
+        self.throttled += 1
+        metrics.THROTTLED_MESSAGES.labels(handler.__name__).inc()
+        if not limit.warned:
+            limit.warned = True
+            await message.answer(f'Too many requests. Please try again in {limit.bucket.delay():.0f} s.')
+        raise CancelHandler()
+
+    def stats(self) -> dict:
+        return {'users': len(self._limits), 'throttled': self.throttled}
@@ -0,0 +1,249 @@
+import asyncio
+import heapq
+import itertools
+import time
+from enum import IntEnum
+from aiogram import Bot
+from aiogram.utils import exceptions
+from loguru import logger
+from payment_bot import metrics
+from payment_bot.config import settings
+from payment_bot.db_infra.cache import TTLCache
+from payment_bot.rate_limit import TokenBucket
+
+# Ограничение Telegram на длину одного сообщения
+MAX_MESSAGE_LENGTH = 4096
+
+# Разделитель между склеенными сообщениями
+_SEPARATOR = '\n\n'
+
+
+class Priority(IntEnum):
+    """Приоритет уведомления: чем меньше, тем раньше уходит"""
+    high = 0
+    normal = 1
+    low = 2
+
+
+class _Outbox:
+    """Сообщения, которые ждут отправки в один чат"""
+
+    def __init__(self, priority: Priority):
+        """Метод инициализации"""
+        self.texts: list[str] = []
+        self.priority = priority
+        self.seq = 0
+        self.not_before = 0.0
+        self.attempts = 0
+        self.sending = False
+
+
+def _take_chunk(texts: list[str]) -> tuple[str, list[str]]:
+    """Склеивает сообщения из начала очереди в одно, пока оно влезает в MAX_MESSAGE_LENGTH.
+    Отдает склеенный текст и то, что осталось"""
+    length = len(texts[0])
+    count = 1
+    for text in texts[1:]:
+        length += len(_SEPARATOR) + len(text)
+        if length > MAX_MESSAGE_LENGTH:
+            break
+        count += 1
+    return _SEPARATOR.join(texts[:count]), texts[count:]
+
+
+class Notifier:
+    """Отправка уведомлений в Telegram в фоне. Методы:
+    notify() — ставит сообщение в очередь и сразу возвращает управление
+    start() и stop() — запускают отправку и останавливают ее, дослав то, что уже в очереди
+    stats() — счетчики отправленных, склеенных, отложенных и потерянных сообщений
+
+    Сообщения уходят по приоритету, но не чаще общего лимита бота и лимита на один чат.
+    Все, что накопилось для одного чата, пока он ждал своей очереди, уходит одним сообщением.
+    На RetryAfter чат откладывается на время, которое назвал Telegram."""
+
+    def __init__(self, bot: Bot,
+                 global_rate: float = settings.notify_global_rate,
+                 chat_rate: float = settings.notify_chat_rate,
+                 chat_burst: float = settings.notify_chat_burst,
+                 concurrency: int = settings.notify_concurrency,
+                 max_chats: int = settings.notify_max_chats,
+                 max_attempts: int = settings.notify_max_attempts,
+                 retry_delay: float = settings.notify_retry_delay):
+        """Метод инициализации"""
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.concurrency = concurrency
+        self.max_chats = max_chats
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._global_limiter = TokenBucket(global_rate)
+        # Лимиты чатов нужны, только пока в чат недавно писали
+        self._chat_limiters = TTLCache(max_chats, ttl=60.0)
+        self._outboxes: dict[int, _Outbox] = {}
+        # Чаты, готовые к отправке: (приоритет, порядковый номер, чат)
+        self._ready: list[tuple[int, int, int]] = []
+        # Чаты, которые ждут лимита или RetryAfter: (когда можно отправлять, приоритет, номер, чат)
+        self._deferred: list[tuple[float, int, int, int]] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._dispatcher: asyncio.Task | None = None
+        self._sending: set[asyncio.Task] = set()
+        self.queued = 0
+        self.sent = 0
+        self.merged = 0
+        self.retry_after = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def notify(self, chat_id, text: str, priority: Priority = Priority.normal) -> None:
+        """Ставит сообщение в очередь. Не ждет ни Telegram, ни лимитов"""
+        chat_id = int(chat_id)
+        outbox = self._outboxes.get(chat_id)
+        if outbox is None:
+            if len(self._outboxes) >= self.max_chats:
+                self.dropped += 1
+                logger.warning("Notification queue is full ({} chats), message to {} dropped",
+                               len(self._outboxes), chat_id)
+                return
+            outbox = self._outboxes[chat_id] = _Outbox(priority)
+            outbox.texts.append(text)
+            self.queued += 1
+            self._schedule(chat_id, outbox)
+            return
+
+        outbox.texts.append(text)
+        self.queued += 1
+        self.merged += 1
+        if priority < outbox.priority:
+            outbox.priority = priority
+            if not outbox.sending:
+                self._schedule(chat_id, outbox)
+
+    async def start(self) -> None:
+        """Запускает фоновую отправку"""
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+            logger.info("Notifier started: {} msg/s, {} msg/s per chat", self._global_limiter.rate, self.chat_rate)
+
+    async def stop(self, timeout: float = settings.shutdown_timeout) -> None:
+        """Досылает то, что уже в очереди (не дольше timeout), и останавливает отправку"""
+        if self._dispatcher is None:
+            return
+        try:
+            await asyncio.wait_for(self._drain(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Notifications were not sent in {}s, {} chats left", timeout, len(self._outboxes))
+        tasks = [self._dispatcher, *self._sending]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._dispatcher = None
+        logger.info("Notifier stopped. Sent: {}, merged: {}, failed: {}", self.sent, self.merged, self.failed)
+
+    def stats(self) -> dict:
+        return {
+            'pending_chats': len(self._outboxes),
+            'pending_messages': sum(len(outbox.texts) for outbox in self._outboxes.values()),
+            'queued': self.queued,
+            'sent': self.sent,
+            'merged': self.merged,
+            'retry_after': self.retry_after,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    async def _drain(self) -> None:
+        while self._outboxes:
+            await asyncio.sleep(0.05)
+
+    def _schedule(self, chat_id: int, outbox: _Outbox) -> None:
+        """Ставит чат в очередь на отправку. Прежние записи этого чата в кучах становятся неактуальными"""
+        outbox.seq = next(self._seq)
+        heapq.heappush(self._ready, (outbox.priority, outbox.seq, chat_id))
+        self._wakeup.set()
+
+    def _chat_limiter(self, chat_id: int) -> TokenBucket:
+        limiter = self._chat_limiters.get(chat_id)
+        if limiter is None:
+            limiter = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_limiters.set(chat_id, limiter)
+        return limiter
+
+    async def _dispatch(self) -> None:
+        """Достает чаты по приоритету и запускает отправку, соблюдая лимиты"""
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            while self._deferred and self._deferred[0][0] <= now:
+                _, priority, seq, chat_id = heapq.heappop(self._deferred)
+                heapq.heappush(self._ready, (priority, seq, chat_id))
+
+            if not self._ready:
+                timeout = self._deferred[0][0] - now if self._deferred else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            priority, seq, chat_id = heapq.heappop(self._ready)
+            outbox = self._outboxes.get(chat_id)
+            if outbox is None or outbox.sending or outbox.seq != seq:
+                continue
+
+            limiter = self._chat_limiter(chat_id)
+            delay = max(outbox.not_before - now, limiter.delay())
+            if delay > 0:
+                heapq.heappush(self._deferred, (now + delay, priority, seq, chat_id))
+                continue
+
+            await self._global_limiter.acquire()
+            await self._slots.acquire()
+            limiter.try_acquire()
+            outbox.sending = True
+            task = asyncio.create_task(self._send(chat_id, outbox))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, chat_id: int, outbox: _Outbox) -> None:
+        """Отправляет в чат все, что для него накопилось (в пределах MAX_MESSAGE_LENGTH)"""
+        text, outbox.texts = _take_chunk(outbox.texts)
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            await self.bot.send_message(chat_id, text)
+            outcome = 'ok'
+            self.sent += 1
+            outbox.attempts = 0
+        except exceptions.RetryAfter as e:
+            outcome = 'retry_after'
+            self.retry_after += 1
+            outbox.texts.insert(0, text)
+            outbox.not_before = time.monotonic() + e.timeout
+            logger.warning("Telegram flood control for chat {}, retry in {}s", chat_id, e.timeout)
+        except (exceptions.Unauthorized, exceptions.ChatNotFound) as e:
+            # Бот заблокирован или чата нет: слать туда больше нечего
+            outcome = 'dropped'
+            self.dropped += 1 + len(outbox.texts)
+            outbox.texts = []
+            logger.warning("Notifications to chat {} dropped: {}", chat_id, e)
+        except Exception as e:
+            outbox.attempts += 1
+            if outbox.attempts >= self.max_attempts:
+                self.failed += 1
+                outbox.attempts = 0
+                logger.error("Notification to chat {} failed after {} attempts: {}", chat_id, self.max_attempts, e)
+            else:
+                outbox.texts.insert(0, text)
+                outbox.not_before = time.monotonic() + self.retry_delay * 2 ** (outbox.attempts - 1)
+                logger.warning("Notification to chat {} failed, attempt {}: {}", chat_id, outbox.attempts, e)
+        finally:
+            metrics.TELEGRAM_SEND_SECONDS.labels(outcome).observe(time.perf_counter() - started)
+            outbox.sending = False
+            self._slots.release()
+            if outbox.texts:
+                self._schedule(chat_id, outbox)
+            else:
+                del self._outboxes[chat_id]
@@ -0,0 +1,87 @@
+import asyncio
+from aiogram import Bot, Dispatcher, types
+from loguru import logger
+from payment_bot.config import settings
+
+
+class UpdateQueue:
+    """Ограниченная очередь апдейтов Telegram для режима вебхуков. Методы:
+    put() — кладет апдейт в очередь и сразу возвращает управление (ждет не дольше put_timeout, если очередь полна)
+    start() и stop() — запускают пул воркеров и останавливают его, дожидаясь обработки того, что уже в очереди
+    stats() — глубина очереди и счетчики принятых, отклоненных и обработанных апдейтов"""
+
+    def __init__(self, dp: Dispatcher, workers: int = settings.webhook_workers,
+                 maxsize: int = settings.webhook_queue_size,
+                 put_timeout: float = settings.webhook_queue_put_timeout):
+        """Метод инициализации"""
+        self.dp = dp
+        self.workers = workers
+        self.put_timeout = put_timeout
+        self._queue: asyncio.Queue[types.Update] = asyncio.Queue(maxsize=maxsize)
+        self._workers: list[asyncio.Task] = []
+        self.max_depth = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+
+    async def put(self, update: types.Update) -> bool:
+        """Кладет апдейт в очередь. Если за put_timeout место не освободилось, отдает False"""
+        try:
+            await asyncio.wait_for(self._queue.put(update), timeout=self.put_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            logger.warning("Update queue is full ({}), update {} rejected", self._queue.qsize(), update.update_id)
+            return False
+        self.accepted += 1
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    async def start(self) -> None:
+        """Запускает пул воркеров"""
+        if self._workers:
+            return
+        for _ in range(self.workers):
+            self._workers.append(asyncio.create_task(self._work()))
+        logger.info("Update queue started with {} workers", self.workers)
+
+    async def stop(self, timeout: float = settings.shutdown_timeout) -> None:
+        """Дожидается обработки апдейтов, которые уже в очереди (не дольше timeout), и останавливает воркеры"""
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Update queue was not drained in {}s, {} updates dropped", timeout, self._queue.qsize())
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logger.info("Update queue stopped. Processed: {}, failed: {}", self.processed, self.failed)
+
+    def stats(self) -> dict:
+        return {
+            'depth': self._queue.qsize(),
+            'max_depth': self.max_depth,
+            'capacity': self._queue.maxsize,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'processed': self.processed,
+            'failed': self.failed,
+        }
+
+    async def _work(self) -> None:
+        """Воркер: достает апдейты из очереди и отдает их диспетчеру aiogram"""
+        # Хендлеры aiogram берут бота и диспетчер из контекста
+        Dispatcher.set_current(self.dp)
+        Bot.set_current(self.dp.bot)
+        while True:
+            update = await self._queue.get()
+            try:
+                await self.dp.process_update(update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error("Update {} processing failed: {}", update.update_id, e)
+            finally:
+                self._queue.task_done()
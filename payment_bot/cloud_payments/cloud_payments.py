@@ -1,38 +1,263 @@
-from httpx import AsyncClient, BasicAuth
+from httpx import AsyncBaseTransport, AsyncClient, BasicAuth, Limits, Timeout, TransportError, USE_CLIENT_DEFAULT
 from payment_bot.config import settings
+from payment_bot import metrics
 from loguru import logger
+from payment_bot.logs import SampledLogger
+from payment_bot.cloud_payments.models import Order, Transaction, TransactionStatus, StatusCode, Receipt
 import asyncio
-from payment_bot.cloud_payments.models import Order, Transaction, StatusCode, Receipt
+import datetime
 import decimal
 import json
+import random
+import time
+
+# payments/find дергает каждая polling-проверка: в лог попадает только часть ответов
+_find_log = SampledLogger()
+
+
+class CloudPaymentsError(Exception):
+    """Ошибка запроса к CloudPayments. retryable=True — сбой на стороне CloudPayments или сети
+    (таймаут, 5xx, 429, ответ не в JSON): такой запрос можно повторить"""
+
+    def __init__(self, endpoint: str, message: str, retryable: bool = False):
+        """Метод инициализации"""
+        super().__init__(f'CloudPayments {endpoint}: {message}')
+        self.endpoint = endpoint
+        self.retryable = retryable
+
+
+class CircuitOpenError(CloudPaymentsError):
+    """Запрос не отправлен: CircuitBreaker разомкнут. retry_after — через сколько секунд пробовать снова"""
+
+    def __init__(self, endpoint: str, retry_after: float):
+        """Метод инициализации"""
+        super().__init__(endpoint, f'circuit breaker is open, retry in {retry_after:.1f}s')
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Circuit breaker для запросов к CloudPayments. Состояния:
+    closed — запросы идут как обычно, считаем сбои подряд
+    open — после failure_threshold сбоев подряд запросы сразу падают с CircuitOpenError, не дожидаясь таймаутов
+    half_open — через recovery_timeout пропускаем один пробный запрос: успех замыкает цепь, сбой снова размыкает"""
+
+    closed = 'closed'
+    open = 'open'
+    half_open = 'half_open'
+
+    def __init__(self, failure_threshold: int = settings.cp_breaker_threshold,
+                 recovery_timeout: float = settings.cp_breaker_recovery):
+        """Метод инициализации"""
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.closed
+        self.consecutive_failures = 0
+        self.opened_total = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        # Пока пробный запрос не вернулся (но не дольше recovery_timeout), остальные запросы не пускаем
+        self._probe_until = 0.0
+
+    def retry_after(self) -> float:
+        """Через сколько секунд breaker пропустит запрос. 0 — пропустит сейчас"""
+        now = time.monotonic()
+        if self.state == self.open:
+            return max(0.0, self._opened_at + self.recovery_timeout - now)
+        if self.state == self.half_open:
+            return max(0.0, self._probe_until - now)
+        return 0.0
+
+    def before_call(self, endpoint: str) -> None:
+        """Пропускает запрос или бросает CircuitOpenError"""
+        now = time.monotonic()
+        if self.state == self.open and now >= self._opened_at + self.recovery_timeout:
+            self.state = self.half_open
+            self._probe_until = 0.0
+            logger.info("CloudPayments circuit breaker is half-open, sending a probe request")
+        if self.state == self.closed:
+            return
+        if self.state == self.half_open and now >= self._probe_until:
+            self._probe_until = now + self.recovery_timeout
+            return
+        self.rejected += 1
+        raise CircuitOpenError(endpoint, self.retry_after())
+
+    def record_success(self) -> None:
+        # Запрос, отправленный до размыкания, ничего не говорит о текущем состоянии CloudPayments
+        if self.state == self.open:
+            return
+        if self.state == self.half_open:
+            logger.info("CloudPayments circuit breaker is closed")
+        self.state = self.closed
+        self.consecutive_failures = 0
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self.state == self.open:
+            return
+        if self.state == self.half_open or self.consecutive_failures >= self.failure_threshold:
+            self.state = self.open
+            self._opened_at = time.monotonic()
+            self.opened_total += 1
+            logger.warning("CloudPayments circuit breaker is open for {}s after {} failures in a row",
+                           self.recovery_timeout, self.consecutive_failures)
+
+    def stats(self) -> dict:
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'opened_total': self.opened_total,
+            'rejected': self.rejected,
+        }
 
 
 class CloudPayments:
     """Класс клиента CloudPayments. Методы:
     create_order_link() — формирует платеж в системе и отдает ссылку для оплаты
     check_order() — разовая проверка статуса платежа
-    check_order_polling() — перманентный метод для проверки платежа в формате polling
-                            (раз в несколько секунд, определенное количество раз, в зависимости от настроек)
+    find_transaction() — разовый запрос транзакции по заказу, на нем работает планировщик polling-проверок
+    list_payments() — страница транзакций за интервал, на нем работает сверка (reconciliation.py)
     cancel_payment() — отменяет платеж
     update_order() — обновляет статус-код в инстансе заказа
-    create_receipt_url() — создает чек и отдает ссылочку на него"""
+    create_receipt_url() — создает чек и отдает ссылочку на него
+    create_receipt() — то же по заранее собранным параметрам запроса (см. receipts.ReceiptTemplate)
+    start() и close() — открывают и закрывают общий пул HTTP-соединений, вызываются при старте и остановке бота
+    stats() — счетчики запросов, повторов и сбоев и состояние circuit breaker
+
+    Ошибки запросов приходят как CloudPaymentsError. Идемпотентные запросы (settings.cp_idempotent_endpoints)
+    при сбое повторяются с экспоненциальной задержкой. Если CloudPayments недоступен, breaker размыкается,
+    и запросы сразу падают с CircuitOpenError"""
 
     # URL для обращения к API CloudPayments
     URL = 'https://api.cloudpayments.ru/'
 
-    def __init__(self, cp_public_id, api_password):
-        """Метод инициализации. Передаем public_ID и API_password из настроек CloudPayments"""
+    def __init__(self, cp_public_id, api_password, transport: AsyncBaseTransport | None = None):
+        """Метод инициализации. Передаем public_ID и API_password из настроек CloudPayments.
+        transport — свой транспорт httpx вместо сети (например, httpx.MockTransport в бенчмарках)"""
         self.cp_public_id = cp_public_id
         self.api_password = api_password
+        self.transport = transport
+        # Общий клиент с пулом соединений, живет все время работы бота
+        self._client: AsyncClient | None = None
+        self.breaker = CircuitBreaker()
+        # Таймауты эндпоинтов собираем один раз. Для остальных эндпоинтов действуют таймауты клиента
+        self._timeouts = {endpoint: Timeout(timeout, connect=settings.http_connect_timeout,
+                                            pool=settings.http_pool_timeout)
+                          for endpoint, timeout in settings.cp_endpoint_timeouts.items()}
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+
+    async def start(self) -> None:
+        """Открывает общий пул соединений с CloudPayments"""
+        self._get_client()
+
+    async def close(self) -> None:
+        """Закрывает пул соединений. Вызывается при остановке бота"""
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
+            logger.info("CloudPayments client closed")
+
+    def _get_client(self) -> AsyncClient:
+        """Отдает общий клиент. Если start() не вызывали, создает его при первом запросе"""
+        if self._client is None or self._client.is_closed:
+            self._client = self._create_client()
+        return self._client
 
-    async def _send_request(self, endpoint, params=None) -> json:
-        """Универсальный внутренний метод для создания асинхронного запроса с нужными параметрами"""
+    def _create_client(self) -> AsyncClient:
+        """Создает клиент с keep-alive пулом и таймаутами из настроек"""
+        http2 = settings.http2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("HTTP/2 is enabled, but h2 is not installed. Falling back to HTTP/1.1")
+                http2 = False
+
+        limits = Limits(max_connections=settings.http_max_connections,
+                        max_keepalive_connections=settings.http_max_keepalive_connections,
+                        keepalive_expiry=settings.http_keepalive_expiry)
+        timeout = Timeout(connect=settings.http_connect_timeout,
+                          read=settings.http_read_timeout,
+                          write=settings.http_write_timeout,
+                          pool=settings.http_pool_timeout)
+        logger.info("CloudPayments connection pool created. HTTP/2: {}", http2)
+        # Авторизацию собираем один раз на весь пул, а не на каждый запрос
         auth = BasicAuth(self.cp_public_id, self.api_password)
-        async with AsyncClient() as async_client:
-            async_response = await async_client.post(url=self.URL + endpoint,
-                                                     auth=auth,
-                                                     json=params)
-            return async_response.json(parse_float=decimal.Decimal)
+        return AsyncClient(base_url=self.URL, auth=auth, http2=http2,
+                           limits=limits, timeout=timeout, transport=self.transport)
+
+    def stats(self) -> dict:
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'failures': self.failures,
+            'breaker': self.breaker.stats(),
+        }
+
+    async def _send_request(self, endpoint, params=None, request_id: str | None = None) -> json:
+        """Универсальный внутренний метод для создания асинхронного запроса с нужными параметрами.
+        Все запросы идут через общий пул соединений, так что TLS-хендшейк не повторяется на каждый вызов.
+        request_id уходит в заголовке X-Request-ID: повтор запроса с тем же id CloudPayments не выполнит дважды.
+        Идемпотентные запросы при сбое повторяются до settings.cp_retry_attempts раз.
+        Время запроса вместе с повторами и его исход пишутся в метрики"""
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            response = await self._send_with_retries(endpoint, params, request_id)
+            outcome = 'ok'
+            return response
+        except CircuitOpenError:
+            outcome = 'rejected'
+            raise
+        finally:
+            if outcome != 'rejected':
+                metrics.CLOUDPAYMENTS_REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - started)
+            metrics.CLOUDPAYMENTS_REQUESTS.labels(endpoint, outcome).inc()
+
+    async def _send_with_retries(self, endpoint, params, request_id: str | None) -> json:
+        headers = {'X-Request-ID': request_id} if request_id else None
+        attempts = settings.cp_retry_attempts if endpoint in settings.cp_idempotent_endpoints else 1
+        for attempt in range(1, attempts + 1):
+            self.breaker.before_call(endpoint)
+            self.requests += 1
+            try:
+                response = await self._post(endpoint, params, headers)
+            except CloudPaymentsError as e:
+                if not e.retryable:
+                    # CloudPayments ответил, значит он жив
+                    self.breaker.record_success()
+                    raise
+                self.failures += 1
+                self.breaker.record_failure()
+                # После размыкания breaker повтор все равно не уйдет, отдаем исходную ошибку
+                if attempt == attempts or self.breaker.state == CircuitBreaker.open:
+                    raise
+                delay = min(settings.cp_retry_max_delay, settings.cp_retry_base_delay * 2 ** (attempt - 1))
+                delay *= random.uniform(0.5, 1.0)
+                self.retries += 1
+                logger.warning("{}. Attempt {} of {}, retry in {:.2f}s", e, attempt, attempts, delay)
+                await asyncio.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return response
+
+    async def _post(self, endpoint, params, headers) -> json:
+        """Один запрос к CloudPayments без повторов"""
+        try:
+            response = await self._get_client().post(endpoint, json=params, headers=headers,
+                                                     timeout=self._timeouts.get(endpoint, USE_CLIENT_DEFAULT))
+        except TransportError as e:
+            raise CloudPaymentsError(endpoint, f'{type(e).__name__}: {e}', retryable=True) from e
+        if response.status_code >= 500 or response.status_code == 429:
+            raise CloudPaymentsError(endpoint, f'HTTP {response.status_code}', retryable=True)
+        if response.status_code >= 400:
+            raise CloudPaymentsError(endpoint, f'HTTP {response.status_code}')
+        try:
+            return response.json(parse_float=decimal.Decimal)
+        except ValueError as e:
+            raise CloudPaymentsError(endpoint, f'invalid JSON in response: {e}', retryable=True) from e
 
     async def create_order_link(self, amount, currency, description) -> Order:
         """Метод, который создает заказ в CloudPayments и возвращает объект заказа"""
@@ -44,54 +269,51 @@ class CloudPayments:
             "RequireConfirmation": 'true',
         }
         create_order_response = await self._send_request(endpoint, params)
-        logger.debug(f"The response has been received: {create_order_response['Model']}")
+        logger.debug("The response has been received: {}", create_order_response.get('Model'))
         if create_order_response['Success']:
             return Order.from_dict(create_order_response['Model'])
+        raise CloudPaymentsError(endpoint, create_order_response.get('Message') or 'order was not created')
 
-    async def check_order(self, order: Order) -> Order:
-        """Метод для разовой проверки платежа. Подходит для финальной сверки, в режиме хуков избыточен"""
+    async def find_transaction(self, order: Order) -> Transaction | None:
+        """Метод для разового запроса транзакции по заказу. Если по заказу ничего не происходило, отдает None.
+        На нем работает PollingScheduler: планировщик сам решает, когда и сколько раз проверять заказ"""
         endpoint = 'payments/find'
         params = {'InvoiceId': order.number}
 
         # Делаем запрос
         checking_order_response = await self._send_request(endpoint, params)
-        logger.debug(f"One order check {checking_order_response}")
+        _find_log.debug("Order check {}", checking_order_response)
 
         # Если есть Model, значит по платежу началась суета
         if 'Model' in checking_order_response:
-            transaction = Transaction.from_dict(checking_order_response['Model'])
+            return Transaction.from_dict(checking_order_response['Model'])
+        return None
+
+    async def list_payments(self, created_from: datetime.datetime, created_to: datetime.datetime,
+                            page_number: int = 1) -> list[dict]:
+        """Одна страница транзакций, созданных в интервале [created_from, created_to] (v2/payments/list).
+        Отдает транзакции как есть, без разбора в модели. Пустая страница — транзакции кончились"""
+        endpoint = 'v2/payments/list'
+        params = {
+            'CreatedDateGte': created_from.isoformat(),
+            'CreatedDateLte': created_to.isoformat(),
+            'PageNumber': page_number,
+            'TimeZone': 'UTC',
+        }
+        response = await self._send_request(endpoint, params)
+        if not response.get('Success'):
+            raise CloudPaymentsError(endpoint, response.get('Message') or 'payments were not listed')
+        return response.get('Model') or []
+
+    async def check_order(self, order: Order) -> Order:
+        """Метод для разовой проверки платежа. Подходит для финальной сверки, в режиме хуков избыточен"""
+        transaction = await self.find_transaction(order)
+        if transaction is not None:
             return self.update_order(transaction.status_code, order)
         else:
-            logger.info(f"Check order status {order.id}: {order.status_code}. Nothing changed")
+            logger.info("Check order status {}: {}. Nothing changed", order.id, order.status_code)
             return order
 
-    async def check_order_polling(self, order: Order) -> Order:
-        """Метод для проверки платежа в формате polling:
-        раз в несколько секунд, какое-то количество раз (в зависимости от настроек).
-        Подходит, когда нет возможности работать с хуками и нужно проверять все руками."""
-        endpoint = 'payments/find'
-        params = {'InvoiceId': order.number}
-
-        # Проверяем платеж раз в DELAY секунд MAX_ATTEMPTS раз
-        for attempt in range(settings.max_attempts):
-            if attempt == (settings.max_attempts - 1):
-                return self.update_order(StatusCode.max_attempts.value, order)
-
-            # Делаем запрос
-            checking_order_response = await self._send_request(endpoint, params)
-            logger.debug(f"Multiple verification for polling: {checking_order_response}")
-
-            # Если в запросе есть Model, то началась суета по платежу, можно чекать
-            if 'Model' in checking_order_response:
-                transaction = Transaction.from_dict(checking_order_response['Model'])
-                if transaction.status == 'Authorized' or transaction.status == 'Declined':
-                    return self.update_order(transaction.status_code, order)
-                elif transaction.status == 'AwaitingAuthentication':
-                    order = self.update_order(transaction.status_code, order)
-
-            # Делаем паузу между запросами проверки для polling
-            await asyncio.sleep(settings.delay)
-
     async def cancel_payment(self, order: Order) -> Order:
         """Метод для ручного удаления платежа. Можно удалить платеж после окончания
         попыток проверки в polling-режиме, чтобы точно не пропустить платеж."""
@@ -99,7 +321,7 @@ class CloudPayments:
         params = {"Id": order.id}
 
         response = await self._send_request(endpoint, params)
-        logger.info(f"Deleting order {order.number}. Response: {response}")
+        logger.info("Deleting order {}. Response: {}", order.number, response)
         order.status_code = StatusCode.cancel.value
 
         return order
@@ -111,16 +333,14 @@ class CloudPayments:
         Выглядит, как затуп: непонятно, почему он получился статический
         и нахрена передавать инстанс, если есть self"""
         order.status_code = status_code
-        logger.info(f"Update order {order.number}. Status: {order.status_code}")
+        logger.info("Update order {}. Status: {}", order.number, order.status_code)
         return order
 
-    async def create_receipt_url(self, customer_receipt: Receipt) -> str:
+    async def create_receipt_url(self, customer_receipt: Receipt) -> str | None:
         """Метод для получения чека.
         Пока простой, только на оплату, не на возврат или что-то еще"""
-        endpoint = 'kkt/receipt'
-
         customer_receipt = customer_receipt.to_dict()
-        logger.debug(f'CloudPayments get the receipt object: {customer_receipt}')
+        logger.debug("CloudPayments get the receipt object: {}", customer_receipt)
 
         params = {
             'Inn': settings.inn,
@@ -128,13 +348,99 @@ class CloudPayments:
             'Type': 'Income',
             'CustomerReceipt': customer_receipt,
         }
-        logger.debug(f'CloudPayments created parameters for '
-                     f'request of receipt: {params} ({type(params)})')
+        return await self.create_receipt(params)
 
-        create_receipt_response = await self._send_request(endpoint, params)
-        logger.debug(f"The response has been received: {json.dumps(create_receipt_response, indent=4)}")
+    async def create_receipt(self, params: dict, request_id: str | None = None) -> str | None:
+        """Создает чек по готовым параметрам запроса kkt/receipt и отдает ссылку на него.
+        Если CloudPayments отказал, отдает None"""
+        endpoint = 'kkt/receipt'
+        create_receipt_response = await self._send_request(endpoint, params, request_id=request_id)
+        logger.debug("The response has been received: {}", create_receipt_response)
         if create_receipt_response['Success']:
-            logger.debug(type(create_receipt_response['Model']['Id']))
             receipt_url = 'https://receipts.ru/' + str(create_receipt_response['Model']['Id'])
-            logger.info(f'The receipt was received: {receipt_url}')
+            logger.info("The receipt was received: {}", receipt_url)
             return receipt_url
+        logger.warning("The receipt was not created: {}", create_receipt_response.get('Message'))
+        return None
+
+
+class PollingPolicy:
+    """Политика polling-проверок: решает, через сколько секунд проверять заказ в следующий раз.
+    first_delay() — задержка перед первой проверкой после create_order_link()
+    next_delay() — задержка после очередной проверки. None значит, что ждать больше нечего (статус max_attempts)"""
+
+    def first_delay(self) -> float:
+        raise NotImplementedError
+
+    def next_delay(self, attempt: int, age: float, status: str | None) -> float | None:
+        """attempt — сколько проверок уже сделали, age — сколько секунд заказу,
+        status — последний статус транзакции из CloudPayments (или None, если транзакции еще нет)"""
+        raise NotImplementedError
+
+
+class FixedPollingPolicy(PollingPolicy):
+    """Старое поведение: проверка раз в delay секунд, не больше max_attempts раз"""
+
+    def __init__(self, delay: float = settings.delay, max_attempts: int = settings.max_attempts):
+        """Метод инициализации"""
+        self.delay = delay
+        self.max_attempts = max_attempts
+
+    def first_delay(self) -> float:
+        return self.delay
+
+    def next_delay(self, attempt: int, age: float, status: str | None) -> float | None:
+        if attempt >= self.max_attempts - 1:
+            return None
+        return self.delay
+
+
+class AdaptivePollingPolicy(PollingPolicy):
+    """Адаптивная политика. Сразу после создания заказа проверяем часто, потом интервал растет
+    экспоненциально до max_delay. К интервалу добавляется джиттер, чтобы заказы, созданные одновременно,
+    не проверялись пачкой. Когда платеж перешел в AwaitingAuthentication, пользователь прямо сейчас
+    проходит 3-D Secure, поэтому снова проверяем часто. Заказ старше max_age больше не проверяем."""
+
+    def __init__(self, initial_delay: float = settings.poll_initial_delay,
+                 factor: float = settings.poll_backoff_factor,
+                 max_delay: float = settings.poll_max_delay,
+                 jitter: float = settings.poll_jitter,
+                 auth_delay: float = settings.poll_auth_delay,
+                 max_age: float = settings.poll_max_age):
+        """Метод инициализации"""
+        self.initial_delay = initial_delay
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.auth_delay = auth_delay
+        self.max_age = max_age
+
+    def _with_jitter(self, delay: float) -> float:
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def first_delay(self) -> float:
+        return self._with_jitter(self.initial_delay)
+
+    def next_delay(self, attempt: int, age: float, status: str | None) -> float | None:
+        left = self.max_age - age
+        if left <= 0:
+            return None
+
+        if status == TransactionStatus.awaiting_authentication:
+            delay = self.auth_delay
+        else:
+            delay = min(self.max_delay, self.initial_delay * self.factor ** attempt)
+
+        # Последнюю проверку делаем ровно на границе max_age, а не после нее
+        return min(self._with_jitter(delay), left)
+
+
+def get_polling_policy(name: str = settings.polling_policy) -> PollingPolicy:
+    """Отдает политику polling-проверок по имени из настроек"""
+    policies = {
+        'fixed': FixedPollingPolicy,
+        'adaptive': AdaptivePollingPolicy,
+    }
+    if name not in policies:
+        raise ValueError(f"Unknown polling policy: {name}. Available: {', '.join(policies)}")
+    return policies[name]()
@@ -1,28 +1,202 @@
+import decimal
 import enum
+from urllib.parse import unquote_plus
+
+
+class ModelParseError(ValueError):
+    """Данные CloudPayments не разбираются в модель: нет обязательного поля или значение не того типа"""
+
+    def __init__(self, model: str, key: str, message: str):
+        """Метод инициализации"""
+        super().__init__(f'{model}.{key}: {message}')
+        self.model = model
+        self.key = key
+
+
+def _decimal(value) -> decimal.Decimal:
+    """Сумма в Decimal. float из JSON переводим через строку, чтобы не тащить двоичную погрешность"""
+    if isinstance(value, decimal.Decimal):
+        return value
+    if isinstance(value, float):
+        value = repr(value)
+    result = decimal.Decimal(value)
+    if not result.is_finite():
+        raise ValueError('amount must be finite')
+    return result
+
+
+def _enum_or_raw(enum_cls, convert=None):
+    """Значение как член enum_cls, а неизвестное CloudPayments значение — как есть (после convert).
+    Новые статусы на стороне CloudPayments не должны ронять разбор платежа"""
+    members = {member.value: member for member in enum_cls}
+
+    def parse(value):
+        if convert is not None:
+            value = convert(value)
+        return members.get(value, value)
+
+    return parse
+
+
+def _bool(value) -> bool:
+    """Флаг из JSON (true/false) или из формы хука ('true'/'false', '1'/'0')"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in ('true', '1', 'false', '0'):
+        return value.lower() in ('true', '1')
+    raise ValueError(f'not a boolean: {value!r}')
 
 
 class Model(object):
-    """Класс для объектов CLoudPayments"""
+    """Класс для объектов CLoudPayments. Модели без __dict__: поля лежат в __slots__, так что заказы,
+    которые ждут проверки, занимают меньше памяти, а разбор ответа CloudPayments — один проход по fields.
+
+    fields — описание полей: (атрибут, ключ CloudPayments, преобразование или None, обязательное ли поле).
+    Порядок fields совпадает с порядком аргументов __init__"""
+
+    __slots__ = ()
+    fields: tuple = ()
+    field_keys: frozenset = frozenset()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.field_keys = frozenset(key for _, key, _, _ in cls.fields)
 
     @classmethod
     def from_dict(cls, model_dict):
-        raise NotImplementedError
+        """Создает инстанс из словаря CloudPayments: ответа API в JSON или полей хука.
+        Лишние ключи игнорируются, отсутствующее обязательное поле или кривое значение — ModelParseError"""
+        values = []
+        for attr, key, parse, required in cls.fields:
+            value = model_dict.get(key)
+            # Пустая строка — пустое поле формы. Сравниваем только строки: Decimal == '' стоит почти микросекунду
+            if value is None or (type(value) is str and not value):
+                if required:
+                    raise ModelParseError(cls.__name__, key, 'is missing')
+                values.append(None)
+                continue
+            if parse is not None:
+                try:
+                    value = parse(value)
+                except (ValueError, TypeError, ArithmeticError) as e:
+                    raise ModelParseError(cls.__name__, key, f'invalid value {value!r}: {e}') from e
+            values.append(value)
+        return cls(*values)
+
+    @classmethod
+    def from_form(cls, body: bytes | str, **extra):
+        """Создает инстанс из тела хука CloudPayments (application/x-www-form-urlencoded).
+        Если ключ повторяется, берется последнее значение. extra дополняет или заменяет поля формы"""
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        # Хук CloudPayments несет десятки полей, а модели нужны единицы: декодируем только их
+        keys = cls.field_keys
+        model_dict = {}
+        for pair in body.split('&'):
+            key, _, value = pair.partition('=')
+            if '%' in key or '+' in key:
+                key = unquote_plus(key)
+            if key in keys:
+                model_dict[key] = unquote_plus(value)
+        model_dict.update(extra)
+        return cls.from_dict(model_dict)
+
+    def _serialize(self) -> dict:
+        result = {}
+        for attr, key, _, _ in self.fields:
+            value = getattr(self, attr)
+            if isinstance(value, Model):
+                value = value.to_dict()
+            elif isinstance(value, list):
+                value = [item.to_dict() if isinstance(item, Model) else item for item in value]
+            result[key] = value
+        return result
+
+    def to_dict(self) -> dict:
+        """Преобразует атрибуты инстанса в словарь с ключами CloudPayments"""
+        return self._serialize()
 
     def __repr__(self):
-        state = ['%s=%s' % (k, repr(v)) for (k, v) in vars(self).items()]
+        state = ['%s=%r' % (name, getattr(self, name, None))
+                 for cls in reversed(type(self).__mro__)
+                 for name in cls.__dict__.get('__slots__', ()) if not name.startswith('_')]
         return '%s(%s)' % (self.__class__.__name__, ', '.join(state))
 
 
+class ValueModel(Model):
+    """Модель-значение: после создания не меняется, поэтому to_dict() собирается один раз.
+    Отданный словарь общий для всех вызовов, менять его нельзя — только копировать"""
+
+    __slots__ = ('_dict',)
+
+    def to_dict(self) -> dict:
+        try:
+            return self._dict
+        except AttributeError:
+            self._dict = self._serialize()
+            return self._dict
+
+
+class StatusCode(enum.IntEnum):
+    """Класс статус-кодов, чтобы передавать их в более явном виде.
+    IntEnum: члены равны своим числам, так что их можно сравнивать и писать в бд как int"""
+
+    # Наши кастомные коды для полинга
+    cancel: int = -1  # Платеж отменен с нашей стороны
+    max_attempts: int = -2  # Бот потратил попытки для опроса платежа: delay * max_attempts в config.settings
+    declined: int = -3  # Попытка оплаты отклонена, но заказ открыт: его еще можно оплатить по той же ссылке
+
+    # Коды CloudPayments
+    wait: int = 1  # В платеж перешли и ввели карту, но не подтвердили
+    ok: int = 2  # Платеж прошел успешно
+    error: int = 5  # Платеж явно отклонен CloudPayments
+
+    def __str__(self):
+        return str(self.value)
+
+
+class TransactionStatus(str, enum.Enum):
+    """Статусы транзакции CloudPayments (поле Status). Члены равны своим строкам"""
+
+    created = 'Created'
+    pending = 'Pending'
+    awaiting_authentication = 'AwaitingAuthentication'
+    authorized = 'Authorized'
+    completed = 'Completed'
+    cancelled = 'Cancelled'
+    declined = 'Declined'
+
+    def __str__(self):
+        return self.value
+
+
+_status_code = _enum_or_raw(StatusCode, convert=int)
+
+
 class Order(Model):
     """Класс заказа. Используется для:
     формирования заказа на стороне клиента, создания заказа в CloudPayments,
     синхронизации данных транзакции в CloudPayments с заказом на нашей стороне и в БД.
     Заполняется из словаря с помощью метода from_dict()"""
 
+    __slots__ = ('id', 'number', 'amount', 'currency', 'email', 'description', 'require_confirmation',
+                 'url', 'status_code', 'created', 'receipt_url')
+    fields = (
+        ('id', 'Id', str, True),
+        ('number', 'Number', int, True),
+        ('amount', 'Amount', _decimal, True),
+        ('currency', 'Currency', str, True),
+        ('email', 'Email', None, False),
+        ('description', 'Description', str, False),
+        ('require_confirmation', 'RequireConfirmation', _bool, False),
+        ('url', 'Url', str, True),
+        ('status_code', 'StatusCode', _status_code, False),
+        ('created', 'CreatedDateIso', None, False),
+    )
+
     def __init__(self, id, number, amount, currency, email,
                  description, require_confirmation, url, status_code, created, receipt_url=None):
         """Метод инициализации"""
-        super(Order, self).__init__()
         self.id = id
         self.number = number
         self.amount = amount
@@ -35,30 +209,26 @@ class Order(Model):
         self.created = created
         self.receipt_url = receipt_url
 
-    @classmethod
-    def from_dict(cls, order_dict):
-        """Преобразует элементы словаря, который передает CloudPayments в атрибуты инстанса"""
-        return cls(order_dict['Id'],
-                   order_dict['Number'],
-                   order_dict['Amount'],
-                   order_dict['Currency'],
-                   order_dict['Email'],
-                   order_dict['Description'],
-                   order_dict['RequireConfirmation'],
-                   order_dict['Url'],
-                   order_dict['StatusCode'],
-                   order_dict['CreatedDateIso'])
-
 
 class Transaction(Model):
     """Класс транзацкции. Используется для получения обновлений о нашем заказе в CloudPayments.
     Когда пользователь ввел карту, заказ на стороне CloudPayments становится транзакцией.
-    Заполняется из словаря с помощью метода from_dict()"""
+    Заполняется из ответа payments/find методом from_dict() или из тела хука методом from_form()"""
+
+    __slots__ = ('transaction_id', 'invoice_id', 'amount', 'currency', 'description', 'status_code', 'status')
+    fields = (
+        ('transaction_id', 'TransactionId', int, True),
+        ('invoice_id', 'InvoiceId', int, True),
+        ('amount', 'Amount', _decimal, True),
+        ('currency', 'Currency', str, True),
+        ('description', 'Description', str, False),
+        ('status_code', 'StatusCode', _status_code, True),
+        ('status', 'Status', _enum_or_raw(TransactionStatus), False),
+    )
 
     def __init__(self, transaction_id, invoice_id, amount, currency,
                  description, status_code, status):
         """Метод инициализации"""
-        super(Transaction, self).__init__()
         self.transaction_id = transaction_id
         self.invoice_id = invoice_id
         self.amount = amount
@@ -67,36 +237,55 @@ class Transaction(Model):
         self.status_code = status_code
         self.status = status
 
-    @classmethod
-    def from_dict(cls, order_dict):
-        """Преобразует элементы словаря, который передает CloudPayments в атрибуты инстанса"""
 
-        return cls(order_dict['TransactionId'],
-                   order_dict['InvoiceId'],
-                   order_dict['Amount'],
-                   order_dict['Currency'],
-                   order_dict['Description'],
-                   order_dict['StatusCode'],
-                   order_dict['Status'])
+# Итоговые статусы: после них заказ больше не проверяем
+TERMINAL_STATUS_CODES = (StatusCode.ok.value, StatusCode.error.value,
+                         StatusCode.cancel.value, StatusCode.max_attempts.value)
 
+# Порядок статусов: статус заказа может меняться только вперед. Успешная оплата важнее всего:
+# после отклоненной попытки (declined, заказ остается открытым) пользователь может оплатить заказ еще раз,
+# а после нашей отмены все равно может прийти оплата. Статусы, которых нет в словаре
+# (например, только что созданный заказ), считаем самыми ранними
+STATUS_RANK = {
+    StatusCode.wait.value: 1,
+    StatusCode.declined.value: 2,
+    StatusCode.cancel.value: 3,
+    StatusCode.max_attempts.value: 3,
+    StatusCode.error.value: 3,
+    StatusCode.ok.value: 4,
+}
 
-class StatusCode(enum.Enum):
-    """Класс статус-кодов, чтобы передавать их в более явном виде"""
 
-    # Наши кастомные коды для полинга
-    cancel: int = -1  # Платеж отменен с нашей стороны
-    max_attempts: int = -2  # Бот потратил попытки для опроса платежа: delay * max_attempts в config.settings
+# Статус заказа по статусу транзакции CloudPayments: так его видят сверка (payments/list) и поллер (payments/find).
+# Отклоненная транзакция не закрывает заказ: его еще можно оплатить, а закроет его поллер по max_attempts.
+# Created и Pending ничего не говорят об исходе платежа, их в словаре нет
+TRANSACTION_STATUS_CODES = {
+    TransactionStatus.awaiting_authentication: StatusCode.wait.value,
+    TransactionStatus.authorized: StatusCode.ok.value,
+    TransactionStatus.completed: StatusCode.ok.value,
+    TransactionStatus.cancelled: StatusCode.cancel.value,
+    TransactionStatus.declined: StatusCode.declined.value,
+}
 
-    # Коды CloudPayments
-    wait: int = 1  # В платеж перешли и ввели карту, но не подтвердили
-    ok: int = 2  # Платеж прошел успешно
-    error: int = 5  # Платеж явно отклонен CloudPayments
+
+def status_codes_not_before(status_code: int) -> tuple:
+    """Статусы, из которых в status_code перейти нельзя: такие же или более поздние"""
+    rank = STATUS_RANK.get(status_code, 0)
+    return tuple(code for code, code_rank in STATUS_RANK.items() if code_rank >= rank)
 
 
-class Receipt(Model):
+class Receipt(ValueModel):
     """Объект чека. Содержит важные поля для создания чека на стороне CloudPayments.
     Преобразуется в словарь с помощью метода to_dict()"""
 
+    __slots__ = ('items', 'taxation_system', 'email', 'phone', 'amounts')
+    fields = (
+        ('items', 'items', None, True),
+        ('taxation_system', 'taxationSystem', None, True),
+        ('email', 'email', None, False),
+        ('phone', 'phone', None, False),
+    )
+
     def __init__(self, items: list, taxation_system: str, email: str = '', phone: str = '', amounts: dict = None):
         """Метод инициализации"""
         self.items = items
@@ -105,22 +294,25 @@ class Receipt(Model):
         self.phone = phone
         self.amounts = amounts
 
-    def to_dict(self):
-        """Преобразует атрибуты инстанса в словарь для отправки в CloudPayments"""
-        items = [item.to_dict() for item in self.items]
-        result = {
-            'items': items,
-            'taxationSystem': self.taxation_system,
-            'email': self.email,
-            'phone': self.phone,
-        }
-        return result
-
 
 # Модель для позиций в чеке
-class ReceiptItem(Model):
+class ReceiptItem(ValueModel):
     """Объект одной позиции в чеке. Для CloudPayments каждую позицию нужно подробно расписывать."""
 
+    __slots__ = ('label', 'price', 'quantity', 'amount', 'vat', 'ean13', 'method', 'item_object',
+                 'measurement_unit')
+    fields = (
+        ('label', 'label', None, True),
+        ('price', 'price', None, True),
+        ('quantity', 'quantity', None, True),
+        ('amount', 'amount', None, True),
+        ('vat', 'vat', None, False),
+        ('ean13', 'ean13', None, False),
+        ('method', 'method', None, False),
+        ('item_object', 'object', None, False),
+        ('measurement_unit', 'measurementUnit', None, False),
+    )
+
     def __init__(self, label, price, quantity, amount, vat, ean13=None,
                  method=0, item_object=0, measurement_unit=None):
         """Метод инициализации"""
@@ -133,17 +325,3 @@ class ReceiptItem(Model):
         self.method = method  # признак способа расчета
         self.item_object = item_object  # признак предмета товара (10 — Payment, платеж)
         self.measurement_unit = measurement_unit  # единица измерения
-
-    def to_dict(self):
-        """Преобразует атрибуты инстанса в словарь для отправки в CloudPayments"""
-        return {
-            'label': self.label,
-            'price': self.price,
-            'quantity': self.quantity,
-            'amount': self.amount,
-            'vat': self.vat,
-            'ean13': self.ean13,
-            'method': self.method,
-            'object': self.item_object,
-            'measurementUnit': self.measurement_unit
-        }
\ No newline at end of file
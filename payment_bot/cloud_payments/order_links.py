@@ -0,0 +1,53 @@
+import datetime
+from typing import Awaitable, Callable
+from loguru import logger
+from payment_bot.config import settings
+from payment_bot.cloud_payments.cloud_payments import CloudPayments
+from payment_bot.db_infra import db
+from payment_bot.db_infra.cache import SingleFlight
+
+
+class OrderLinks:
+    """Выдача ссылок на оплату: у юзера одна открытая ссылка на одну и ту же сумму. Методы:
+    get_or_create() — отдает открытый заказ юзера, а если его нет, создает заказ в CloudPayments и в бд.
+                      Одновременные запросы одного юзера ждут один и тот же заказ (single-flight)
+    stats() — сколько заказов создано, сколько выдано повторно и сколько запросов склеено
+
+    on_created(order) вызывается для каждого нового заказа, например чтобы поставить его в polling-расписание"""
+
+    def __init__(self, client: CloudPayments,
+                 on_created: Callable[[object], Awaitable] | None = None,
+                 reuse_ttl: float = settings.order_reuse_ttl):
+        """Метод инициализации"""
+        self.client = client
+        self.on_created = on_created
+        self.reuse_ttl = reuse_ttl
+        self._flights = SingleFlight()
+        self.created = 0
+        self.reused = 0
+
+    async def get_or_create(self, user_id, amount, currency: str):
+        """Заказ, ссылку которого нужно отдать юзеру. Новый заказ уже лежит в бд"""
+        return await self._flights.do((user_id, str(amount), currency),
+                                      lambda: self._get_or_create(user_id, amount, currency))
+
+    async def _get_or_create(self, user_id, amount, currency: str):
+        if self.reuse_ttl > 0:
+            created_after = db.utc_now() - datetime.timedelta(seconds=self.reuse_ttl)
+            order = await db.get_open_order(user_id, amount, currency, created_after)
+            if order is not None:
+                self.reused += 1
+                logger.debug("Reuse open order {} of {}", order.number, user_id)
+                return order
+
+        order = await self.client.create_order_link(amount, currency, user_id)
+        await db.add_order(order)
+        self.created += 1
+        if self.on_created is not None:
+            await self.on_created(order)
+        return order
+
+    def stats(self) -> dict:
+        flights = self._flights.stats()
+        return {'created': self.created, 'reused': self.reused,
+                'inflight': flights['inflight'], 'coalesced': flights['coalesced']}
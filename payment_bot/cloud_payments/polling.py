@@ -0,0 +1,327 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import random
+import time
+from typing import Awaitable, Callable
+from loguru import logger
+from payment_bot.config import settings
+from payment_bot.logs import SampledLogger
+from payment_bot.cloud_payments.cloud_payments import (CloudPayments, CircuitOpenError, PollingPolicy,
+                                                        get_polling_policy)
+from payment_bot.cloud_payments.models import Order, StatusCode, TERMINAL_STATUS_CODES, TRANSACTION_STATUS_CODES
+from payment_bot.db_infra import db
+from payment_bot.rate_limit import TokenBucket
+
+# Проверок тысячи в секунду: в лог попадает только часть
+_check_log = SampledLogger()
+
+
+def _to_datetime(timestamp: float) -> datetime.datetime:
+    """Время из кучи планировщика в datetime с часовым поясом, как в колонках Orders"""
+    return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+
+
+class PollingTask:
+    """Запись планировщика: заказ, сколько раз его уже проверили, когда проверять в следующий раз,
+    когда заказ поставили в расписание, последний статус транзакции и сколько проверок подряд упало"""
+
+    def __init__(self, order: Order, next_check_at: float, attempt: int = 0,
+                 created_at: float | None = None, status: str | None = None):
+        """Метод инициализации"""
+        self.order = order
+        self.next_check_at = next_check_at
+        self.attempt = attempt
+        self.created_at = created_at if created_at is not None else time.time()
+        self.status = status
+        self.failures = 0
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.created_at
+
+    def __repr__(self):
+        return f'PollingTask(number={self.order.number}, attempt={self.attempt}, next_check_at={self.next_check_at})'
+
+
+class PollingScheduler:
+    """Центральный планировщик polling-проверок. Вместо отдельной спящей корутины на каждый заказ
+    все ожидающие заказы лежат в одной куче, отсортированной по времени следующей проверки.
+    Методы:
+    add() — ставит заказ на проверку и сразу возвращает управление
+    discard() — снимает заказ с проверки
+    claim() — забирает в аренду из БД заказы, которые пора проверять
+    start() и stop() — запускают и останавливают диспетчер и пул воркеров
+    stats() — сколько заказов ждут проверки и глубина очереди к воркерам
+
+    Диспетчер достает из кучи заказы, у которых подошло время, пропускает их через общий лимит
+    запросов в секунду и отдает воркерам. Когда проверять заказ дальше, решает PollingPolicy.
+    Когда по заказу есть итоговый статус, воркер вызывает on_finished(order).
+    Пока circuit breaker клиента разомкнут, диспетчер ставит проверки на паузу.
+
+    Если persistent=True, расписание (время следующей проверки, число попыток, последний статус)
+    хранится в таблице Orders, и после рестарта проверки продолжаются с того же места.
+    Каждый заказ в памяти поллер держит в аренде (lease_owner, lease_expires) и продлевает ее при каждой проверке.
+    Раз в lease_claim_interval поллер забирает свободные заказы, которые пора проверять, через
+    FOR UPDATE SKIP LOCKED. Так несколько процессов делят заказы между собой, а заказы упавшего процесса
+    подхватываются, когда истекает аренда. При distributed=True новые заказы не закрепляются за
+    создавшим их процессом и сразу попадают в общий пул."""
+
+    def __init__(self, client: CloudPayments, on_finished: Callable[[Order], Awaitable[None]],
+                 workers: int = settings.polling_workers, rps: float = settings.polling_rps,
+                 policy: PollingPolicy | None = None, persistent: bool = True,
+                 owner: str = settings.poller_id, distributed: bool = settings.polling_distributed):
+        """Метод инициализации. Если политика не передана, берем ее из настроек"""
+        self.client = client
+        self.persistent = persistent
+        self.owner = owner
+        self.distributed = distributed and persistent
+        self.on_finished = on_finished
+        self.policy = policy or get_polling_policy()
+        self.workers = workers
+        self._limiter = TokenBucket(rps)
+        # Куча из (время проверки, порядковый номер, задача) и актуальные задачи по номеру заказа
+        self._heap: list[tuple[float, int, PollingTask]] = []
+        self._tasks: dict[str, PollingTask] = {}
+        self._seq = itertools.count()
+        self._queue: asyncio.Queue[PollingTask] = asyncio.Queue(maxsize=workers)
+        self._wakeup = asyncio.Event()
+        # Диспетчер и разборщик аренды отдельно от воркеров: при остановке их гасим первыми
+        self._background: list[asyncio.Task] = []
+        self._workers: list[asyncio.Task] = []
+
+    def __len__(self):
+        """Сколько заказов сейчас ждут проверки"""
+        return len(self._tasks)
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._tasks),
+            'heap': len(self._heap),
+            'queue_depth': self._queue.qsize(),
+            'workers': len(self._workers),
+        }
+
+    async def add(self, order: Order, delay: float | None = None) -> None:
+        """Ставит заказ в расписание. Первая проверка будет через delay секунд, по умолчанию — по политике"""
+        if delay is None:
+            delay = self.policy.first_delay()
+        task = PollingTask(order, time.time() + delay)
+
+        if self.distributed:
+            # Заказ заберет тот поллер, который первым до него доберется
+            await db.schedule_order(order.number, _to_datetime(task.next_check_at))
+            logger.debug("Order {} scheduled for polling by any poller: {}", order.number, task)
+            return
+
+        self._tasks[str(order.number)] = task
+        self._push(task)
+        if self.persistent:
+            await db.schedule_order(order.number, _to_datetime(task.next_check_at),
+                                    owner=self.owner)
+        logger.debug("Order {} scheduled for polling: {}", order.number, task)
+
+    async def claim(self) -> int:
+        """Забирает в аренду заказы, которые пора проверять: новые, оставшиеся после рестарта
+        и брошенные упавшими поллерами. Просроченные проверки размазываем по окну resume_spread,
+        чтобы не ударить по CloudPayments разом"""
+        if not self.persistent:
+            return 0
+
+        now = time.time()
+        horizon = _to_datetime(now + 2 * settings.lease_claim_interval)
+        # Забираем не больше, чем успеем проверить за интервал при своем лимите запросов,
+        # чтобы остальное досталось другим поллерам
+        limit = min(settings.lease_batch, max(1, int(self._limiter.rate * settings.lease_claim_interval)))
+        orders = await db.claim_due_orders(self.owner, horizon, limit)
+        for order in orders:
+            next_check_at = order.next_check_at.timestamp()
+            if next_check_at < now:
+                next_check_at = now + random.uniform(0, settings.resume_spread)
+            task = PollingTask(order, next_check_at, attempt=order.poll_attempts,
+                               created_at=order.created.timestamp(), status=order.poll_status)
+            self._tasks[str(order.number)] = task
+            self._push(task)
+
+        if orders:
+            logger.info("Poller {} claimed {} orders", self.owner, len(orders))
+        return len(orders)
+
+    async def _claim_loop(self) -> None:
+        """Периодически разбирает свободные заказы"""
+        while True:
+            try:
+                await self.claim()
+            except Exception as e:
+                logger.error("Claiming orders failed: {}", e)
+            await asyncio.sleep(settings.lease_claim_interval)
+
+    def discard(self, number) -> None:
+        """Снимает заказ с проверки. Запись в куче удалится лениво, когда до нее дойдет очередь"""
+        self._tasks.pop(str(number), None)
+
+    def _push(self, task: PollingTask) -> None:
+        heapq.heappush(self._heap, (task.next_check_at, next(self._seq), task))
+        self._wakeup.set()
+
+    def _is_actual(self, check_at: float, task: PollingTask) -> bool:
+        """Запись в куче актуальна, если заказ все еще в расписании и его не перепланировали"""
+        return self._tasks.get(str(task.order.number)) is task and task.next_check_at == check_at
+
+    async def start(self) -> None:
+        """Запускает диспетчер, пул воркеров и разбор аренды заказов из БД"""
+        if self._background:
+            return
+        self._background.append(asyncio.create_task(self._dispatch()))
+        if self.persistent:
+            self._background.append(asyncio.create_task(self._claim_loop()))
+        for _ in range(self.workers):
+            self._workers.append(asyncio.create_task(self._work()))
+        logger.info("Polling scheduler {} started with {} workers", self.owner, self.workers)
+
+    async def stop(self) -> None:
+        """Останавливает диспетчер и воркеры. Заказы, которые не успели проверить, остаются в БД до следующего старта.
+        Проверки, которые уже отданы воркерам, даем доделать, чтобы не оборвать запрос к БД посередине"""
+        if not self._background:
+            return
+        for runner in self._background:
+            runner.cancel()
+        await asyncio.gather(*self._background, return_exceptions=True)
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=settings.shutdown_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Polling workers did not finish in {}s, cancelling", settings.shutdown_timeout)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._background, self._workers = [], []
+        logger.info("Polling scheduler stopped. Orders left unchecked: {}", len(self))
+
+    async def _dispatch(self) -> None:
+        """Достает из кучи заказы, у которых подошло время проверки, и отдает их воркерам"""
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            check_at, _, task = self._heap[0]
+            if not self._is_actual(check_at, task):
+                heapq.heappop(self._heap)
+                continue
+
+            wait = check_at - time.time()
+            if wait > 0:
+                # Ждем до ближайшей проверки или до появления более раннего заказа
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # CloudPayments недоступен: не тратим проверки, пока breaker не пропустит запрос
+            pause = self.client.breaker.retry_after()
+            if pause > 0:
+                logger.warning("CloudPayments is unavailable, polling paused for {:.1f}s", pause)
+                await asyncio.sleep(pause)
+                continue
+
+            heapq.heappop(self._heap)
+            # Общий лимит запросов к CloudPayments на все заказы
+            await self._limiter.acquire()
+            await self._queue.put(task)
+
+    async def _work(self) -> None:
+        """Воркер: проверяет заказ и либо перепланирует его, либо отдает итоговый статус"""
+        while True:
+            task = await self._queue.get()
+            try:
+                await self._check(task)
+                task.failures = 0
+            except Exception as e:
+                task.failures += 1
+                logger.error("Polling check of order {} failed ({} in a row): {}", task.order.number, task.failures, e)
+                await self._retry(task)
+            finally:
+                self._queue.task_done()
+
+    async def _retry(self, task: PollingTask) -> None:
+        """Перепланирует упавшую проверку. Если время по политике вышло или проверки падают раз за разом
+        (settings.poll_max_failures), заказ закрывается со статусом max_attempts"""
+        delay = self.policy.next_delay(task.attempt, task.age, task.status)
+        if delay is not None and task.failures < settings.poll_max_failures:
+            return await self._reschedule(task, delay)
+        if self._tasks.get(str(task.order.number)) is not task:
+            return
+        try:
+            await self._finish(task, StatusCode.max_attempts.value)
+        except Exception as e:
+            # Заказ остается в аренде: когда она истечет, его заберет и проверит поллер
+            self.discard(task.order.number)
+            logger.error("Giving up polling order {} failed: {}", task.order.number, e)
+
+    async def _check(self, task: PollingTask) -> None:
+        """Одна проверка заказа. Статус транзакции переводим в статус заказа по models.TRANSACTION_STATUS_CODES:
+        итоговый (TERMINAL_STATUS_CODES) завершает проверки, AwaitingAuthentication — обновляем заказ и ждем дальше.
+        Следующую проверку назначает политика"""
+        # Заказ могли снять с проверки, пока он ждал воркера
+        if self._tasks.get(str(task.order.number)) is not task:
+            return
+
+        task.attempt += 1
+        try:
+            transaction = await self.client.find_transaction(task.order)
+        except CircuitOpenError as e:
+            # Запрос даже не ушел в CloudPayments: проверку не засчитываем, повторим, когда breaker пропустит
+            task.attempt -= 1
+            return await self._reschedule(task, max(e.retry_after, 1.0))
+        _check_log.debug("Polling check of order {}, attempt {}: {}", task.order.number, task.attempt, transaction)
+
+        if transaction is not None:
+            status_code = TRANSACTION_STATUS_CODES.get(transaction.status)
+            if status_code in TERMINAL_STATUS_CODES:
+                return await self._finish(task, status_code)
+            elif status_code is not None:
+                task.order = self.client.update_order(status_code, task.order)
+            task.status = transaction.status
+
+        delay = self.policy.next_delay(task.attempt, task.age, task.status)
+        if delay is None:
+            return await self._finish(task, StatusCode.max_attempts.value)
+
+        await self._reschedule(task, delay)
+
+    async def _reschedule(self, task: PollingTask, delay: float) -> None:
+        if self._tasks.get(str(task.order.number)) is not task:
+            return
+        task.next_check_at = time.time() + delay
+        self._push(task)
+        if not self.persistent:
+            return
+        next_check_at = _to_datetime(task.next_check_at)
+        try:
+            leased = await db.save_poll_state(task.order.number, self.owner, next_check_at, task.attempt, task.status)
+        except Exception as e:
+            # Расписание в памяти уже обновлено, в БД догоним на следующей проверке
+            logger.error("Saving poll state of order {} failed: {}", task.order.number, e)
+        else:
+            if not leased:
+                # Аренда истекла, и заказ уже забрал другой поллер
+                logger.warning("Order {} lease was taken over by another poller", task.order.number)
+                self.discard(task.order.number)
+
+    async def _finish(self, task: PollingTask, status_code: int) -> None:
+        self.discard(task.order.number)
+        order = self.client.update_order(status_code, task.order)
+        try:
+            await self.on_finished(order)
+        except Exception:
+            # Итог не обработан: возвращаем заказ в расписание, воркер перепланирует проверку
+            self._tasks[str(order.number)] = task
+            raise
+        # Снимаем заказ с расписания в БД только после обработки итогового статуса:
+        # если процесс упадет раньше, после рестарта заказ проверят еще раз, а не потеряют
+        if self.persistent:
+            await db.save_poll_state(order.number, self.owner, None, task.attempt, task.status)
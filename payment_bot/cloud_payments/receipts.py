@@ -0,0 +1,181 @@
+import asyncio
+import random
+from typing import Awaitable, Callable
+from loguru import logger
+from payment_bot.config import Settings, settings
+from payment_bot.cloud_payments.cloud_payments import CloudPayments
+from payment_bot.cloud_payments.models import Order, Receipt, ReceiptItem
+from payment_bot.db_infra import db, write_behind
+
+
+class ReceiptTemplate:
+    """Заготовка запроса kkt/receipt. Все, что зависит только от настроек (ИНН, НДС, система налогообложения),
+    собирается один раз в __init__. render() подставляет в копию заготовки сумму и описание заказа"""
+
+    def __init__(self, config: Settings = settings):
+        """Метод инициализации"""
+        # TODO: Пока у нас один товар на одну оплату
+        #  Возможно, со временем понадобится расширять функциональность
+        item = ReceiptItem(label=None, price=None, quantity='1', amount=None,
+                           vat=config.vat, item_object='10')
+        receipt = Receipt(items=[item], taxation_system=config.tax_system)
+        # to_dict() отдает общий закэшированный словарь: берем копию без позиций
+        self._receipt = {key: value for key, value in receipt.to_dict().items() if key != 'items'}
+        self._item = item.to_dict()
+        self._params = {
+            'Inn': config.inn,
+            # Как раз здесь указываем вид операции — приход
+            'Type': 'Income',
+        }
+
+    def render(self, order: Order) -> dict:
+        """Параметры запроса kkt/receipt для заказа"""
+        amount = str(order.amount)
+        item = {**self._item, 'label': order.description, 'price': amount, 'amount': amount}
+        return {**self._params, 'CustomerReceipt': {**self._receipt, 'items': [item]}}
+
+
+class ReceiptPipeline:
+    """Создание чеков в фоне, отдельно от обработки платежа. Методы:
+    submit() — ставит заказ в очередь на чек. Если очередь полна, ждет в ней места
+    start() и stop() — запускают пул воркеров и останавливают его, дождавшись чеков из очереди (не дольше timeout)
+    stats() — очередь и счетчики созданных чеков, повторов, ошибок и чеков, добранных при старте
+
+    Когда чек готов, ссылка записывается в заказ (write_behind.save_order) и передается в on_ready().
+    Неудачные запросы повторяются с экспоненциальной задержкой. Все попытки одного заказа идут
+    с одним X-Request-ID, так что повтор после таймаута не создаст второй чек.
+
+    Очередь живет в памяти, а признак недоделанного чека — в бд: оплаченный заказ без receipt_url.
+    Поэтому start() в фоне ставит в очередь такие заказы, и чеки, не созданные до остановки, создаются
+    после рестарта. Повторный запрос с тем же X-Request-ID второй чек не создаст"""
+
+    def __init__(self, client: CloudPayments, on_ready: Callable[[Order], Awaitable],
+                 template: ReceiptTemplate | None = None,
+                 workers: int = settings.receipt_workers,
+                 queue_size: int = settings.receipt_queue_size,
+                 max_attempts: int = settings.receipt_max_attempts,
+                 retry_delay: float = settings.receipt_retry_delay,
+                 retry_max_delay: float = settings.receipt_retry_max_delay):
+        """Метод инициализации"""
+        self.client = client
+        self.on_ready = on_ready
+        self.template = template if template is not None else ReceiptTemplate()
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self._queue: asyncio.Queue[Order] = asyncio.Queue(maxsize=queue_size)
+        self._workers: list[asyncio.Task] = []
+        self._recovery: asyncio.Task | None = None
+        # Номера заказов в очереди и в работе: заказ, добранный при старте, не встанет в очередь второй раз
+        self._pending: set[str] = set()
+        self.created = 0
+        self.retries = 0
+        self.failed = 0
+        self.recovered = 0
+
+    async def submit(self, order: Order) -> None:
+        """Ставит заказ в очередь на чек. CloudPayments не ждет, но если очередь полна, ждет места в ней"""
+        key = str(order.number)
+        if key in self._pending:
+            return
+        self._pending.add(key)
+        try:
+            await self._queue.put(order)
+        except BaseException:
+            self._pending.discard(key)
+            raise
+
+    async def start(self) -> None:
+        """Запускает пул воркеров и в фоне ставит в очередь оплаченные заказы, которые остались без чека"""
+        if self._workers:
+            return
+        for _ in range(self.workers):
+            self._workers.append(asyncio.create_task(self._work()))
+        self._recovery = asyncio.create_task(self._recover())
+        logger.info("Receipt pipeline started with {} workers", self.workers)
+
+    async def stop(self, timeout: float = settings.shutdown_timeout) -> None:
+        """Дожидается чеков, которые уже в очереди (не дольше timeout), и останавливает воркеры.
+        Оставшиеся заказы так и останутся без receipt_url, их чеки создаст следующий запуск"""
+        if not self._workers:
+            return
+        if self._recovery is not None:
+            self._recovery.cancel()
+            await asyncio.gather(self._recovery, return_exceptions=True)
+            self._recovery = None
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Receipt queue was not drained in {}s, {} receipts left for the next start",
+                           timeout, len(self._pending))
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = asyncio.Queue(maxsize=self._queue.maxsize)
+        self._pending.clear()
+        logger.info("Receipt pipeline stopped. Created: {}, failed: {}", self.created, self.failed)
+
+    def stats(self) -> dict:
+        return {
+            'depth': self._queue.qsize(),
+            'created': self.created,
+            'retries': self.retries,
+            'failed': self.failed,
+            'recovered': self.recovered,
+        }
+
+    async def _recover(self) -> None:
+        """Ставит в очередь оплаченные заказы без ссылки на чек: их чеки не успели создать до остановки"""
+        try:
+            async for order in db.iter_orders_without_receipt():
+                if str(order.number) in self._pending:
+                    continue
+                await self.submit(order)
+                self.recovered += 1
+        except Exception as e:
+            logger.error("Recovery of unfinished receipts failed: {}", e)
+            return
+        if self.recovered:
+            logger.info("Receipt pipeline recovered {} unfinished receipts", self.recovered)
+
+    async def _work(self) -> None:
+        """Воркер: создает чеки для заказов из очереди"""
+        while True:
+            order = await self._queue.get()
+            try:
+                await self._process(order)
+            except Exception as e:
+                self.failed += 1
+                logger.error("Receipt for order {} failed: {}", order.number, e)
+            finally:
+                self._pending.discard(str(order.number))
+                self._queue.task_done()
+
+    async def _process(self, order: Order) -> None:
+        receipt_url = await self._create_receipt(order)
+        if receipt_url is None:
+            self.failed += 1
+            return
+        self.created += 1
+        order.receipt_url = receipt_url
+        await write_behind.save_order(order)
+        await self.on_ready(order)
+
+    async def _create_receipt(self, order: Order) -> str | None:
+        """Запрос kkt/receipt с повторами. Отказ CloudPayments (Success: false) не повторяем"""
+        params = self.template.render(order)
+        request_id = f'receipt-{order.id}'
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return await self.client.create_receipt(params, request_id=request_id)
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    raise
+                delay = min(self.retry_max_delay, self.retry_delay * 2 ** (attempt - 1))
+                delay *= random.uniform(0.5, 1.0)
+                self.retries += 1
+                logger.warning("Receipt for order {} failed, attempt {}: {}. Retry in {:.1f}s",
+                               order.number, attempt, e, delay)
+                await asyncio.sleep(delay)
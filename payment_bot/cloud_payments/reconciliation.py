@@ -0,0 +1,247 @@
+"""Сверка заказов с CloudPayments по выгрузке транзакций за интервал (v2/payments/list).
+
+Вместо запроса payments/find на каждый заказ транзакции читаются постранично, каждая страница сверяется
+с Orders одним запросом, а исправленные статусы пишутся пачками через db.bulk_update_orders().
+Итоговые статусы сверка забирает пачкой через db.claim_order_statuses() и обрабатывает так же, как бот
+(core.settle_claimed_order): уведомление юзеру, чек или отмена платежа. Поэтому без --dry-run
+поднимаются компоненты бота (core.build_lifecycle), и перед выходом они дорабатывают очереди.
+
+Пример:
+python -m payment_bot.cloud_payments.reconciliation --from 2024-01-01T00:00:00+00:00 --to 2024-01-02T00:00:00+00:00
+python -m payment_bot.cloud_payments.reconciliation --from 2024-01-01 --to 2024-01-02 --dry-run --report report.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+from types import SimpleNamespace
+from typing import Awaitable, Callable
+from loguru import logger
+from payment_bot import core
+from payment_bot.config import settings
+from payment_bot.lifecycle import Lifecycle, Step
+from payment_bot.logs import setup_logging
+from payment_bot.cloud_payments.cloud_payments import CloudPayments
+from payment_bot.cloud_payments.models import (ModelParseError, Transaction, STATUS_RANK, TERMINAL_STATUS_CODES,
+                                               TRANSACTION_STATUS_CODES, status_codes_not_before)
+from payment_bot.db_infra import db
+
+
+class ReconciliationReport:
+    """Итог сверки: сколько прочитано страниц и транзакций и какие расхождения нашлись.
+    updated — неитоговые статусы, которые исправлены (или были бы исправлены при dry_run)
+    settled — итоговые статусы, которые мы пропустили (например, потерялся хук): сверка их записала
+              и обработала заказ, как это сделал бы бот (или сделала бы при dry_run)
+    conflicts — в бд статус позже, чем в CloudPayments (или стал позже, пока шла сверка):
+                назад статус не двигаем, только сообщаем
+    unknown — транзакции по номерам, которых нет ни в Orders, ни в архиве
+    archived — заказы уже в архиве: их статус итоговый и сверка его не меняет
+    skipped — транзакции без InvoiceId или с кривыми полями"""
+
+    def __init__(self, created_from: datetime.datetime, created_to: datetime.datetime, dry_run: bool):
+        """Метод инициализации"""
+        self.created_from = created_from
+        self.created_to = created_to
+        self.dry_run = dry_run
+        self.pages = 0
+        self.transactions = 0
+        self.matched = 0
+        self.skipped = 0
+        self.updated: list[dict] = []
+        self.settled: list[dict] = []
+        self.conflicts: list[dict] = []
+        self.unknown: list[int] = []
+        self.archived: list[int] = []
+
+    def to_dict(self) -> dict:
+        return {
+            'created_from': self.created_from.isoformat(),
+            'created_to': self.created_to.isoformat(),
+            'dry_run': self.dry_run,
+            'pages': self.pages,
+            'transactions': self.transactions,
+            'matched': self.matched,
+            'skipped': self.skipped,
+            'updated': self.updated,
+            'settled': self.settled,
+            'conflicts': self.conflicts,
+            'unknown': self.unknown,
+            'archived': self.archived,
+        }
+
+
+def _parse_page(page: list[dict], report: ReconciliationReport) -> dict:
+    """Итоговый статус по каждому заказу страницы. Если транзакций по заказу несколько
+    (например, отклоненная попытка и успешная оплата), берется самый поздний статус по STATUS_RANK"""
+    statuses = {}
+    for item in page:
+        try:
+            transaction = Transaction.from_dict(item)
+        except ModelParseError as e:
+            report.skipped += 1
+            logger.debug("Transaction skipped: {}", e)
+            continue
+        status_code = TRANSACTION_STATUS_CODES.get(transaction.status)
+        if status_code is None:
+            continue
+        number = transaction.invoice_id
+        current = statuses.get(number)
+        if current is None or STATUS_RANK[status_code] > STATUS_RANK[current]:
+            statuses[number] = status_code
+    return statuses
+
+
+class Reconciler:
+    """Сверка заказов с транзакциями CloudPayments. Методы:
+    run() — проходит выгрузку за интервал и отдает ReconciliationReport
+
+    Следующая страница запрашивается, пока сверяется текущая. Статус заказа двигается только вперед
+    (см. models.STATUS_RANK), как и при хуках. Неитоговые статусы просто пишутся, а итоговые забираются
+    так же, как их забирают хук и поллер: заказ, который забрала сверка, передается в settle(),
+    а заказ, который успели закрыть они, попадает в conflicts и второй раз не обрабатывается"""
+
+    def __init__(self, client: CloudPayments, settle: Callable[..., Awaitable[None]],
+                 batch_size: int = settings.reconcile_batch_size, dry_run: bool = False):
+        """Метод инициализации"""
+        self.client = client
+        self.settle = settle
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self._pending: list = []
+        self._claims: list = []
+
+    async def run(self, created_from: datetime.datetime, created_to: datetime.datetime) -> ReconciliationReport:
+        report = ReconciliationReport(created_from, created_to, self.dry_run)
+        page_number = 1
+        next_page = asyncio.create_task(self.client.list_payments(created_from, created_to, page_number))
+        try:
+            while True:
+                page = await next_page
+                if not page:
+                    break
+                page_number += 1
+                next_page = asyncio.create_task(self.client.list_payments(created_from, created_to, page_number))
+                report.pages += 1
+                report.transactions += len(page)
+                await self._reconcile_page(page, report)
+        finally:
+            if not next_page.done():
+                next_page.cancel()
+                await asyncio.gather(next_page, return_exceptions=True)
+            await self._flush(report)
+
+        logger.info("Reconciliation {} - {}: {} pages, {} transactions, {} updated, {} settled, {} conflicts, "
+                    "{} unknown, {} archived", created_from, created_to, report.pages, report.transactions,
+                    len(report.updated), len(report.settled), len(report.conflicts), len(report.unknown),
+                    len(report.archived))
+        return report
+
+    async def _reconcile_page(self, page: list[dict], report: ReconciliationReport) -> None:
+        statuses = _parse_page(page, report)
+        orders = await db.get_orders_by_numbers(statuses)
+        missing = [number for number in statuses if number not in orders]
+        archived = await db.get_archived_numbers(missing) if missing else set()
+        for number, status_code in statuses.items():
+            order = orders.get(number)
+            if order is None:
+                (report.archived if number in archived else report.unknown).append(number)
+                continue
+            report.matched += 1
+            if order.status_code == status_code:
+                continue
+            if order.status_code is not None and order.status_code in status_codes_not_before(status_code):
+                report.conflicts.append({'number': number, 'db': order.status_code, 'cloudpayments': status_code})
+                continue
+            change = {'number': number, 'old': order.status_code, 'new': status_code}
+            (self._claims if status_code in TERMINAL_STATUS_CODES else self._pending).append(change)
+        if len(self._pending) + len(self._claims) >= self.batch_size:
+            await self._flush(report)
+
+    async def _flush(self, report: ReconciliationReport) -> None:
+        """Пишет накопленные статусы. Ссылки на чек не трогаем, а статус в бд двигается только вперед:
+        если заказ успели закрыть хук или поллер, пока шла сверка, бд его не обновит, и он попадет в conflicts.
+        Итоговые статусы забираются одним guarded UPDATE, и забранные заказы сразу обрабатываются"""
+        batch, self._pending = self._pending, []
+        claims, self._claims = self._claims, []
+        if not batch and not claims:
+            return
+        if self.dry_run:
+            report.updated.extend(batch)
+            report.settled.extend(claims)
+            return
+
+        rejected = []
+        if batch:
+            updated = await db.bulk_update_orders([SimpleNamespace(number=change['number'], status_code=change['new'],
+                                                                   receipt_url=None) for change in batch])
+            applied = {order.number for order in updated}
+            report.updated.extend(change for change in batch if change['number'] in applied)
+            rejected.extend(change for change in batch if change['number'] not in applied)
+        if claims:
+            claimed = await db.claim_order_statuses([SimpleNamespace(number=change['number'],
+                                                                     status_code=change['new']) for change in claims])
+            applied = {order.number for order in claimed}
+            report.settled.extend(change for change in claims if change['number'] in applied)
+            rejected.extend(change for change in claims if change['number'] not in applied)
+            # Статус уже записан, и заказ больше никто не заберет: ошибка одного заказа не должна
+            # прервать обработку остальных (core.settle_claimed_order сам повторяет упавшую обработку)
+            results = await asyncio.gather(*(self.settle(order) for order in claimed), return_exceptions=True)
+            for order, result in zip(claimed, results):
+                if isinstance(result, Exception):
+                    logger.error("Settlement of order {} failed: {}", order.number, result)
+
+        current = await db.get_orders_by_numbers(change['number'] for change in rejected) if rejected else {}
+        for change in rejected:
+            order = current.get(change['number'])
+            report.conflicts.append({'number': change['number'], 'db': order.status_code if order else None,
+                                     'cloudpayments': change['new']})
+
+
+def _datetime(value: str) -> datetime.datetime:
+    """Дата или дата со временем в ISO 8601. Без часового пояса считаем, что это UTC"""
+    result = datetime.datetime.fromisoformat(value)
+    return result if result.tzinfo is not None else result.replace(tzinfo=datetime.timezone.utc)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Reconcile Orders with CloudPayments transactions')
+    parser.add_argument('--from', dest='created_from', type=_datetime, required=True,
+                        help='start of the interval, ISO 8601 (UTC if no offset)')
+    parser.add_argument('--to', dest='created_to', type=_datetime, required=True,
+                        help='end of the interval, ISO 8601 (UTC if no offset)')
+    parser.add_argument('--dry-run', action='store_true', help='report the differences without applying them')
+    parser.add_argument('--report', metavar='PATH', help='write the full report as JSON')
+    parser.add_argument('--batch-size', type=int, default=settings.reconcile_batch_size)
+    return parser.parse_args()
+
+
+async def main(args: argparse.Namespace) -> ReconciliationReport:
+    if args.dry_run:
+        # Только читаем: уведомления, чеки и прочие компоненты бота не нужны
+        lifecycle = Lifecycle('Reconciliation').stage(
+            Step('db', db.connect, db.close),
+            Step('cloudpayments', core.client.start, core.client.close),
+        )
+    else:
+        # Итоговые статусы обрабатываются как в боте. При остановке дорабатываются уведомления, чеки
+        # и повторы обработки, и только потом закрываются сессия бота и пулы
+        lifecycle = core.build_lifecycle('Reconciliation', polling=False,
+                                         first_stage=(Step('bot_session', stop=core.close_bot_session),))
+    await lifecycle.start()
+    try:
+        reconciler = Reconciler(core.client, core.settle_claimed_order, batch_size=args.batch_size,
+                                dry_run=args.dry_run)
+        return await reconciler.run(args.created_from, args.created_to)
+    finally:
+        await lifecycle.stop()
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    setup_logging()
+    result = asyncio.run(main(arguments))
+    if arguments.report:
+        with open(arguments.report, 'w') as report_file:
+            json.dump(result.to_dict(), report_file, indent=2, ensure_ascii=False)
+    print(json.dumps({key: len(value) if isinstance(value, list) else value
+                      for key, value in result.to_dict().items()}, indent=2))
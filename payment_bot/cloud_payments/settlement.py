@@ -0,0 +1,71 @@
+import asyncio
+import random
+from typing import Awaitable, Callable
+from loguru import logger
+from payment_bot.config import settings
+from payment_bot.cloud_payments.models import Order
+
+
+class SettlementRetries:
+    """Повторная обработка итогового статуса, которая упала после того, как статус уже записан в бд. Методы:
+    submit() — повторит settle(order, **kwargs) в фоне и сразу возвращает управление
+    stop() — дожидается повторов (не дольше timeout) и отменяет оставшиеся
+    stats() — сколько заказов ждут повтора, сколько обработано повтором и сколько так и не обработано
+
+    Статус в бд к этому моменту уже итоговый: повтор хука CloudPayments отсечет дедупликация, а поллер
+    не сможет забрать заказ (db.claim_order_status). Поэтому обработку доделываем сами.
+    Повторы идут с экспоненциальной задержкой"""
+
+    def __init__(self, settle: Callable[..., Awaitable[None]],
+                 max_attempts: int = settings.settle_max_attempts,
+                 retry_delay: float = settings.settle_retry_delay,
+                 retry_max_delay: float = settings.settle_retry_max_delay):
+        """Метод инициализации"""
+        self.settle = settle
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self._tasks: set[asyncio.Task] = set()
+        self.retries = 0
+        self.recovered = 0
+        self.failed = 0
+
+    def submit(self, order: Order, **kwargs) -> None:
+        task = asyncio.create_task(self._retry(order, kwargs))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def stop(self, timeout: float = settings.shutdown_timeout) -> None:
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if pending:
+            logger.error("Settlement retries did not finish in {}s, {} orders left unsettled", timeout, len(pending))
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._tasks),
+            'retries': self.retries,
+            'recovered': self.recovered,
+            'failed': self.failed,
+        }
+
+    async def _retry(self, order: Order, kwargs: dict) -> None:
+        for attempt in range(1, self.max_attempts + 1):
+            delay = min(self.retry_max_delay, self.retry_delay * 2 ** (attempt - 1))
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            self.retries += 1
+            try:
+                await self.settle(order, **kwargs)
+            except Exception as e:
+                logger.warning("Settlement of order {} failed, retry {} of {}: {}",
+                               order.number, attempt, self.max_attempts, e)
+                continue
+            self.recovered += 1
+            logger.info("Order {} settled on retry {}", order.number, attempt)
+            return
+        self.failed += 1
+        logger.error("Settlement of order {} failed after {} retries", order.number, self.max_attempts)
@@ -1,5 +1,6 @@
 from pydantic import BaseModel, Field
 import os
+import socket
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -28,15 +29,161 @@ class Settings(BaseModel):
     db_user: str = os.getenv('DB_USER')
     db_password: str = os.getenv('DB_PASSWORD')
     db_host: str = os.getenv('DB_HOST')
+    # Пул соединений с бд на все приложение и таймаут операций (в секундах)
+    db_pool_min: int = int(os.getenv('DB_POOL_MIN', 1))
+    db_pool_max: int = int(os.getenv('DB_POOL_MAX', 20))
+    db_timeout: float = 60.0
+    # Отложенная запись статусов заказов: изменения копятся в памяти и уходят в бд одним запросом
+    # раз в write_behind_interval_ms миллисекунд или как только накопится write_behind_max_rows заказов
+    write_behind_enabled: bool = os.getenv('WRITE_BEHIND', 'false').lower() == 'true'
+    write_behind_interval_ms: int = 200
+    write_behind_max_rows: int = 500
 
     # Задержка между проверками платежа и максимальное число попыток
     # Итоговое время ожидания платежа = delay * max_attempts
     delay: int = 3
     max_attempts: int = 100
 
+    # Политика polling-проверок: fixed — раз в delay секунд max_attempts раз,
+    # adaptive — часто сразу после создания заказа, дальше экспоненциально реже (с джиттером),
+    # и снова часто, когда платеж ждет 3-D Secure (AwaitingAuthentication)
+    polling_policy: str = os.getenv('POLLING_POLICY', 'adaptive')
+    poll_initial_delay: float = 2.0
+    poll_backoff_factor: float = 1.6
+    poll_max_delay: float = 30.0
+    poll_jitter: float = 0.2
+    poll_auth_delay: float = 2.0
+    poll_max_age: float = delay * max_attempts
+    # Сколько проверок заказа подряд может упасть (например, кривой ответ payments/find), прежде чем заказ
+    # закроется со статусом max_attempts
+    poll_max_failures: int = 10
+
+    # Планировщик polling-проверок: число воркеров и общий лимит запросов payments/find в секунду
+    polling_workers: int = 20
+    polling_rps: float = 50.0
+    # Просроченные проверки (например, после рестарта) размазываются по этому окну (в секундах)
+    resume_spread: float = 30.0
+
+    # Распределение заказов между несколькими поллерами через аренду строк в Orders.
+    # polling_distributed=True — новые заказы не закрепляются за создавшим их процессом,
+    # их разбирают все запущенные поллеры (polling_mode.py и polling_worker.py)
+    polling_distributed: bool = os.getenv('POLLING_DISTRIBUTED', 'false').lower() == 'true'
+    poller_id: str = os.getenv('POLLER_ID', f'{socket.gethostname()}-{os.getpid()}')
+    lease_ttl: float = 60.0
+    lease_claim_interval: float = 1.0
+    lease_batch: int = 100
+    # Сколько секунд при остановке ждем воркеры, которые уже проверяют заказы
+    shutdown_timeout: float = 10.0
+
+    # Пул HTTP-соединений с CloudPayments: один клиент на все запросы, keep-alive и опционально HTTP/2
+    # Для HTTP/2 нужен пакет h2 (httpx[http2]), без него клиент откатится на HTTP/1.1
+    http2: bool = os.getenv('CP_HTTP2', 'false').lower() == 'true'
+    http_max_connections: int = 100
+    http_max_keepalive_connections: int = 20
+    http_keepalive_expiry: float = 30.0
+    http_connect_timeout: float = 5.0
+    http_read_timeout: float = 10.0
+    http_write_timeout: float = 10.0
+    http_pool_timeout: float = 5.0
+
+    # Устойчивость запросов к CloudPayments: таймаут каждого эндпоинта (в секундах), повторы с экспоненциальной
+    # задержкой для идемпотентных эндпоинтов и circuit breaker: после cp_breaker_threshold сбоев подряд
+    # запросы не отправляются cp_breaker_recovery секунд, а polling-проверки ставятся на паузу
+    cp_endpoint_timeouts: dict[str, float] = {
+        'payments/find': 5.0,
+        'orders/cancel': 5.0,
+        'orders/create': 10.0,
+        'kkt/receipt': 15.0,
+        'v2/payments/list': 30.0,
+    }
+    cp_idempotent_endpoints: tuple[str, ...] = ('payments/find', 'orders/cancel', 'v2/payments/list')
+    cp_retry_attempts: int = 3
+    cp_retry_base_delay: float = 0.2
+    cp_retry_max_delay: float = 2.0
+    cp_breaker_threshold: int = 5
+    cp_breaker_recovery: float = 30.0
+
+    # Создание чеков: число воркеров, размер очереди и повторы kkt/receipt с экспоненциальной задержкой
+    receipt_workers: int = 5
+    receipt_queue_size: int = 10_000
+    receipt_max_attempts: int = 5
+    receipt_retry_delay: float = 1.0
+    receipt_retry_max_delay: float = 30.0
+
+    # Повторы обработки итогового статуса (уведомление, отмена платежа), если она упала, когда статус уже в бд
+    settle_max_attempts: int = 5
+    settle_retry_delay: float = 1.0
+    settle_retry_max_delay: float = 30.0
+
+    # HTTP-сервер с метриками Prometheus для polling-режима (в режиме вебхуков метрики отдает FastAPI на /metrics).
+    # METRICS_PORT=0 — не запускать. У каждого поллера на одном хосте должен быть свой порт
+    metrics_host: str = os.getenv('METRICS_HOST', '0.0.0.0')
+    metrics_port: int = int(os.getenv('METRICS_PORT', '9100'))
+
+    # Логи: уровень, файл (LOG_FILE, по умолчанию только stderr) и его ротация.
+    # log_enqueue=True — запись в sink идет из отдельного потока: медленный диск или переполненный pipe stdout
+    # не останавливают event loop, но каждое записанное сообщение стоит дороже (см. benchmarks/logging_overhead.py).
+    # Частые события (polling-проверки) попадают в лог только каждые log_sample_every раз
+    log_level: str = os.getenv('LOG_LEVEL', 'INFO')
+    log_file: str | None = os.getenv('LOG_FILE')
+    log_rotation: str = os.getenv('LOG_ROTATION', '100 MB')
+    log_enqueue: bool = os.getenv('LOG_ENQUEUE', 'true').lower() == 'true'
+    log_sample_every: int = int(os.getenv('LOG_SAMPLE_EVERY', '100'))
+
+    # Выгрузка заказов (GET /orders/export в режиме вебхуков): токен доступа (без него ручка выключена)
+    # и сколько заказов читается из бд за один запрос
+    export_token: str | None = os.getenv('EXPORT_TOKEN')
+    export_batch_size: int = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))
+
+    # Выдача ссылок на оплату (/get_payment): не больше payment_rate запросов в секунду на юзера
+    # со всплеском до payment_burst, лимиты хранятся для throttle_max_users последних юзеров.
+    # Пока открытый заказ юзера моложе order_reuse_ttl секунд, на повторный запрос отдается его ссылка
+    payment_rate: float = float(os.getenv('PAYMENT_RATE', '0.2'))
+    payment_burst: float = float(os.getenv('PAYMENT_BURST', '3'))
+    throttle_max_users: int = 100_000
+    order_reuse_ttl: float = float(os.getenv('ORDER_REUSE_TTL', poll_max_age / 2))
+
+    # Гибридный режим (hybrid_mode.py): сколько секунд ждем хук CloudPayments по новому заказу,
+    # прежде чем начать проверять его через payments/find
+    webhook_grace: float = float(os.getenv('WEBHOOK_GRACE', '60'))
+
+    # Сверка с CloudPayments (cloud_payments/reconciliation.py): сколько исправлений статусов
+    # копится перед записью в бд одним запросом
+    reconcile_batch_size: int = int(os.getenv('RECONCILE_BATCH_SIZE', '1000'))
+
+    # Архив заказов (db_infra/archive.py): заказы с итоговым статусом старше archive_after секунд переезжают
+    # из Orders в OrdersArchive пачками по archive_batch_size с паузой archive_batch_pause между пачками.
+    # Перенос запускается раз в archive_interval секунд, ARCHIVE_INTERVAL=0 — не запускать в приложении
+    archive_after: float = float(os.getenv('ARCHIVE_AFTER', 30 * 24 * 60 * 60))
+    archive_batch_size: int = int(os.getenv('ARCHIVE_BATCH_SIZE', '1000'))
+    archive_batch_pause: float = 0.1
+    archive_interval: float = float(os.getenv('ARCHIVE_INTERVAL', 60 * 60))
+
     # Креды для вебхуков
     webhook_path: str = f"/bot/{tg_token}"
     ngrok_url: str | None = 'https://example.com/your-bot-endpoint'
 
+    # Быстрый ответ Telegram на вебхук: апдейт кладется в ограниченную очередь, эндпоинт сразу отвечает 200,
+    # а обрабатывают апдейты webhook_workers воркеров. Если очередь полна дольше webhook_queue_put_timeout,
+    # отвечаем 503, и Telegram повторит доставку позже
+    webhook_fast_ack: bool = os.getenv('WEBHOOK_FAST_ACK', 'false').lower() == 'true'
+    webhook_queue_size: int = 1000
+    webhook_workers: int = 10
+    webhook_queue_put_timeout: float = 1.0
+
+    # Кэш уже обработанных хуков CloudPayments: повторные доставки отсекаются без похода в бд
+    webhook_dedup_size: int = 100_000
+    webhook_dedup_ttl: float = 24 * 60 * 60
+
+    # Уведомления в Telegram: общий лимит бота и лимит на один чат (сообщений в секунду),
+    # сколько сообщений отправляется одновременно и сколько раз повторять отправку при ошибке
+    notify_global_rate: float = 25.0
+    notify_chat_rate: float = 1.0
+    notify_chat_burst: float = 1.0
+    notify_concurrency: int = 10
+    notify_max_chats: int = 10_000
+    notify_max_attempts: int = 3
+    notify_retry_delay: float = 1.0
+
 
 settings = Settings()
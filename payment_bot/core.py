@@ -0,0 +1,225 @@
+import functools
+from aiogram import Bot, Dispatcher, types
+from loguru import logger
+from payment_bot import metrics
+from payment_bot.lifecycle import Lifecycle, Step
+from payment_bot.config import settings
+from payment_bot.cloud_payments import cloud_payments, models, order_links, polling, receipts, settlement
+from payment_bot.cloud_payments.models import Order
+from payment_bot.db_infra import archive, db, migrations, write_behind
+from payment_bot.db_infra.idempotency import WebhookDeduplicator
+from payment_bot.bot_infra.middlewares import HandlerMetricsMiddleware, ThrottlingMiddleware, rate_limit
+from payment_bot.bot_infra.notifications import Notifier, Priority
+
+# Общая часть всех режимов: бот, клиент CloudPayments, хендлеры и обработка итоговых статусов заказов.
+# Режимы (polling_mode.py, webhooks_mode.py, hybrid_mode.py) отличаются только тем, откуда приходят апдейты
+# Telegram и статусы платежей, и собирают запуск через build_lifecycle()
+
+# Запускаем бота
+bot = Bot(token=settings.tg_token)
+dp = Dispatcher(bot)
+# Лимиты на юзера стоят первыми: отброшенные сообщения не попадают в метрики хендлеров
+throttling = ThrottlingMiddleware()
+dp.middleware.setup(throttling)
+dp.middleware.setup(HandlerMetricsMiddleware())
+
+# Уведомления юзерам уходят в фоне, с учетом лимитов Telegram
+notifier = Notifier(bot)
+
+# Создаем клиента для CloudPayments
+client = cloud_payments.CloudPayments(settings.cp_p_id, settings.cp_api_pass)
+
+# Отсекаем повторные доставки хуков CloudPayments
+webhook_deduplicator = WebhookDeduplicator()
+
+# Ссылки на оплату: повторный /get_payment отдает открытый заказ, а не создает новый.
+# Ставить ли новый заказ в планировщик, решает режим в build_lifecycle()
+links = order_links.OrderLinks(client)
+
+
+# ---- Telegram Bot handlers ---- #
+@dp.message_handler(commands=['start'])
+async def send_welcome(message: types.Message):
+    """Проверяем, что все ок и что бот работает"""
+    await message.reply("Hi!\nThe bot is working.")
+    await message.reply(f"Available tables in db: {await db.get_table_names()}")
+
+
+@dp.message_handler(commands=["get_payment"])
+@rate_limit(settings.payment_rate, settings.payment_burst)
+async def get_payment_link(message: types.Message) -> None:
+    """Отправляем юзеру ссылку на открытый заказ. Если его нет, создаем платеж в CloudPayments и добавляем в БД"""
+    try:
+        # Сюда нужно передавать сумму из сообщения
+        order = await links.get_or_create(message.from_id, 10.0, 'USD')
+        await message.answer(f'Your order link: {order.url}')
+    except cloud_payments.CloudPaymentsError as e:
+        logger.warning("Payment link for {} was not created: {}", message.from_id, e)
+        await message.answer('The payment service is temporarily unavailable. Please try again later.')
+    except Exception as e:
+        await message.answer(f'Somethings went wrong: {e}')
+
+
+@dp.message_handler()
+async def echo(message: types.Message):
+    await message.answer('This bot demonstrates the possibilities of interacting with the Cloud Payments API.'
+                         ' To receive a test payment, click /get_payment')
+# ------------------------- #
+
+
+# ---- Bot payment processing ---- #
+async def settle_order(order: Order) -> None:
+    """Реагируем на итоговый статус заказа, откуда бы он ни пришел: из хука или от проверки.
+    Статус к этому моменту уже записан в бд. Если лимит проверок закончился, получили ошибку
+    или платеж отменился, руками отменяем платеж, чтобы не наткнуться на ошибку.
+    Отклоненную попытку (declined, хук /fail) только сообщаем юзеру: заказ остается открытым,
+    его еще можно оплатить по той же ссылке, а поллер проверяет его дальше"""
+    if order.status_code == models.StatusCode.ok.value:
+        await payment_received(order)
+    elif order.status_code == models.StatusCode.declined.value:
+        await payment_declined(order)
+    elif order.status_code in (models.StatusCode.error.value,
+                               models.StatusCode.cancel.value,
+                               models.StatusCode.max_attempts.value):
+        await cancel_payment(order)
+
+
+async def settle_checked_order(order: Order) -> None:
+    """Итоговый статус от планировщика. Статус записывается в бд одним guarded UPDATE:
+    если такой же или более поздний статус уже пришел хуком или его применил поллер в другом процессе,
+    строка не вернется, и второй раз заказ не обрабатываем"""
+    claimed = await db.claim_order_status(order.number, order.status_code)
+    if claimed is None:
+        logger.info("The payment {} is already settled", order.number)
+        return
+    await settle_claimed_order(order)
+
+
+async def settle_claimed_order(order: Order) -> None:
+    """Обработка итогового статуса, который уже записан в бд и забран вызывающим (хук, поллер, сверка).
+    Если она упала, повторяем ее в фоне: ни повтор хука, ни следующая проверка заказ уже не обработают"""
+    try:
+        await settle_order(order)
+    except Exception as e:
+        logger.error("Settlement of order {} failed, will retry: {}", order.number, e)
+        settlement_retries.submit(order)
+
+
+async def payment_received(order: Order) -> None:
+    """Действия при удачной оплате: отсылаем подрообности юзеру.
+    Чек создается в фоне, ссылку на него юзер получит отдельно, когда чек будет готов"""
+    logger.info("The payment {} received. Status: {}", order.number, order.status_code)
+    # Сообщение для понимания, что платеж прошел успешно
+    notifier.notify(order.description,
+                    f'The payment {order.number} was successful.'
+                    f'\nThe amount: {order.amount}.', Priority.high)
+    await receipt_pipeline.submit(order)
+
+
+async def payment_declined(order: Order) -> None:
+    """Действия при отклоненной попытке оплаты: отправляем инфу юзеру, заказ остается открытым в CloudPayments"""
+    logger.info("The payment {} declined", order.number)
+    notifier.notify(order.description,
+                    f'The payment {order.number} was declined.'
+                    f'\nYou can try again with the same link.', Priority.high)
+
+
+async def send_receipt_link(order: Order) -> None:
+    """Отправляем юзеру ссылку на готовый чек"""
+    notifier.notify(order.description, f'Your receipt link: {order.receipt_url}')
+
+
+async def cancel_payment(order: Order) -> None:
+    """Действия при неудачной оплате: отменяем платеж в CloudPayments и отправляем инфу юзеру.
+    В бд остается итоговый статус, из-за которого платеж отменили"""
+    order = await client.cancel_payment(order)
+    logger.info("The payment {} canceled", order.number)
+    # Сообщение для понимания, что платеж прошел с ошибкой
+    notifier.notify(order.description,
+                    f'The payment {order.number} was made with an error.'
+                    f'\nThe amount of {order.amount} has not been credited.'
+                    f'\nStatus code: {order.status_code}', Priority.high)
+
+
+async def apply_webhook(request_body: bytes, status_code: int):
+    """Статус платежа из хука CloudPayments /pay или /fail. Новый итоговый статус снимает заказ
+    с polling-проверок и обрабатывается так же, как найденный планировщиком. Отклоненная попытка из /fail
+    (declined) заказ не закрывает: он остается в расписании, чтобы поллер нашел оплату, если ее хук потеряется"""
+    # Разбираем тело хука (form-urlencoded) сразу в транзакцию, статус-код берем из эндпоинта
+    try:
+        transaction = models.Transaction.from_form(request_body, StatusCode=status_code)
+    except models.ModelParseError as e:
+        # Повторная доставка такого хука ничего не изменит
+        logger.warning("Webhook was skipped: {}", e)
+        return None
+    logger.debug("Transaction has been created from form: {}", transaction)
+
+    # Повторный хук или откат статуса назад заказ не тронут
+    new_order = await webhook_deduplicator.apply(transaction)
+    logger.debug("Order was updated: {}", new_order)
+    if new_order is not None:
+        if new_order.status_code in models.TERMINAL_STATUS_CODES:
+            scheduler.discard(new_order.number)
+        await settle_claimed_order(new_order)
+    return new_order
+# ------------------------- #
+
+
+# Планировщик polling-проверок: один на все заказы. Запускается только в режимах с polling
+scheduler = polling.PollingScheduler(client, on_finished=settle_checked_order)
+
+# Повторы обработки статусов, которая упала: повторная доставка хука или проверка ее уже не запустят
+settlement_retries = settlement.SettlementRetries(settle_order)
+
+# Очередь на создание чеков: чеки не задерживают обработку платежей
+receipt_pipeline = receipts.ReceiptPipeline(client, on_ready=send_receipt_link)
+
+# Состояние очередей и клиентов в метриках
+metrics.registry.stats_gauges('polling_scheduler', 'Polling scheduler', scheduler.stats)
+metrics.registry.stats_gauges('notifier', 'Telegram notification queue', notifier.stats)
+metrics.registry.stats_gauges('receipts', 'Receipt pipeline', receipt_pipeline.stats)
+metrics.registry.stats_gauges('webhook_dedup', 'Deduplication of CloudPayments webhooks', webhook_deduplicator.stats)
+metrics.registry.stats_gauges('cloudpayments', 'CloudPayments client and circuit breaker', client.stats)
+metrics.registry.stats_gauges('order_links', 'Payment links: created, reused and coalesced', links.stats)
+metrics.registry.stats_gauges('throttling', 'Per-user rate limits of bot handlers', throttling.stats)
+metrics.registry.stats_gauges('settlement_retries', 'Retries of failed order settlements', settlement_retries.stats)
+
+
+# Сессию бота закрываем последней, когда уведомления уже отправлены (шаг первого этапа)
+async def close_bot_session() -> None:
+    session = await bot.get_session()
+    await session.close()
+
+
+def build_lifecycle(name: str, polling: bool, first_check_delay: float | None = None,
+                    first_stage: tuple = (), second_stage: tuple = (), last_stage: tuple = ()) -> Lifecycle:
+    """Запуск режима по этапам: миграции (в отдельном потоке), пулы бд и CloudPayments и отправка уведомлений
+    поднимаются одновременно, дальше отложенная запись, очередь чеков и архивация заказов, последним — планировщик
+    (если polling=True), когда все готово. Остановка идет в обратном порядке.
+    *_stage — шаги режима, которые добавляются в соответствующие этапы.
+
+    С polling=True каждый новый заказ встает в планировщик: первая проверка через first_check_delay секунд,
+    а без него — по политике. Вызывается один раз на процесс"""
+    links.on_created = functools.partial(scheduler.add, delay=first_check_delay) if polling else None
+    lifecycle = Lifecycle(name).stage(
+        *first_stage,
+        Step('migrations', migrations.migrate_async),
+        Step('db', db.connect, db.close),
+        Step('cloudpayments', client.start, client.close),
+        Step('notifier', notifier.start, notifier.stop),
+    ).stage(
+        # Дописываем отложенные изменения статусов до закрытия пула
+        Step('write_behind', write_behind.start, write_behind.stop),
+        # Доделываем чеки и досылаем уведомления по уже закрытым заказам
+        Step('receipts', receipt_pipeline.start, receipt_pipeline.stop),
+        # Старые закрытые заказы переезжают в архив по расписанию
+        Step('archive', archive.archiver.start, archive.archiver.stop),
+        # Доделываем упавшие обработки статусов, пока живы очередь чеков, уведомления и клиент CloudPayments
+        Step('settlement_retries', stop=settlement_retries.stop),
+        *second_stage,
+    ).stage(
+        *((Step('scheduler', scheduler.start, scheduler.stop),) if polling else ()),
+        *last_stage,
+    )
+    metrics.registry.stats_gauges('startup', 'Startup time of the app, seconds', lifecycle.stats)
+    return lifecycle
@@ -0,0 +1,110 @@
+import asyncio
+import datetime
+from loguru import logger
+from payment_bot import metrics
+from payment_bot.config import settings
+from payment_bot.db_infra import db
+
+
+def _month_start(value: datetime.datetime) -> datetime.datetime:
+    value = value.astimezone(datetime.timezone.utc)
+    return datetime.datetime(value.year, value.month, 1, tzinfo=datetime.timezone.utc)
+
+
+def _next_month(month: datetime.datetime) -> datetime.datetime:
+    return month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+
+
+class OrderArchiver:
+    """Перенос заказов с итоговым статусом (models.TERMINAL_STATUS_CODES) старше older_than секунд
+    из Orders в архив OrdersArchive, секционированный по месяцу создания (UTC). Методы:
+    run_once() — переносит все такие заказы пачками по batch_size и отдает, сколько перенесено
+    start() и stop() — запускают перенос раз в interval секунд и останавливают его
+    stats() — сколько заказов перенесено, прогонов и сбоев
+
+    Каждая пачка — отдельный короткий запрос (db.move_orders_to_archive), так что Orders не блокируется
+    надолго, а между пачками бд получает паузу. В Orders остаются заказы, которые еще могут поменяться,
+    и свежие итоговые. Заказы из архива по-прежнему находит db.get_order_by_number()"""
+
+    def __init__(self, older_than: float = settings.archive_after, batch_size: int = settings.archive_batch_size,
+                 interval: float = settings.archive_interval, pause: float = settings.archive_batch_pause):
+        """Метод инициализации"""
+        self.older_than = older_than
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pause = pause
+        # Месяцы, секции которых этот процесс уже создал
+        self._partitions: set[datetime.datetime] = set()
+        self._runner: asyncio.Task | None = None
+        self.archived = 0
+        self.runs = 0
+        self.failures = 0
+
+    async def run_once(self) -> int:
+        cutoff = db.utc_now() - datetime.timedelta(seconds=self.older_than)
+        await self._ensure_partitions(cutoff)
+        moved = 0
+        while True:
+            batch = await db.move_orders_to_archive(cutoff, self.batch_size)
+            moved += batch
+            self.archived += batch
+            if batch < self.batch_size:
+                break
+            await asyncio.sleep(self.pause)
+        self.runs += 1
+        logger.info("Archived {} orders created before {}", moved, cutoff)
+        return moved
+
+    async def _ensure_partitions(self, cutoff: datetime.datetime) -> None:
+        """Создает секции архива на все месяцы от самого старого кандидата до cutoff"""
+        oldest = await db.get_oldest_archivable(cutoff)
+        if oldest is None:
+            return
+        month = _month_start(oldest)
+        while month <= cutoff:
+            if month not in self._partitions:
+                await db.create_archive_partition(f'{db.OrdersArchive._meta.table_name}_{month:%Y_%m}',
+                                                  month, _next_month(month))
+                self._partitions.add(month)
+            month = _next_month(month)
+
+    async def start(self) -> None:
+        if self._runner is None and self.interval > 0:
+            self._runner = asyncio.create_task(self._run_periodically())
+            logger.info("Order archiver started: every {}s, orders older than {}s", self.interval, self.older_than)
+
+    async def stop(self) -> None:
+        """Останавливает перенос. Пачка переносится одним запросом, так что прерванная пачка
+        не потеряет и не задвоит заказы: они переедут при следующем запуске"""
+        if self._runner is not None:
+            self._runner.cancel()
+            await asyncio.gather(self._runner, return_exceptions=True)
+            self._runner = None
+
+    def stats(self) -> dict:
+        return {'archived': self.archived, 'runs': self.runs, 'failures': self.failures}
+
+    async def _run_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.failures += 1
+                logger.error("Archiving orders failed: {}", e)
+
+
+archiver = OrderArchiver()
+metrics.registry.stats_gauges('archive', 'Archive of settled orders', archiver.stats)
+
+
+async def _archive_and_close() -> int:
+    await db.connect()
+    try:
+        return await archiver.run_once()
+    finally:
+        await db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(_archive_and_close())
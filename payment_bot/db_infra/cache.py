@@ -0,0 +1,101 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+
+class TTLCache:
+    """Ограниченный LRU-кэш с временем жизни записей. Методы:
+    get() — отдает значение или default, если записи нет или она устарела
+    set() — кладет значение, вытесняя самую давно использованную запись, если кэш полон
+    pop() — удаляет запись
+    stats() — счетчики попаданий, промахов и вытеснений"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        """Метод инициализации. ttl — время жизни записи в секундах"""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value) -> None:
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return item[0] if item is not None else default
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+_MISSING = object()
+
+
+class SingleFlight:
+    """Склейка одновременных вызовов: пока идет вызов по ключу, остальные вызовы с тем же ключом
+    не запускают свой, а ждут его результат (или его ошибку). Результат не запоминается.
+    do() — запускает func() или присоединяется к уже идущему вызову
+    stats() — сколько вызовов сейчас идет и сколько было склеено"""
+
+    def __init__(self):
+        """Метод инициализации"""
+        self._inflight: dict = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, func: Callable[[], Awaitable]):
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = future
+        self.calls += 1
+        try:
+            value = await func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            del self._inflight[key]
+
+    def stats(self) -> dict:
+        return {'inflight': len(self._inflight), 'calls': self.calls, 'coalesced': self.coalesced}
@@ -1,29 +1,87 @@
 import peewee_async
 from peewee import *
+from playhouse.postgres_ext import DateTimeTZField
 from loguru import logger
-from payment_bot.cloud_payments.models import Order
+from payment_bot.cloud_payments.models import Order, StatusCode, TERMINAL_STATUS_CODES, status_codes_not_before
 import datetime
+import time
 
 from payment_bot.config import settings
+from payment_bot import metrics
 
-# Подключение к базе данных PostgreSQL
-db = peewee_async.PostgresqlDatabase(database=settings.db_name,
-                                     user=settings.db_user, password=settings.db_password,
-                                     host=settings.db_host)
 
+class PoolStats:
+    """Метрики пула соединений: сколько корутин ждут соединение, сколько раз и как долго его получали"""
 
+    def __init__(self):
+        """Метод инициализации"""
+        self.waiting = 0
+        self.acquired = 0
+        self.acquire_time_total = 0.0
+        self.acquire_time_max = 0.0
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedPostgresqlConnection(peewee_async.AsyncPostgresqlConnection):
+    """Пул соединений aiopg, который считает ожидание и время получения соединения"""
+
+    async def acquire(self):
+        pool_stats.waiting += 1
+        started = time.perf_counter()
+        try:
+            return await super().acquire()
+        finally:
+            elapsed = time.perf_counter() - started
+            pool_stats.waiting -= 1
+            pool_stats.acquired += 1
+            pool_stats.acquire_time_total += elapsed
+            pool_stats.acquire_time_max = max(pool_stats.acquire_time_max, elapsed)
+
+
+class PooledPostgresqlDatabase(peewee_async.PooledPostgresqlDatabase):
+    """Пул соединений с PostgreSQL на все приложение, с метриками из InstrumentedPostgresqlConnection"""
+
+    def init_async(self, conn_cls=InstrumentedPostgresqlConnection, **kwargs):
+        super().init_async(conn_cls=conn_cls, **kwargs)
+
+
+# Подключение к базе данных PostgreSQL. Пул открывается в connect() и закрывается в close()
+db = PooledPostgresqlDatabase(database=settings.db_name,
+                              user=settings.db_user, password=settings.db_password,
+                              host=settings.db_host,
+                              min_connections=settings.db_pool_min,
+                              max_connections=settings.db_pool_max,
+                              connection_timeout=settings.db_timeout)
+
+
+def utc_now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+# Схему таблицы меняем только миграциями из db_infra/migrations.py, там же все индексы
 class BaseModel(Model):
-    id = TextField(column_name='id', null=False)
-    number = TextField(column_name='number', null=False)
-    amount = DecimalField(column_name='amount', null=False)
+    id = TextField(column_name='id', primary_key=True)
+    number = BigIntegerField(column_name='number', null=False, unique=True)
+    amount = DecimalField(column_name='amount', null=False, max_digits=12, decimal_places=2)
     currency = TextField(column_name='currency', null=False)
     email = TextField(column_name='email', null=True)
     description = TextField(column_name='description', null=True)
     require_confirmation = TextField(column_name='require_confirmation', null=True)
     url = TextField(column_name='url', null=False)
-    status_code = IntegerField(column_name='status_code', null=True)
-    created = DateTimeField(default=datetime.datetime.now)
+    status_code = SmallIntegerField(column_name='status_code', null=True)
+    created = DateTimeTZField(column_name='created', null=False, default=utc_now)
     receipt_url = TextField(column_name='receipt_url', null=True)
+    # Состояние polling-проверки: когда проверять в следующий раз, сколько раз уже проверили
+    # и последний статус транзакции. next_check_at = NULL, когда заказ больше не проверяем
+    next_check_at = DateTimeTZField(column_name='next_check_at', null=True)
+    poll_attempts = IntegerField(column_name='poll_attempts', null=False, default=0)
+    poll_status = TextField(column_name='poll_status', null=True)
+    # Аренда заказа поллером: кто из процессов сейчас его проверяет и до какого времени.
+    # Если процесс упал, аренда истекает и заказ забирает другой поллер
+    lease_owner = TextField(column_name='lease_owner', null=True)
+    lease_expires = DateTimeTZField(column_name='lease_expires', null=True)
 
     class Meta:
         database = db
@@ -34,63 +92,477 @@ class Orders(BaseModel):
         table_name = 'Orders'
 
 
+# Уже обработанные хуки CloudPayments: по одной строке на пару (транзакция, статус)
+class ProcessedWebhooks(Model):
+    transaction_id = BigIntegerField(column_name='transaction_id')
+    status_code = SmallIntegerField(column_name='status_code')
+    invoice_id = BigIntegerField(column_name='invoice_id', null=True)
+    received_at = DateTimeTZField(column_name='received_at', default=utc_now)
+
+    class Meta:
+        database = db
+        table_name = 'ProcessedWebhooks'
+        primary_key = CompositeKey('transaction_id', 'status_code')
+
+
+# Архив заказов с итоговым статусом, секционированный по месяцу создания (см. db_infra/archive.py).
+# Полей polling-расписания и аренды в нем нет: архивные заказы больше не проверяются
+class OrdersArchive(Model):
+    id = TextField(column_name='id')
+    number = BigIntegerField(column_name='number')
+    amount = DecimalField(column_name='amount', max_digits=12, decimal_places=2)
+    currency = TextField(column_name='currency')
+    email = TextField(column_name='email', null=True)
+    description = TextField(column_name='description', null=True)
+    require_confirmation = TextField(column_name='require_confirmation', null=True)
+    url = TextField(column_name='url')
+    status_code = SmallIntegerField(column_name='status_code', null=True)
+    created = DateTimeTZField(column_name='created')
+    receipt_url = TextField(column_name='receipt_url', null=True)
+    archived_at = DateTimeTZField(column_name='archived_at', default=utc_now)
+
+    class Meta:
+        database = db
+        table_name = 'OrdersArchive'
+        primary_key = CompositeKey('number', 'created')
+
+
+# Один менеджер на все приложение, а не новый на каждый запрос
+_manager = peewee_async.Manager(db)
+
+# Горячие запросы собираем один раз, а не через ORM на каждый вызов
+_TABLE = Orders._meta.table_name
+_SELECT_ORDER_BY_NUMBER = f'SELECT * FROM "{_TABLE}" WHERE number = %s LIMIT 1'
+# Статус меняется только вперед (см. models.STATUS_RANK), как и в _APPLY_WEBHOOK_STATUS. Тот же статус записать можно:
+# так сохраняется ссылка на чек. Ссылку на чек не затираем пустой: снимок заказа мог быть сделан до чека
+_UPDATE_ORDER_STATUS = (f'UPDATE "{_TABLE}" SET status_code = %s, receipt_url = COALESCE(%s, receipt_url) '
+                        f'WHERE number = %s AND (status_code IS NULL OR status_code = %s OR status_code NOT IN %s) '
+                        f'RETURNING *')
+_DELETE_ORDER = f'DELETE FROM "{_TABLE}" WHERE number = %s RETURNING *'
+_ARCHIVE_TABLE = OrdersArchive._meta.table_name
+_SELECT_ARCHIVED_ORDER_BY_NUMBER = f'SELECT * FROM "{_ARCHIVE_TABLE}" WHERE number = %s LIMIT 1'
+_SELECT_ARCHIVED_NUMBERS = f'SELECT number FROM "{_ARCHIVE_TABLE}" WHERE number IN %s'
+# Колонки, которые переезжают в архив. Поля polling-расписания и аренды остаются в Orders
+_ARCHIVE_COLUMNS = ', '.join(f'"{field.column_name}"' for field in OrdersArchive._meta.sorted_fields
+                             if field.name != 'archived_at')
+# Перенос пачки одним запросом: DELETE из Orders отдает строки, INSERT кладет их в архив, все в одной короткой
+# транзакции. FOR UPDATE SKIP LOCKED: заказы, которые сейчас кто-то меняет, переедут в следующий раз,
+# а несколько процессов с архивацией не ждут друг друга
+_MOVE_TO_ARCHIVE = (f'WITH moved AS (DELETE FROM "{_TABLE}" WHERE number IN ('
+                    f'SELECT number FROM "{_TABLE}" WHERE status_code IN %s AND created < %s '
+                    f'ORDER BY created LIMIT %s FOR UPDATE SKIP LOCKED) '
+                    f'RETURNING {_ARCHIVE_COLUMNS}) '
+                    f'INSERT INTO "{_ARCHIVE_TABLE}" ({_ARCHIVE_COLUMNS}) SELECT {_ARCHIVE_COLUMNS} FROM moved')
+_OLDEST_ARCHIVABLE = f'SELECT min(created) FROM "{_TABLE}" WHERE status_code IN %s AND created < %s'
+# Секция архива на интервал. Advisory lock — чтобы два процесса не создавали одну секцию одновременно
+_CREATE_ARCHIVE_PARTITION = (f'SELECT pg_advisory_xact_lock(7412002); '
+                             f'CREATE TABLE IF NOT EXISTS "{{name}}" PARTITION OF "{_ARCHIVE_TABLE}" '
+                             f'FOR VALUES FROM (%s) TO (%s)')
+# Пачка изменений статусов одним запросом: строки VALUES подставляются в bulk_update_orders().
+# Те же правила, что и в _UPDATE_ORDER_STATUS: not_before — статусы, поверх которых новый не пишется
+_BULK_UPDATE_ORDERS = (f'UPDATE "{_TABLE}" AS o SET status_code = v.status_code, '
+                       f'receipt_url = COALESCE(v.receipt_url, o.receipt_url) '
+                       f'FROM (VALUES {{values}}) AS v (number, status_code, receipt_url, not_before) '
+                       f'WHERE o.number = v.number AND (o.status_code IS NULL OR o.status_code = v.status_code '
+                       f'OR o.status_code <> ALL(v.not_before)) RETURNING o.*')
+_BULK_UPDATE_VALUES_ROW = '(%s::BIGINT, %s::SMALLINT, %s::TEXT, %s::SMALLINT[])'
+# Регистрация хука и смена статуса одним запросом: если такой хук уже был, INSERT ничего не вставит
+# и UPDATE не тронет заказ. Статус меняется только вперед (см. models.STATUS_RANK)
+_APPLY_WEBHOOK_STATUS = (f'WITH registered AS ('
+                         f'INSERT INTO "{ProcessedWebhooks._meta.table_name}" '
+                         f'(transaction_id, status_code, invoice_id) VALUES (%s, %s, %s) '
+                         f'ON CONFLICT DO NOTHING RETURNING invoice_id) '
+                         f'UPDATE "{_TABLE}" SET status_code = %s '
+                         f'WHERE number = (SELECT invoice_id FROM registered) '
+                         f'AND (status_code IS NULL OR status_code NOT IN %s) '
+                         f'RETURNING *')
+# Итоговый статус от проверки: записываем его, только если в бд статус более ранний. Строка вернется
+# ровно одному из тех, кто одновременно пришел с этим статусом (хук, поллеры в разных процессах)
+_CLAIM_ORDER_STATUS = (f'UPDATE "{_TABLE}" SET status_code = %s '
+                       f'WHERE number = %s AND (status_code IS NULL OR status_code NOT IN %s) '
+                       f'RETURNING *')
+# То же для пачки итоговых статусов (сверка): строки VALUES подставляются в claim_order_statuses()
+_CLAIM_ORDER_STATUSES = (f'UPDATE "{_TABLE}" AS o SET status_code = v.status_code '
+                         f'FROM (VALUES {{values}}) AS v (number, status_code, not_before) '
+                         f'WHERE o.number = v.number AND (o.status_code IS NULL OR o.status_code <> ALL(v.not_before)) '
+                         f'RETURNING o.*')
+_CLAIM_VALUES_ROW = '(%s::BIGINT, %s::SMALLINT, %s::SMALLINT[])'
+# Последний открытый заказ юзера на ту же сумму: статус еще не итоговый и заказ не старше created_after
+_SELECT_OPEN_ORDER = (f'SELECT * FROM "{_TABLE}" WHERE description = %s AND amount = %s AND currency = %s '
+                      f'AND created > %s AND (status_code IS NULL OR status_code NOT IN %s) '
+                      f'ORDER BY created DESC LIMIT 1')
+_SAVE_POLL_STATE = (f'UPDATE "{_TABLE}" SET next_check_at = %s, poll_attempts = %s, poll_status = %s, '
+                    f'lease_owner = %s, lease_expires = %s '
+                    f'WHERE number = %s AND (lease_owner IS NULL OR lease_owner = %s)')
+
+
 def _get_conn() -> peewee_async.Manager:
-    connection_manager = peewee_async.Manager(db)
-    return connection_manager
+    return _manager
+
+
+async def connect() -> None:
+    """Открывает пул соединений. Вызывается при старте приложения"""
+    await _manager.connect()
+    logger.info("Database pool opened: {}-{} connections", settings.db_pool_min, settings.db_pool_max)
+
+
+async def close() -> None:
+    """Закрывает пул соединений. Вызывается при остановке приложения"""
+    await _manager.close()
+    logger.info("Database pool closed")
+
 
+def get_pool_stats() -> dict:
+    """Метрики пула: размер, занятые и свободные соединения, ожидающие корутины и время получения соединения"""
+    pool = db._async_conn.pool if db._async_conn is not None else None
+    size = pool.size if pool is not None else 0
+    free = pool.freesize if pool is not None else 0
+    return {
+        'size': size,
+        'in_use': size - free,
+        'free': free,
+        'min_size': settings.db_pool_min,
+        'max_size': settings.db_pool_max,
+        'waiting': pool_stats.waiting,
+        'acquired_total': pool_stats.acquired,
+        'acquire_time_total': pool_stats.acquire_time_total,
+        'acquire_time_max': pool_stats.acquire_time_max,
+    }
 
-def create_tables(database: peewee_async.PostgresqlDatabase, table: type[Orders]) -> None:
-    database.create_tables([table])
-    logger.info("Tables created")
+
+# Состояние пула соединений в метриках
+metrics.registry.stats_gauges('db_pool', 'Database connection pool', get_pool_stats)
+
+# Время и ошибки каждой функции доступа к бд пишутся в метрики
+_timed = metrics.timed(metrics.DB_QUERY_SECONDS, metrics.DB_QUERY_ERRORS)
+
+
+def _number(number):
+    """Приводит номер заказа к типу колонки, как это сделал бы ORM"""
+    return Orders.number.db_value(number)
+
+
+async def _execute(sql: str, params: tuple) -> int:
+    """Выполняет заранее собранный запрос без результата и возвращает число затронутых строк"""
+    cursor = await db.cursor_async()
+    try:
+        await cursor.execute(sql, params)
+        return cursor.rowcount
+    finally:
+        await cursor.release()
+
+
+async def _fetch(sql: str, params: tuple) -> list[Orders]:
+    """Выполняет заранее собранный запрос и отдает строки как объекты Orders"""
+    return list(await _manager.execute(Orders.raw(sql, *params)))
+
+
+# Список таблиц в текущей схеме бд, без синхронного db.get_tables() в event loop
+@_timed
+async def get_table_names() -> list[str]:
+    cursor = await db.cursor_async()
+    try:
+        await cursor.execute('SELECT tablename FROM pg_tables WHERE schemaname = current_schema() ORDER BY tablename')
+        return [row[0] for row in await cursor.fetchall()]
+    finally:
+        await cursor.release()
 
 
-# Функция для получения всех платежей из бд
+# Функция для получения всех платежей из бд. Грузит всю таблицу в память: для больших выборок — iter_orders()
+@_timed
 async def get_orders():
     elements = await _get_conn().execute(Orders.select())
     list_elements = []
     for element in elements:
         list_elements.append(element)
-    logger.debug(f"Get all of objects from db: {list_elements}")
+    logger.debug("Get all of objects from db: {} orders", len(list_elements))
     return list_elements
 
 
-# Функция для получения платежа из бд по номеру
-async def get_order_by_number(number: str):
+def _orders_page_query(after_number, status_codes, created_from, created_to, limit: int):
+    query = Orders.select()
+    if after_number is not None:
+        query = query.where(Orders.number > after_number)
+    if status_codes:
+        query = query.where(Orders.status_code.in_(status_codes))
+    if created_from is not None:
+        query = query.where(Orders.created >= created_from)
+    if created_to is not None:
+        query = query.where(Orders.created < created_to)
+    return query.order_by(Orders.number).limit(limit)
+
+
+# Потоковый обход заказов с фильтрами по статусам и интервалу создания [created_from, created_to).
+# Keyset-пагинация по number: каждая страница — отдельный короткий запрос WHERE number > последний номер,
+# так что память не зависит от размера таблицы, а соединение не держится между страницами.
+# Серверные курсоры тут не подходят: aiopg работает с асинхронными соединениями psycopg2, а они их не умеют
+async def iter_orders(status_codes: tuple | None = None,
+                      created_from: datetime.datetime | None = None,
+                      created_to: datetime.datetime | None = None,
+                      batch_size: int = settings.export_batch_size):
+    async for page in iter_order_pages(status_codes, created_from, created_to, batch_size):
+        for order in page:
+            yield order
+
+
+# То же постранично: удобно, когда заказы обрабатываются пачками (например, выгрузка)
+async def iter_order_pages(status_codes: tuple | None = None,
+                           created_from: datetime.datetime | None = None,
+                           created_to: datetime.datetime | None = None,
+                           batch_size: int = settings.export_batch_size):
+    after_number = None
+    while True:
+        query = _orders_page_query(after_number, status_codes, created_from, created_to, batch_size)
+        page = list(await _get_conn().execute(query))
+        if not page:
+            return
+        logger.debug("Orders page after {}: {} orders", after_number, len(page))
+        yield page
+        if len(page) < batch_size:
+            return
+        after_number = page[-1].number
+
+
+# Оплаченные заказы без ссылки на чек, постранично по number (индекс orders_missing_receipt).
+# Это чеки, которые не успели создать до остановки процесса: очередь чеков живет только в памяти
+async def iter_orders_without_receipt(batch_size: int = settings.export_batch_size):
+    after_number = None
+    while True:
+        query = Orders.select().where(Orders.status_code == StatusCode.ok.value, Orders.receipt_url.is_null())
+        if after_number is not None:
+            query = query.where(Orders.number > after_number)
+        page = list(await _get_conn().execute(query.order_by(Orders.number).limit(batch_size)))
+        for order in page:
+            yield order
+        if len(page) < batch_size:
+            return
+        after_number = page[-1].number
+
+
+async def _load_order_by_number(number):
     try:
-        order = await _get_conn().get(Orders, number=number)
-        logger.debug(f"Get order from db: {order.number}")
+        orders = await _fetch(_SELECT_ORDER_BY_NUMBER, (_number(number),))
+        if not orders:
+            # Заказа нет среди живых: возможно, он уже в архиве
+            orders = list(await _manager.execute(OrdersArchive.raw(_SELECT_ARCHIVED_ORDER_BY_NUMBER,
+                                                                   _number(number))))
     except Exception as e:
-        logger.debug(f"Something went wrong: {e}")
+        logger.debug("Something went wrong: {}", e)
         return None
-    else:
-        return order
+    if not orders:
+        logger.debug("Order {} not found in db", number)
+        return None
+    logger.debug("Get order from db: {}", orders[0].number)
+    return orders[0]
+
+
+# Заказы по списку номеров одним запросом, например для сверки пачки транзакций. Отдает словарь номер -> заказ,
+# номеров, которых нет в бд, в нем нет
+@_timed
+async def get_orders_by_numbers(numbers) -> dict:
+    numbers = {_number(number) for number in numbers}
+    if not numbers:
+        return {}
+    orders = await _get_conn().execute(Orders.select().where(Orders.number.in_(list(numbers))))
+    return {order.number: order for order in orders}
+
+
+# Какие из номеров уже в архиве. Такие заказы не меняются: update_order() и bulk_update_orders() их не найдут
+@_timed
+async def get_archived_numbers(numbers) -> set:
+    numbers = tuple({_number(number) for number in numbers})
+    if not numbers:
+        return set()
+    cursor = await db.cursor_async()
+    try:
+        await cursor.execute(_SELECT_ARCHIVED_NUMBERS, (numbers,))
+        return {row[0] for row in await cursor.fetchall()}
+    finally:
+        await cursor.release()
+
+
+# Функция для получения платежа по номеру: из Orders, а если там нет — из архива
+@_timed
+async def get_order_by_number(number: str):
+    return await _load_order_by_number(number)
+
+
+# Открытый заказ юзера (description — id юзера в Telegram), который еще можно оплатить по той же ссылке.
+# Итоговые статусы пишутся в бд сразу (claim_order_status, apply_webhook_status), мимо отложенной записи,
+# так что закрытый заказ запрос уже не найдет
+@_timed
+async def get_open_order(description: str, amount, currency: str, created_after: datetime.datetime):
+    orders = await _fetch(_SELECT_OPEN_ORDER, (str(description), Orders.amount.db_value(amount), currency,
+                                               created_after, TERMINAL_STATUS_CODES))
+    if not orders:
+        return None
+    logger.debug("Open order of {}: {}", description, orders[0].number)
+    return orders[0]
 
 
 # Функция для создания нового платежа в бд
+@_timed
 async def add_order(order: Order):
     new_order = await _get_conn().create(Orders,
                                          id=order.id, number=order.number, amount=order.amount, currency=order.currency,
                                          email=order.email, description=order.description,
                                          require_confirmation=order.require_confirmation, url=order.url,
                                          status_code=order.status_code)
-    logger.debug(f'Order created')
+    logger.debug("Order created")
     return new_order
 
 
-# Функция для обновления объекта платежа в базе
+# Функция для обновления объекта платежа в базе. UPDATE ... RETURNING сразу отдает обновленную строку,
+# так что перечитывать ее отдельным запросом не нужно. Если заказа нет или в бд уже более поздний статус, вернется None
+@_timed
 async def update_order(order: Order):
-    result = await _get_conn().execute(Orders.update(status_code=order.status_code,
-                                                     receipt_url=order.receipt_url
-                                                     ).where(Orders.number == order.number))
-    logger.debug(f"Update order. Result: {result}")
-    updated_db_object = await get_order_by_number(order.number)
-    logger.debug(f'Updated db object status code: {updated_db_object.status_code}')
+    orders = await _fetch(_UPDATE_ORDER_STATUS, (order.status_code, order.receipt_url, _number(order.number),
+                                                 order.status_code, status_codes_not_before(order.status_code)))
+    updated_db_object = orders[0] if orders else None
+    logger.debug("Update order {}. Updated db object: {}", order.number, updated_db_object)
     return updated_db_object
 
 
-# Удаляем платеж из базы
-async def delete_order(order: Order) -> None:
-    result = await _get_conn().execute(Orders.delete().where(Orders.number == order.number))
-    logger.debug(f"Delete order. Result: {result}")
-    updated_db_object = await get_order_by_number(order.number)
-    logger.debug(f'Db object deleted: {updated_db_object.status_code}')
\ No newline at end of file
+# Удаляем платеж из базы. DELETE ... RETURNING отдает удаленную строку или None, если ее не было
+@_timed
+async def delete_order(order: Order):
+    orders = await _fetch(_DELETE_ORDER, (_number(order.number),))
+    deleted_db_object = orders[0] if orders else None
+    logger.debug("Delete order {}. Deleted db object: {}", order.number, deleted_db_object)
+    return deleted_db_object
+
+
+# Обновляем статусы и ссылки на чек у пачки заказов одним запросом, например при сверке.
+# Если один заказ встречается несколько раз, берем последнее изменение. receipt_url=None ссылку не трогает.
+# Отдает обновленные строки: заказов, которых нет в бд или где статус уже более поздний, среди них нет
+@_timed
+async def bulk_update_orders(orders: list[Order]) -> list[Orders]:
+    changes = {}
+    for order in orders:
+        changes[_number(order.number)] = (order.status_code, order.receipt_url)
+    if not changes:
+        return []
+
+    values = ', '.join([_BULK_UPDATE_VALUES_ROW] * len(changes))
+    params = tuple(param for number, (status_code, receipt_url) in changes.items()
+                   for param in (number, status_code, receipt_url, list(status_codes_not_before(status_code))))
+    updated = await _fetch(_BULK_UPDATE_ORDERS.format(values=values), params)
+    logger.debug("Bulk update of {} orders. Updated: {}", len(changes), len(updated))
+    return updated
+
+
+# Сохраняем состояние polling-проверки заказа и продлеваем аренду, чтобы после рестарта продолжить с того же места.
+# Обновляем только заказ, который все еще арендован этим поллером. Если аренду уже забрали, вернется False
+@_timed
+async def save_poll_state(number, owner: str, next_check_at: datetime.datetime | None, attempts: int,
+                          status: str | None) -> bool:
+    if next_check_at is not None:
+        lease_owner = owner
+        lease_expires = next_check_at + datetime.timedelta(seconds=settings.lease_ttl)
+    else:
+        # Заказ больше не проверяем, отпускаем аренду
+        lease_owner, lease_expires = None, None
+    result = await _execute(_SAVE_POLL_STATE, (next_check_at, attempts, status, lease_owner, lease_expires,
+                                               _number(number), owner))
+    logger.debug("Save poll state of order {}: {}, attempt {}. Result: {}", number, next_check_at, attempts, result)
+    return result > 0
+
+
+# Ставим новый заказ в расписание. Если owner не передан, заказ заберет любой свободный поллер
+@_timed
+async def schedule_order(number, next_check_at: datetime.datetime, owner: str | None = None) -> None:
+    lease_expires = next_check_at + datetime.timedelta(seconds=settings.lease_ttl) if owner else None
+    result = await _get_conn().execute(Orders.update(next_check_at=next_check_at,
+                                                     poll_attempts=0,
+                                                     lease_owner=owner,
+                                                     lease_expires=lease_expires
+                                                     ).where(Orders.number == number))
+    logger.debug("Schedule order {} for polling at {}. Owner: {}. Result: {}", number, next_check_at, owner, result)
+
+
+# Забираем в аренду заказы, которые пора проверять и которые никто не держит (или чья аренда истекла).
+# FOR UPDATE SKIP LOCKED: несколько поллеров одновременно разбирают разные заказы, не блокируя друг друга
+@_timed
+async def claim_due_orders(owner: str, horizon: datetime.datetime, limit: int) -> list[Orders]:
+    now = utc_now()
+    due_orders = (Orders.select(Orders.number)
+                  .where(Orders.next_check_at.is_null(False),
+                         Orders.next_check_at <= horizon,
+                         Orders.lease_expires.is_null() | (Orders.lease_expires < now),
+                         Orders.status_code.is_null() | Orders.status_code.not_in(TERMINAL_STATUS_CODES))
+                  .order_by(Orders.next_check_at)
+                  .limit(limit)
+                  .for_update('FOR UPDATE SKIP LOCKED'))
+    query = (Orders.update(lease_owner=owner,
+                           lease_expires=now + datetime.timedelta(seconds=settings.lease_ttl))
+             .where(Orders.number.in_(due_orders))
+             .returning(Orders))
+    orders = list(await _get_conn().execute(query))
+    logger.debug("Poller {} claimed {} orders", owner, len(orders))
+    return orders
+
+
+# Применяем статус из хука CloudPayments: регистрируем хук и двигаем статус заказа вперед за один запрос.
+# Если хук уже обрабатывали или статус не новее текущего, вернется None
+@_timed
+async def apply_webhook_status(transaction_id, invoice_id, status_code: int):
+    orders = await _fetch(_APPLY_WEBHOOK_STATUS, (transaction_id, status_code, _number(invoice_id),
+                                                  status_code, status_codes_not_before(status_code)))
+    updated_db_object = orders[0] if orders else None
+    logger.debug("Apply webhook status {} of transaction {} to order {}. Updated db object: {}",
+                 status_code, transaction_id, invoice_id, updated_db_object)
+    return updated_db_object
+
+
+# Самый старый заказ с итоговым статусом, созданный раньше cutoff: с какого месяца нужны секции архива
+@_timed
+async def get_oldest_archivable(cutoff: datetime.datetime) -> datetime.datetime | None:
+    cursor = await db.cursor_async()
+    try:
+        await cursor.execute(_OLDEST_ARCHIVABLE, (TERMINAL_STATUS_CODES, cutoff))
+        return (await cursor.fetchone())[0]
+    finally:
+        await cursor.release()
+
+
+# Создаем секцию архива name для заказов, созданных в [created_from, created_to), если ее еще нет
+@_timed
+async def create_archive_partition(name: str, created_from: datetime.datetime,
+                                   created_to: datetime.datetime) -> None:
+    await _execute(_CREATE_ARCHIVE_PARTITION.format(name=name), (created_from, created_to))
+
+
+# Переносим в архив до limit заказов с итоговым статусом, созданных раньше cutoff, от старых к новым.
+# Отдает, сколько заказов перенесено
+@_timed
+async def move_orders_to_archive(cutoff: datetime.datetime, limit: int) -> int:
+    moved = await _execute(_MOVE_TO_ARCHIVE, (TERMINAL_STATUS_CODES, cutoff, limit))
+    logger.debug("Moved {} orders created before {} to the archive", moved, cutoff)
+    return moved
+
+
+# Забираем обработку итогового статуса заказа: статус пишется сразу, в обход отложенной записи.
+# Если заказ уже закрыт таким же или более поздним статусом (хуком или другим поллером), вернется None
+@_timed
+async def claim_order_status(number, status_code: int):
+    orders = await _fetch(_CLAIM_ORDER_STATUS, (status_code, _number(number), status_codes_not_before(status_code)))
+    claimed_db_object = orders[0] if orders else None
+    logger.debug("Claim status {} of order {}. Claimed db object: {}", status_code, number, claimed_db_object)
+    return claimed_db_object
+
+
+# Забираем обработку итоговых статусов пачки заказов одним запросом, например при сверке.
+# Если один заказ встречается несколько раз, берем последний статус. Отдает забранные строки:
+# заказов, которых нет в бд или которые уже закрыты таким же или более поздним статусом, среди них нет
+@_timed
+async def claim_order_statuses(orders: list[Order]) -> list[Orders]:
+    changes = {_number(order.number): order.status_code for order in orders}
+    if not changes:
+        return []
+
+    values = ', '.join([_CLAIM_VALUES_ROW] * len(changes))
+    params = tuple(param for number, status_code in changes.items()
+                   for param in (number, status_code, list(status_codes_not_before(status_code))))
+    claimed = await _fetch(_CLAIM_ORDER_STATUSES.format(values=values), params)
+    logger.debug("Claim statuses of {} orders. Claimed: {}", len(changes), len(claimed))
+    return claimed
@@ -0,0 +1,60 @@
+import csv
+import datetime
+import decimal
+import io
+import json
+from typing import AsyncIterator
+from payment_bot.config import settings
+from payment_bot.db_infra import db
+
+# Колонки выгрузки: без служебных полей polling-расписания и аренды
+EXPORT_COLUMNS = ('id', 'number', 'amount', 'currency', 'email', 'description', 'require_confirmation',
+                  'url', 'status_code', 'created', 'receipt_url')
+
+# Форматы выгрузки и их Content-Type (charset для text/* добавит StreamingResponse)
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def _plain(value):
+    """Значение колонки в виде, который понятен и csv, и json"""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    return value
+
+
+def _rows(page: list) -> list[list]:
+    return [[_plain(getattr(order, column)) for column in EXPORT_COLUMNS] for order in page]
+
+
+def render_csv(page: list, header: bool = False) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(EXPORT_COLUMNS)
+    writer.writerows(_rows(page))
+    return buffer.getvalue().encode()
+
+
+def render_ndjson(page: list) -> bytes:
+    lines = [json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) for row in _rows(page)]
+    return ('\n'.join(lines) + '\n').encode() if lines else b''
+
+
+async def export_orders(fmt: str,
+                        status_codes: tuple | None = None,
+                        created_from: datetime.datetime | None = None,
+                        created_to: datetime.datetime | None = None,
+                        batch_size: int = settings.export_batch_size) -> AsyncIterator[bytes]:
+    """Выгрузка заказов в csv или ndjson кусками по странице из db.iter_order_pages().
+    В памяти одновременно лежит не больше одной страницы, сколько бы заказов ни было в таблице"""
+    if fmt not in FORMATS:
+        raise ValueError(f'unknown export format: {fmt}')
+    if fmt == 'csv':
+        yield render_csv([], header=True)
+    async for page in db.iter_order_pages(status_codes, created_from, created_to, batch_size):
+        yield render_csv(page) if fmt == 'csv' else render_ndjson(page)
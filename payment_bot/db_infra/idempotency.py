@@ -0,0 +1,36 @@
+from loguru import logger
+from payment_bot.config import settings
+from payment_bot.cloud_payments.models import Transaction
+from payment_bot.db_infra import db
+from payment_bot.db_infra.cache import TTLCache
+
+
+class WebhookDeduplicator:
+    """Идемпотентная обработка хуков CloudPayments. CloudPayments повторяет доставку хука,
+    пока не получит ответ, поэтому один и тот же хук может прийти несколько раз.
+    Ключ — пара (TransactionId, статус). Сначала смотрим в LRU-кэш в памяти: повтор отсекается без бд.
+    Если в кэше пары нет, хук регистрируется в таблице ProcessedWebhooks с уникальным ключом
+    в том же запросе, что и смена статуса заказа, так что повтор не пройдет и между процессами.
+    Хук считается обработанным, как только статус записан: если дальше обработка заказа упадет,
+    повторная доставка ее не запустит, ее повторяет вызывающий (core: settlement.SettlementRetries)."""
+
+    def __init__(self, maxsize: int = settings.webhook_dedup_size, ttl: float = settings.webhook_dedup_ttl):
+        """Метод инициализации"""
+        self._seen = TTLCache(maxsize, ttl)
+        self.duplicates = 0
+
+    async def apply(self, transaction: Transaction):
+        """Применяет статус из хука к заказу. Если хук уже обрабатывали или статус не новее текущего, отдает None"""
+        key = (str(transaction.transaction_id), int(transaction.status_code))
+        if key in self._seen:
+            self.duplicates += 1
+            logger.info("Duplicate webhook of transaction {} skipped", transaction.transaction_id)
+            return None
+
+        order = await db.apply_webhook_status(transaction.transaction_id, transaction.invoice_id,
+                                              int(transaction.status_code))
+        self._seen.set(key, True)
+        return order
+
+    def stats(self) -> dict:
+        return {**self._seen.stats(), 'duplicates': self.duplicates}
@@ -0,0 +1,146 @@
+import asyncio
+from loguru import logger
+from peewee import Database
+
+from payment_bot.db_infra import db
+
+# Версионированные миграции схемы. Каждая миграция — (версия, описание, список SQL-запросов).
+# Примененные версии хранятся в таблице schema_migrations, новые миграции добавляются только в конец списка
+MIGRATIONS = [
+    (1, 'Create Orders table', [
+        # Таблица в том виде, в каком ее раньше создавал create_tables()
+        '''CREATE TABLE IF NOT EXISTS "Orders" (
+            "id" TEXT NOT NULL,
+            "number" TEXT NOT NULL,
+            "amount" NUMERIC(10, 5) NOT NULL,
+            "currency" TEXT NOT NULL,
+            "email" TEXT,
+            "description" TEXT,
+            "require_confirmation" TEXT,
+            "url" TEXT NOT NULL,
+            "status_code" INTEGER,
+            "created" TIMESTAMP NOT NULL,
+            "receipt_url" TEXT
+        )''',
+    ]),
+    (2, 'Polling state and poller leases', [
+        '''ALTER TABLE "Orders"
+            ADD COLUMN IF NOT EXISTS "next_check_at" TIMESTAMP,
+            ADD COLUMN IF NOT EXISTS "poll_attempts" INTEGER NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS "poll_status" TEXT,
+            ADD COLUMN IF NOT EXISTS "lease_owner" TEXT,
+            ADD COLUMN IF NOT EXISTS "lease_expires" TIMESTAMP''',
+        'DROP INDEX IF EXISTS "orders_next_check_at"',
+    ]),
+    (3, 'Typed columns, primary key and indexes', [
+        # Старые TIMESTAMP писались в локальном времени сервера, переводим их в TIMESTAMPTZ в часовом поясе сессии
+        '''ALTER TABLE "Orders"
+            ALTER COLUMN "number" TYPE BIGINT USING "number"::BIGINT,
+            ALTER COLUMN "amount" TYPE NUMERIC(12, 2),
+            ALTER COLUMN "status_code" TYPE SMALLINT,
+            ALTER COLUMN "created" TYPE TIMESTAMPTZ,
+            ALTER COLUMN "created" SET DEFAULT now(),
+            ALTER COLUMN "next_check_at" TYPE TIMESTAMPTZ,
+            ALTER COLUMN "lease_expires" TYPE TIMESTAMPTZ,
+            ADD PRIMARY KEY ("id")''',
+        # Поиск по номеру: get_order_by_number, update_order, delete_order
+        'CREATE UNIQUE INDEX IF NOT EXISTS "orders_number" ON "Orders" ("number")',
+        # Поиск заказов по статусу и дате создания
+        'CREATE INDEX IF NOT EXISTS "orders_status_code_created" ON "Orders" ("status_code", "created")',
+        # Заказы, которые еще ждут polling-проверки: по этому индексу поллеры разбирают аренду
+        '''CREATE INDEX IF NOT EXISTS "orders_pending_next_check_at" ON "Orders" ("next_check_at")
+            WHERE "next_check_at" IS NOT NULL''',
+    ]),
+    (4, 'Processed CloudPayments webhooks', [
+        # Уникальная пара (транзакция, статус): повторная доставка того же хука не пройдет дальше INSERT
+        '''CREATE TABLE IF NOT EXISTS "ProcessedWebhooks" (
+            "transaction_id" BIGINT NOT NULL,
+            "status_code" SMALLINT NOT NULL,
+            "invoice_id" BIGINT,
+            "received_at" TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY ("transaction_id", "status_code")
+        )''',
+    ]),
+    (5, 'Open orders by user', [
+        # Открытый заказ юзера для повторной выдачи ссылки: get_open_order ищет по description и свежести
+        'CREATE INDEX IF NOT EXISTS "orders_description_created" ON "Orders" ("description", "created")',
+    ]),
+    (6, 'Archive of settled orders', [
+        # Архив заказов с итоговым статусом, по месяцу создания. Секции по месяцам создает db_infra/archive.py.
+        # Номер уникален только вместе с created: ключ секционированной таблицы должен включать ключ секций.
+        # Поиск по номеру идет по этому ключу в каждой секции. Кандидатов в архив в Orders ищет
+        # индекс orders_status_code_created
+        '''CREATE TABLE IF NOT EXISTS "OrdersArchive" (
+            "id" TEXT NOT NULL,
+            "number" BIGINT NOT NULL,
+            "amount" NUMERIC(12, 2) NOT NULL,
+            "currency" TEXT NOT NULL,
+            "email" TEXT,
+            "description" TEXT,
+            "require_confirmation" TEXT,
+            "url" TEXT NOT NULL,
+            "status_code" SMALLINT,
+            "created" TIMESTAMPTZ NOT NULL,
+            "receipt_url" TEXT,
+            "archived_at" TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY ("number", "created")
+        ) PARTITION BY RANGE ("created")''',
+    ]),
+    (7, 'Paid orders without a receipt', [
+        # Чеки, которые не успели создать до остановки: очередь чеков при старте добирает их по этому индексу
+        '''CREATE INDEX IF NOT EXISTS "orders_missing_receipt" ON "Orders" ("number")
+            WHERE "status_code" = 2 AND "receipt_url" IS NULL''',
+    ]),
+]
+
+# Ключ advisory lock, чтобы несколько процессов не накатывали миграции одновременно
+_LOCK_KEY = 7412001
+
+
+def migrate(database: Database = db.db) -> list[int]:
+    """Накатывает все непримененные миграции по порядку, каждую в своей транзакции.
+    Возвращает список примененных версий"""
+    database.execute_sql('CREATE TABLE IF NOT EXISTS "schema_migrations" ('
+                         '"version" INTEGER PRIMARY KEY, '
+                         '"description" TEXT NOT NULL, '
+                         '"applied_at" TIMESTAMPTZ NOT NULL DEFAULT now())')
+
+    # Обычно схема уже актуальна: одним запросом узнаем это и не берем блокировку на каждую миграцию
+    cursor = database.execute_sql('SELECT "version" FROM "schema_migrations"')
+    known = {row[0] for row in cursor.fetchall()}
+
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if version in known:
+            continue
+        with database.atomic():
+            database.execute_sql('SELECT pg_advisory_xact_lock(%s)', (_LOCK_KEY,))
+            cursor = database.execute_sql('SELECT 1 FROM "schema_migrations" WHERE "version" = %s', (version,))
+            if cursor.fetchone():
+                continue
+            for statement in statements:
+                database.execute_sql(statement)
+            database.execute_sql('INSERT INTO "schema_migrations" ("version", "description") VALUES (%s, %s)',
+                                 (version, description))
+        logger.info("Migration {} applied: {}", version, description)
+        applied.append(version)
+
+    logger.info("Database schema is up to date. Applied migrations: {}", applied or 'none')
+    return applied
+
+
+def _migrate_and_close(database: Database) -> list[int]:
+    try:
+        return migrate(database)
+    finally:
+        # Синхронное соединение принадлежит потоку executor'а, приложению оно больше не нужно
+        database.close()
+
+
+async def migrate_async(database: Database = db.db) -> list[int]:
+    """То же, что migrate(), но в потоке executor'а: синхронные запросы не блокируют event loop при старте"""
+    return await asyncio.get_running_loop().run_in_executor(None, _migrate_and_close, database)
+
+
+if __name__ == '__main__':
+    migrate()
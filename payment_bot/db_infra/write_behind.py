@@ -0,0 +1,107 @@
+import asyncio
+from types import SimpleNamespace
+from loguru import logger
+from payment_bot import metrics
+from payment_bot.config import settings
+from payment_bot.cloud_payments.models import Order
+from payment_bot.db_infra import db
+
+
+class WriteBehindBuffer:
+    """Отложенная запись статусов заказов. Методы:
+    submit() — запоминает новый статус и ссылку на чек заказа, в бд они уйдут со следующей пачкой
+    flush() — сразу пишет все накопленное одним запросом (db.bulk_update_orders)
+    start() и stop() — запускают периодическую запись и останавливают ее, дописывая остаток
+
+    Если один заказ поменялся несколько раз до записи, в бд уйдет последнее состояние.
+    Пачки пишутся строго по очереди, так что более раннее изменение не перезапишет более позднее.
+    Статус, который в бд уже сменился более поздним (например, хуком), пачка не откатит."""
+
+    def __init__(self, interval_ms: int = settings.write_behind_interval_ms,
+                 max_rows: int = settings.write_behind_max_rows):
+        """Метод инициализации"""
+        self.interval = interval_ms / 1000
+        self.max_rows = max_rows
+        self._pending: dict = {}
+        self._lock = asyncio.Lock()
+        self._runner: asyncio.Task | None = None
+        self.flushes = 0
+        self.rows_written = 0
+        self.failures = 0
+
+    async def submit(self, order: Order) -> None:
+        """Запоминает состояние заказа. Если накопилось max_rows заказов, сразу пишет пачку"""
+        # Снимок, а не сам объект: заказ могут поменять еще раз, пока он ждет записи
+        self._pending[str(order.number)] = SimpleNamespace(number=order.number, status_code=order.status_code,
+                                                      receipt_url=order.receipt_url)
+        # Кэш заказов обновится строками, которые бд примет при записи пачки (db.bulk_update_orders)
+        if len(self._pending) >= self.max_rows:
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Пишет все накопленные изменения одним запросом"""
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            try:
+                await db.bulk_update_orders(list(batch.values()))
+            except Exception as e:
+                self.failures += 1
+                logger.error("Write-behind flush of {} orders failed: {}", len(batch), e)
+                # Возвращаем пачку в буфер, но не затираем изменения, которые пришли после нее
+                self._pending = {**batch, **self._pending}
+                return
+            self.flushes += 1
+            self.rows_written += len(batch)
+            logger.debug("Write-behind flushed {} orders", len(batch))
+
+    async def start(self) -> None:
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._flush_periodically())
+            logger.info("Write-behind started: every {}s or {} orders", self.interval, self.max_rows)
+
+    async def stop(self) -> None:
+        """Останавливает периодическую запись и синхронно дописывает все, что осталось в буфере"""
+        if self._runner is not None:
+            self._runner.cancel()
+            await asyncio.gather(self._runner, return_exceptions=True)
+            self._runner = None
+        await self.flush()
+        logger.info("Write-behind stopped. Orders written: {}, left: {}", self.rows_written, len(self._pending))
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._pending),
+            'flushes': self.flushes,
+            'rows_written': self.rows_written,
+            'failures': self.failures,
+        }
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+
+buffer = WriteBehindBuffer()
+metrics.registry.stats_gauges('write_behind', 'Write-behind buffer of order status updates', buffer.stats)
+
+
+async def save_order(order: Order):
+    """Сохраняет статус и ссылку на чек заказа. Если включена отложенная запись, кладет изменение в буфер
+    и сразу отдает тот же заказ, иначе пишет в бд сразу и отдает обновленную строку.
+    Статус в бд двигается только вперед: если там уже более поздний статус, вернется None"""
+    if settings.write_behind_enabled:
+        await buffer.submit(order)
+        return order
+    return await db.update_order(order)
+
+
+async def start() -> None:
+    if settings.write_behind_enabled:
+        await buffer.start()
+
+
+async def stop() -> None:
+    await buffer.stop()
@@ -0,0 +1,7 @@
+from payment_bot import web
+
+# Гибридный режим: статусы платежей приходят хуками CloudPayments /pay и /fail, а payments/find проверяет
+# только заказы, по которым хук не пришел за settings.webhook_grace секунд (потерянные хуки).
+# Пришедший хук снимает заказ с проверок. Запуск: uvicorn payment_bot.hybrid_mode:app
+app = web.create_app('Hybrid mode', fallback_polling=True)
+lifecycle = app.state.lifecycle
@@ -0,0 +1,74 @@
+import asyncio
+import time
+from typing import Awaitable, Callable
+from loguru import logger
+
+
+class Step:
+    """Шаг запуска: start() при старте и stop() при остановке. Любой из них может быть None"""
+
+    def __init__(self, name: str, start: Callable[[], Awaitable] | None = None,
+                 stop: Callable[[], Awaitable] | None = None):
+        """Метод инициализации"""
+        self.name = name
+        self.start = start
+        self.stop = stop
+
+
+class Lifecycle:
+    """Запуск и остановка компонентов приложения. Методы:
+    stage() — добавляет этап: шаги одного этапа запускаются одновременно, этапы — друг за другом
+    start() — запускает этапы по порядку и пишет в лог, сколько занял каждый шаг
+    stop() — останавливает запущенные шаги в обратном порядке. Ошибка одного шага не мешает остальным
+    stats() — время запуска по шагам
+
+    Если шаг упал при запуске, уже запущенные шаги останавливаются, а ошибка пробрасывается дальше"""
+
+    def __init__(self, name: str):
+        """Метод инициализации"""
+        self.name = name
+        self._stages: list[list[Step]] = []
+        self._started: list[Step] = []
+        self.timings: dict[str, float] = {}
+        self.total = 0.0
+
+    def stage(self, *steps: Step) -> 'Lifecycle':
+        self._stages.append(list(steps))
+        return self
+
+    async def start(self) -> None:
+        started = time.perf_counter()
+        try:
+            for stage in self._stages:
+                results = await asyncio.gather(*(self._start_step(step) for step in stage), return_exceptions=True)
+                errors = [result for result in results if isinstance(result, BaseException)]
+                if errors:
+                    raise errors[0]
+        except BaseException:
+            await self.stop()
+            raise
+        self.total = time.perf_counter() - started
+        logger.info("{} started in {:.3f}s: {}", self.name, self.total,
+                    ', '.join(f'{name} {seconds:.3f}s' for name, seconds in self.timings.items()))
+
+    async def _start_step(self, step: Step) -> None:
+        started = time.perf_counter()
+        if step.start is not None:
+            await step.start()
+        self.timings[step.name] = time.perf_counter() - started
+        self._started.append(step)
+
+    async def stop(self) -> None:
+        # Порядок остановки — обратный порядку этапов, внутри этапа — обратный порядку объявления
+        order = {id(step): index for index, step in enumerate(step for stage in self._stages for step in stage)}
+        for step in sorted(self._started, key=lambda item: order[id(item)], reverse=True):
+            if step.stop is None:
+                continue
+            try:
+                await step.stop()
+            except Exception as e:
+                logger.error("{}: stopping {} failed: {}", self.name, step.name, e)
+        self._started = []
+
+    def stats(self) -> dict:
+        return {'total_seconds': self.total, 'step_seconds': dict(self.timings)}
@@ -0,0 +1,48 @@
+import sys
+from loguru import logger
+from payment_bot.config import settings
+
+# Формат как у loguru по умолчанию
+LOG_FORMAT = ('<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | '
+              '<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>')
+
+
+def setup_logging(level: str | None = None, log_file: str | None = None) -> None:
+    """Настраивает loguru для процесса. Вызывается один раз при запуске режима.
+    Сообщения ниже level отбрасываются до форматирования. С settings.log_enqueue запись в stderr и файл
+    идет из отдельного потока, а не из event loop.
+    Перед выходом нужно дождаться записи хвоста очереди: await logger.complete()"""
+    level = (level or settings.log_level).upper()
+    log_file = log_file or settings.log_file
+    logger.remove()
+    logger.add(sys.stderr, level=level, format=LOG_FORMAT, enqueue=settings.log_enqueue)
+    if log_file:
+        logger.add(log_file, level=level, format=LOG_FORMAT, enqueue=settings.log_enqueue,
+                   rotation=settings.log_rotation)
+
+
+class SampledLogger:
+    """Лог для частых событий: пропускает в лог первое и дальше каждое every-е сообщение.
+    Счетчик свой у каждого объекта, поэтому заводится один объект на одно место в коде.
+    Отброшенные сообщения не форматируются, аргументы уходят в loguru как есть"""
+
+    def __init__(self, every: int = settings.log_sample_every):
+        """Метод инициализации"""
+        self.every = max(1, every)
+        self.seen = 0
+
+    def _log(self, level: str, message: str, args: tuple, kwargs: dict) -> None:
+        self.seen += 1
+        if (self.seen - 1) % self.every:
+            return
+        # depth=2: в записи будет место вызова debug()/info(), а не этот метод
+        logger.opt(depth=2).bind(sampled=self.every).log(level, message, *args, **kwargs)
+
+    def debug(self, message: str, *args, **kwargs) -> None:
+        self._log('DEBUG', message, args, kwargs)
+
+    def info(self, message: str, *args, **kwargs) -> None:
+        self._log('INFO', message, args, kwargs)
+
+    def warning(self, message: str, *args, **kwargs) -> None:
+        self._log('WARNING', message, args, kwargs)
@@ -0,0 +1,280 @@
+import bisect
+import functools
+import math
+import time
+from typing import Callable
+from loguru import logger
+from payment_bot.config import settings
+
+# Content-Type текстового формата Prometheus
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Границы корзин гистограмм задержек по умолчанию, в секундах
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Общая часть метрик: имя, описание, метки и дочерние серии по значениям меток.
+    labels() кэширует серию, так что на горячем пути остается поиск в словаре"""
+
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        """Метод инициализации"""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: dict[tuple, object] = {}
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def collect(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for values, child in list(self._children.items()):
+            lines.extend(self._collect_child(values, child))
+        return lines
+
+    def _collect_child(self, values: tuple, child) -> list[str]:
+        raise NotImplementedError
+
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Counter(_Metric):
+    """Счетчик, который только растет"""
+
+    type = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def _collect_child(self, values: tuple, child: _CounterChild) -> list[str]:
+        return [f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}']
+
+
+class _HistogramChild:
+    __slots__ = ('upper_bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, upper_bounds: tuple):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        # Накопительные суммы по корзинам считаются только при выгрузке, здесь одна корзина на наблюдение
+        self.counts[bisect.bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    """Гистограмма с фиксированными корзинами, обычно для задержек в секундах"""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        """Метод инициализации"""
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def _collect_child(self, values: tuple, child: _HistogramChild) -> list[str]:
+        lines = []
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets + (math.inf,), child.counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, f'le="{_format_value(upper_bound)}"')
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f'{self.name}_sum{labels} {_format_value(child.sum)}')
+        lines.append(f'{self.name}_count{labels} {child.count}')
+        return lines
+
+
+class StatsGauges:
+    """Гейджи из stats() компонентов: очереди, пулы, кэши. Значения берутся в момент выгрузки,
+    поэтому на горячем пути ничего не стоят. Вложенные словари разворачиваются в имя через '_',
+    строковые значения (например, состояние circuit breaker) выгружаются как метка со значением 1"""
+
+    def __init__(self, prefix: str, documentation: str, stats: Callable[[], dict]):
+        """Метод инициализации"""
+        self.prefix = prefix
+        self.documentation = documentation
+        self.stats = stats
+
+    def collect(self) -> list[str]:
+        try:
+            stats = self.stats()
+        except Exception as e:
+            logger.warning("Metrics of {} were not collected: {}", self.prefix, e)
+            return []
+        lines = []
+        for name, value in self._flatten(self.prefix, stats):
+            lines.append(f'# HELP {name} {self.documentation}')
+            lines.append(f'# TYPE {name} gauge')
+            if isinstance(value, str):
+                lines.append(f'{name}{{value="{_escape(value)}"}} 1')
+            else:
+                lines.append(f'{name} {_format_value(value)}')
+        return lines
+
+    def _flatten(self, prefix: str, stats: dict):
+        for key, value in stats.items():
+            name = f'{prefix}_{key}'
+            if isinstance(value, dict):
+                yield from self._flatten(name, value)
+            elif isinstance(value, bool):
+                yield name, int(value)
+            elif isinstance(value, (int, float, str)) or value is None:
+                yield name, value if value is not None else 0
+
+
+class Registry:
+    """Все метрики процесса. render() отдает их в текстовом формате Prometheus"""
+
+    def __init__(self):
+        """Метод инициализации"""
+        self._collectors: dict[str, object] = {}
+
+    def register(self, collector):
+        self._collectors[getattr(collector, 'name', None) or collector.prefix] = collector
+        return collector
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def stats_gauges(self, prefix: str, documentation: str, stats: Callable[[], dict]) -> StatsGauges:
+        return self.register(StatsGauges(prefix, documentation, stats))
+
+    def render(self) -> str:
+        lines = []
+        for collector in list(self._collectors.values()):
+            lines.extend(collector.collect())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# Метрики горячего пути
+CLOUDPAYMENTS_REQUEST_SECONDS = registry.histogram(
+    'cloudpayments_request_seconds', 'CloudPayments request latency, including retries', ('endpoint',))
+CLOUDPAYMENTS_REQUESTS = registry.counter(
+    'cloudpayments_requests_total', 'CloudPayments requests by outcome', ('endpoint', 'outcome'))
+DB_QUERY_SECONDS = registry.histogram(
+    'db_query_seconds', 'Latency of db_infra.db functions', ('function',))
+DB_QUERY_ERRORS = registry.counter(
+    'db_query_errors_total', 'Failed db_infra.db calls', ('function',))
+HANDLER_SECONDS = registry.histogram(
+    'bot_handler_seconds', 'Latency of aiogram handlers', ('handler',))
+THROTTLED_MESSAGES = registry.counter(
+    'bot_throttled_messages_total', 'Messages dropped by per-user rate limits', ('handler',))
+TELEGRAM_SEND_SECONDS = registry.histogram(
+    'telegram_send_message_seconds', 'Latency of bot.send_message', ('outcome',))
+
+
+def timed(histogram: Histogram, errors: Counter | None = None, label: str | None = None):
+    """Декоратор для корутин: пишет время выполнения в histogram, а упавшие вызовы в errors.
+    Метка — label или имя функции. Серии метрик берутся один раз при декорировании"""
+
+    def decorator(func):
+        name = label or func.__name__
+        observe = histogram.labels(name).observe
+        error_counter = errors.labels(name) if errors is not None else None
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                if error_counter is not None:
+                    error_counter.inc()
+                raise
+            finally:
+                observe(time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+class MetricsServer:
+    """Небольшой HTTP-сервер с одной ручкой /metrics для режимов без FastAPI (polling_mode, polling_worker)"""
+
+    def __init__(self, host: str = settings.metrics_host, port: int = settings.metrics_port):
+        """Метод инициализации. port=0 — сервер не запускается"""
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self) -> None:
+        if not self.port or self._runner is not None:
+            return
+        from aiohttp import web
+
+        async def handle(request: web.Request) -> web.Response:
+            return web.Response(body=registry.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.host, self.port).start()
+        except OSError as e:
+            # Без метрик бот работать может, так что не падаем
+            logger.error("Metrics server was not started on {}:{}: {}", self.host, self.port, e)
+            await runner.cleanup()
+            return
+        self._runner = runner
+        logger.info("Metrics are served on http://{}:{}/metrics", self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
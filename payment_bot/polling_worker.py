@@ -0,0 +1,29 @@
+import asyncio
+import signal
+from loguru import logger
+from payment_bot import polling_mode
+from payment_bot.config import settings
+from payment_bot.logs import setup_logging
+
+
+async def main() -> None:
+    """Отдельный поллер без приема апдейтов Telegram: только разбирает заказы из общего пула
+    и проверяет их в CloudPayments. Таких процессов можно запустить сколько угодно рядом с polling_mode.py,
+    заказы делятся между ними через аренду строк в Orders (POLLING_DISTRIBUTED=true)"""
+    await polling_mode.on_startup(polling_mode.dp)
+    logger.info("Polling worker {} is running", settings.poller_id)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    await polling_mode.on_shutdown(polling_mode.dp)
+    session = await polling_mode.bot.get_session()
+    await session.close()
+
+
+if __name__ == '__main__':
+    setup_logging()
+    asyncio.run(main())
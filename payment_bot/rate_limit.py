@@ -0,0 +1,40 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Token bucket для ограничения частоты запросов.
+    rate — сколько токенов добавляется в секунду, capacity — максимальный размер всплеска"""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        """Метод инициализации. Корзина создается полной"""
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        """Доливаем токены за время, прошедшее с прошлого обращения"""
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """Забирает токены, если они есть. Не ждет"""
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    def delay(self, tokens: float = 1.0) -> float:
+        """Сколько секунд ждать, пока в корзине наберется нужное число токенов"""
+        self._refill()
+        if self._tokens >= tokens:
+            return 0.0
+        return (tokens - self._tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        """Ждет, пока появятся токены, и забирает их"""
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.delay(tokens))
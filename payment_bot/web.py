@@ -0,0 +1,128 @@
+import datetime
+import hmac
+from fastapi import APIRouter, FastAPI, Header, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from aiogram import types, Dispatcher, Bot
+from loguru import logger
+from payment_bot import core, metrics
+from payment_bot.lifecycle import Step
+from payment_bot.logs import setup_logging
+from payment_bot.config import settings
+from payment_bot.cloud_payments import models
+from payment_bot.bot_infra.update_queue import UpdateQueue
+
+# FastAPI-часть режимов с вебхуками (webhooks_mode.py и hybrid_mode.py): апдейты Telegram,
+# хуки CloudPayments, метрики и выгрузка заказов. Приложение собирает create_app()
+
+# Очередь апдейтов для быстрого ответа Telegram (settings.webhook_fast_ack)
+update_queue = UpdateQueue(core.dp)
+metrics.registry.stats_gauges('update_queue', 'Telegram update queue', update_queue.stats)
+
+router = APIRouter()
+
+
+async def register_webhook() -> None:
+    """Регистрирует вебхук одним запросом. skip_updates — drop_pending_updates=True в том же setWebhook"""
+    url = f"{settings.ngrok_url}{settings.webhook_path}"
+    if not settings.skip_updates:
+        webhook_info = await core.bot.get_webhook_info()
+        if webhook_info.url == url:
+            return
+    await core.bot.set_webhook(url=url, drop_pending_updates=settings.skip_updates)
+
+
+async def start_update_queue() -> None:
+    if settings.webhook_fast_ack:
+        await update_queue.start()
+
+
+def create_app(name: str, fallback_polling: bool = False) -> FastAPI:
+    """FastAPI-приложение режима с вебхуками. Вебхук Telegram регистрируется последним, когда все готово
+    принимать апдейты, и при остановке удаляется первым.
+    fallback_polling=True — гибридный режим: заказ, по которому за settings.webhook_grace секунд не пришел хук
+    CloudPayments, проверяется планировщиком через payments/find"""
+    lifecycle = core.build_lifecycle(
+        name, polling=fallback_polling,
+        first_check_delay=settings.webhook_grace if fallback_polling else None,
+        first_stage=(Step('bot_session', stop=core.close_bot_session),),
+        # Дорабатываем апдейты, которые уже приняли от Telegram
+        second_stage=(Step('update_queue', start_update_queue, update_queue.stop),),
+        last_stage=(Step('webhook', register_webhook, core.bot.delete_webhook),),
+    )
+
+    async def on_startup():
+        setup_logging()
+        await lifecycle.start()
+
+    # Удаляет вебхук, дорабатывает очереди и закрывает сессию бота и пулы соединений
+    async def on_shutdown():
+        await lifecycle.stop()
+        # Дописываем логи, которые еще в очереди sink'ов
+        await logger.complete()
+
+    app = FastAPI(on_startup=[on_startup], on_shutdown=[on_shutdown])
+    app.include_router(router)
+    app.state.lifecycle = lifecycle
+    logger.debug('Start {}', name)
+    return app
+
+
+# ---- FastAPI handlers ---- #
+# Доставляет изменения боту при получении POST запроса от Telegram API.
+# В режиме webhook_fast_ack только кладет апдейт в очередь и сразу отвечает Telegram
+@router.post(settings.webhook_path)
+async def bot_webhook(update: dict):
+    telegram_update = types.Update(**update)
+    if settings.webhook_fast_ack:
+        if not await update_queue.put(telegram_update):
+            # Очередь переполнена: Telegram повторит доставку позже
+            return Response(status_code=503)
+        return
+    Dispatcher.set_current(core.dp)
+    Bot.set_current(core.bot)
+    await core.dp.process_update(telegram_update)
+
+
+# Метрики в текстовом формате Prometheus
+@router.get("/metrics")
+async def get_metrics():
+    return Response(content=metrics.registry.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+# Потоковая выгрузка заказов в csv или ndjson с фильтрами по статусам и интервалу создания [created_from, created_to).
+# Доступ по заголовку Authorization: Bearer <settings.export_token>, без токена в настройках ручки нет
+@router.get("/orders/export")
+async def export_orders(format: str = 'csv',
+                        status: list[int] | None = Query(None),
+                        created_from: datetime.datetime | None = None,
+                        created_to: datetime.datetime | None = None,
+                        authorization: str | None = Header(None)):
+    if not settings.export_token:
+        return Response(status_code=404)
+    if not hmac.compare_digest((authorization or '').encode(), f'Bearer {settings.export_token}'.encode()):
+        return Response(status_code=401)
+    # Модуль выгрузки нужен редко, не тянем его при старте
+    from payment_bot.db_infra import export
+    if format not in export.FORMATS:
+        return Response(content=f'Unknown format {format}, expected one of: {", ".join(export.FORMATS)}',
+                        status_code=400)
+    chunks = export.export_orders(format, tuple(status) if status else None, created_from, created_to)
+    return StreamingResponse(chunks, media_type=export.FORMATS[format],
+                             headers={'Content-Disposition': f'attachment; filename="orders.{format}"'})
+
+
+# Хук для успешной оплаты CloudPayments
+@router.post("/pay")
+async def receive_pay_webhook(request: Request):
+    # Обрабатываем запрос, пришедший по хуку, изменяем нужный Order
+    new_order = await core.apply_webhook(await request.body(), status_code=models.StatusCode.ok.value)
+    logger.debug(new_order)
+
+
+# Хук для ошибки оплаты CloudPayments: попытка отклонена, заказ остается открытым
+@router.post("/fail")
+async def receive_fail_webhook(request: Request):
+    # Обрабатываем запрос, пришедший по хуку, изменяем нужный Order
+    new_order = await core.apply_webhook(await request.body(), status_code=models.StatusCode.declined.value)
+    logger.debug(new_order)
+# ------------------------- #